@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Prepared analytics over a database loaded by sqlite_loader.py.
+
+The statistics in OpenStreetMap+Project.md (element counts, distinct uids of the nodes and
+ways, top contributors, tag type breakdowns) were typed into the sqlite3 shell by hand, and each
+of them scans a whole table.  Analytics answers them from three layers:
+
+- summary tables: summary_elements (elements per element type), summary_users (elements per
+  element type, uid and user) and summary_tag_types (tags per element type and tag type).
+  sqlite_loader.py fills them when a load is closed, and osc_update.py keeps them up to date:
+  the contribution of a changed element is subtracted before its rows are replaced and added
+  again after, so a diff costs a few row updates instead of a rebuild.  A query then reads a
+  few thousand summary rows instead of millions of element and tag rows.
+- covering indexes: with direct=True the queries run against the tables themselves, as in the
+  report (e.g. to check the summaries).  The index that lets each of them scan an index instead
+  of the table is created the first time it is needed, not by every load.
+- result cache: results are saved to a JSON file next to the database (map.db.analytics.json)
+  keyed by the database generation, a random id made by each load plus the number of
+  osc_update.py transactions applied since.  Asking again before the database changes reads
+  the saved result without touching the tables.
+
+A database loaded before this module existed gets its summary tables the first time it is
+opened with Analytics.
+
+Usage:
+    python analytics.py map.db --top 10
+    python analytics.py map.db --direct --no-cache
+"""
+import argparse
+import binascii
+import json
+import os
+import pprint
+import sqlite3
+from timeit import default_timer as timer
+
+import checkpoint
+
+TAGS = ('node', 'way', 'relation')
+#element table and tag table of each element type
+ELEMENT_TABLES = {'node': ('nodes', 'nodes_tags'),
+                  'way': ('ways', 'ways_tags'),
+                  'relation': ('relations', 'relations_tags')}
+TOP = 10
+#suffix of the result cache file next to the database
+CACHE_SUFFIX = '.analytics.json'
+
+SUMMARY_TABLES = [
+    'CREATE TABLE analytics_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+    'CREATE TABLE summary_elements (tag TEXT PRIMARY KEY, elements INTEGER NOT NULL)',
+    '''CREATE TABLE summary_users (
+            tag TEXT NOT NULL,
+            uid INTEGER,
+            user TEXT,
+            elements INTEGER NOT NULL
+        )''',
+    'CREATE INDEX summary_users_key ON summary_users (tag, uid, user)',
+    '''CREATE TABLE summary_tag_types (
+            tag TEXT NOT NULL,
+            type TEXT NOT NULL,
+            tags INTEGER NOT NULL,
+            PRIMARY KEY (tag, type)
+        )''',
+]
+FILL_ELEMENTS = "INSERT INTO summary_elements SELECT '{tag}', COUNT(*) FROM {table}"
+FILL_USERS = "INSERT INTO summary_users SELECT '{tag}', uid, user, COUNT(*) FROM {table} GROUP BY uid, user"
+FILL_TAG_TYPES = "INSERT INTO summary_tag_types SELECT '{tag}', type, COUNT(*) FROM {tags_table} GROUP BY type"
+
+#the queries of the report, from the summary tables and directly from the loaded tables
+SUMMARY_QUERIES = {
+    'elements': 'SELECT elements FROM summary_elements WHERE tag = ?',
+    'unique_users': "SELECT COUNT(DISTINCT uid) FROM summary_users WHERE tag IN ('node', 'way')",
+    'top_users': '''SELECT user, SUM(elements) FROM summary_users WHERE tag = ?
+                    GROUP BY user ORDER BY SUM(elements) DESC, user LIMIT ?''',
+    'tag_types': 'SELECT type, tags FROM summary_tag_types WHERE tag = ? ORDER BY tags DESC, type LIMIT ?',
+}
+DIRECT_QUERIES = {
+    'elements': 'SELECT COUNT(*) FROM {table}',
+    'unique_users': 'SELECT COUNT(DISTINCT(e.uid)) FROM (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) e',
+    'top_users': 'SELECT user, COUNT(*) FROM {table} GROUP BY user ORDER BY COUNT(*) DESC, user LIMIT ?',
+    'tag_types': 'SELECT type, COUNT(*) FROM {tags_table} GROUP BY type ORDER BY COUNT(*) DESC, type LIMIT ?',
+}
+#covering indexes of the direct queries, by the tables they read
+COVERING_INDEXES = {
+    'elements': ['CREATE INDEX IF NOT EXISTS {table}_user_uid ON {table} (user, uid)'],
+    'unique_users': ['CREATE INDEX IF NOT EXISTS nodes_user_uid ON nodes (user, uid)',
+                     'CREATE INDEX IF NOT EXISTS ways_user_uid ON ways (user, uid)'],
+    'top_users': ['CREATE INDEX IF NOT EXISTS {table}_user_uid ON {table} (user, uid)'],
+    'tag_types': ['CREATE INDEX IF NOT EXISTS {tags_table}_type ON {tags_table} (type)'],
+}
+
+
+def has_summaries(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'analytics_state'").fetchone() is not None
+
+
+def build_summaries(conn):
+    """Create (or empty) and fill the summary tables from the loaded tables, under a new load id"""
+    if not has_summaries(conn):
+        for create in SUMMARY_TABLES:
+            conn.execute(create)
+    for name in ('summary_elements', 'summary_users', 'summary_tag_types'):
+        conn.execute('DELETE FROM {0}'.format(name))
+    for tag in TAGS:
+        table, tags_table = ELEMENT_TABLES[tag]
+        for fill in (FILL_ELEMENTS, FILL_USERS, FILL_TAG_TYPES):
+            conn.execute(fill.format(tag=tag, table=table, tags_table=tags_table))
+    conn.execute("INSERT OR REPLACE INTO analytics_state VALUES ('load_id', ?)", (binascii.hexlify(os.urandom(8)).decode('ascii'),))
+    conn.execute("INSERT OR REPLACE INTO analytics_state VALUES ('changes', '0')")
+
+
+def generation(conn):
+    """Return the generation of the database, which changes with every load and applied diff"""
+    state = dict(conn.execute('SELECT key, value FROM analytics_state'))
+    return '{0}:{1}'.format(state['load_id'], state['changes'])
+
+
+#adds delta to the count column of the summary row with the given key columns, making the row if needed
+#(the uid and user of an element may be NULL, so the row is looked up with IS rather than a primary key)
+def add_to(conn, table, count_column, key, delta):
+    columns = sorted(key)
+    values = [key[column] for column in columns]
+    updated = conn.execute('UPDATE {0} SET {1} = {1} + ? WHERE {2}'.format(
+        table, count_column, ' AND '.join(column + ' IS ?' for column in columns)), [delta] + values).rowcount
+    if not updated:
+        conn.execute('INSERT INTO {0} ({1}, {2}) VALUES ({3})'.format(
+            table, ', '.join(columns), count_column, ', '.join('?' * (len(columns) + 1))), values + [delta])
+
+
+def count_element(conn, tag, element_id, sign):
+    """Add (sign 1) or subtract (sign -1) the rows of one element in the summary tables
+
+    osc_update.py calls it with -1 before the rows of a changed element are deleted and with 1
+    once its new rows are in.
+    """
+    table, tags_table = ELEMENT_TABLES[tag]
+    row = conn.execute('SELECT uid, user FROM {0} WHERE id = ?'.format(table), (element_id,)).fetchone()
+    if row is None:
+        return
+    conn.execute('UPDATE summary_elements SET elements = elements + ? WHERE tag = ?', (sign, tag))
+    add_to(conn, 'summary_users', 'elements', {'tag': tag, 'uid': row[0], 'user': row[1]}, sign)
+    for tag_type, tags in conn.execute('SELECT type, COUNT(*) FROM {0} WHERE id = ? GROUP BY type'.format(tags_table),
+                                       (element_id,)).fetchall():
+        add_to(conn, 'summary_tag_types', 'tags', {'tag': tag, 'type': tag_type}, sign * tags)
+
+
+def changes_applied(conn, applied):
+    """Drop the summary rows counted down to 0 and move to the next generation
+
+    applied is the number of changes that were applied.  A diff whose changes were all stale
+    changed nothing, so the generation (and the cached results with it) is kept.
+    """
+    if not applied:
+        return
+    conn.execute('DELETE FROM summary_users WHERE elements = 0')
+    conn.execute('DELETE FROM summary_tag_types WHERE tags = 0')
+    conn.execute("UPDATE analytics_state SET value = CAST(value AS INTEGER) + 1 WHERE key = 'changes'")
+
+
+class ResultCache(object):
+    """Query results saved in a JSON file, valid for one database generation"""
+
+    def __init__(self, path, generation):
+        self.path = path
+        self.generation = generation
+        self.results = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path) as cache_file:
+                saved = json.load(cache_file)
+            if saved.get('generation') == generation:
+                self.results = saved['results']
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def put(self, key, result):
+        self.results[key] = result
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        checkpoint.replace_file(self.path, json.dumps({'generation': self.generation, 'results': self.results}))
+        self.dirty = False
+
+
+class Analytics(object):
+    """The report's statistics of the database at db_path
+
+    Results come from the summary tables, or with direct from the loaded tables (through their
+    covering indexes).  With cache (the default) they are also saved to cache_path, db_path +
+    CACHE_SUFFIX by default, and served from there until the database generation changes.
+    """
+
+    def __init__(self, db_path, direct=False, cache=True, cache_path=None):
+        self.conn = sqlite3.connect(db_path, isolation_level=None)
+        self.direct = direct
+        if not has_summaries(self.conn):
+            self.conn.execute('BEGIN IMMEDIATE')
+            build_summaries(self.conn)
+            self.conn.execute('COMMIT')
+        self.generation = generation(self.conn)
+        self.cache = None
+        if cache:
+            self.cache = ResultCache(cache_path or db_path + CACHE_SUFFIX, self.generation)
+        self.indexed = set()
+        self.timings = {}
+
+    def query(self, name, tag=None, limit=None):
+        """Return the rows of the named query for an element type, cached unless direct"""
+        key = ':'.join(str(part) for part in (name, tag, limit) if part is not None)
+        if self.cache is not None and not self.direct:
+            rows = self.cache.get(key)
+            if rows is not None:
+                return rows
+        start = timer()
+        if self.direct:
+            table, tags_table = ELEMENT_TABLES.get(tag, (None, None))
+            for index in COVERING_INDEXES[name]:
+                index = index.format(table=table, tags_table=tags_table)
+                if index not in self.indexed:
+                    self.conn.execute(index)
+                    self.indexed.add(index)
+            sql = DIRECT_QUERIES[name].format(table=table, tags_table=tags_table)
+            params = [limit] if limit is not None else []
+        else:
+            sql = SUMMARY_QUERIES[name]
+            params = [value for value in (tag, limit) if value is not None]
+        rows = [list(row) for row in self.conn.execute(sql, params)]
+        self.timings[key] = round(timer() - start, 6)
+        if self.cache is not None and not self.direct:
+            self.cache.put(key, rows)
+        return rows
+
+    def elements(self, tag):
+        rows = self.query('elements', tag)
+        return rows[0][0] if rows else 0
+
+    def unique_users(self):
+        return self.query('unique_users')[0][0]
+
+    def top_users(self, tag='node', limit=TOP):
+        return self.query('top_users', tag, limit)
+
+    def tag_types(self, tag='node', limit=TOP):
+        return self.query('tag_types', tag, limit)
+
+    def report(self, limit=TOP):
+        """Return all of the statistics as a JSON-ready dict"""
+        return {'generation': self.generation,
+                'elements': dict((tag, self.elements(tag)) for tag in TAGS),
+                'unique_users': self.unique_users(),
+                'top_users': dict((tag, self.top_users(tag, limit)) for tag in TAGS),
+                'tag_types': dict((tag, self.tag_types(tag, limit)) for tag in TAGS)}
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.save()
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the statistics of a database loaded by data.py --sqlite')
+    parser.add_argument('db', help='SQLite database loaded with data.py --sqlite DB')
+    parser.add_argument('--top', type=int, default=TOP, help='length of the top users and tag type lists')
+    parser.add_argument('--direct', action='store_true',
+                        help='query the loaded tables (through covering indexes) instead of the summary tables')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='neither read nor save the result cache file')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the summary tables from the loaded tables first')
+    args = parser.parse_args()
+
+    start = timer()
+    if args.rebuild:
+        conn = sqlite3.connect(args.db, isolation_level=None)
+        conn.execute('BEGIN IMMEDIATE')
+        build_summaries(conn)
+        conn.execute('COMMIT')
+        conn.close()
+    analytics = Analytics(args.db, direct=args.direct, cache=args.cache)
+    try:
+        report = analytics.report(args.top)
+        report['query_seconds'] = analytics.timings
+    finally:
+        analytics.close()
+    report['seconds'] = round(timer() - start, 4)
+    pprint.pprint(report)
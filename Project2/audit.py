@@ -9,53 +9,36 @@ Your task in this exercise has two steps:
     The function takes a string with street name as an argument and should return the fixed name
     We have provided a simple test so that you see what exactly is expected
 """
-import xml.etree.cElementTree as ET
-from collections import defaultdict
-import re
 import pprint
+import osm_reader
+import street_rules
 
 #input file here
 OSMFILE = "new-orleans_louisiana.osm"
 
-#regex key definitions
-street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
-ave_re = re.compile(r'\bAv', re.IGNORECASE)
-rd_re = re.compile(r'\bRd', re.IGNORECASE)
+#regex key definitions, shared with data.py in street_rules.py
+street_type_re = street_rules.street_type_re
 
 #Lisy of expected street names in the dataset
-expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
-            "Trail", "Parkway", "Commons", "Bayou", "Circle", "Bend", "Highway", "Point", "Way", 
-            "Hollow", "Trace", "Run", "Loop", "Knee", "Ridge", "Park", "Hill", "Cove", "Alley"]
+expected = street_rules.EXPECTED
 
 #Mapping dict to keep track of abbreiations that can be replaced
-mapping = { "St": "Street",
-            "St.": "Street"
-            }
-
-#this function uses iterparse to fetch all of the elements in the dataset
-#Uses code that ensures the elements are not stored in memory
-#Reference: https://discussions.udacity.com/t/lingering-questions-as-i-head-into-sql-portion-of-p3/237251/27
-def get_element(osm_file, tags=('node', 'way')):
+#the mappings for the unexpected street types are learned from the audit, see learn_mapping
+mapping = dict(street_rules.DEFAULT_MAPPING)
+
+#this function fetches all of the elements in the dataset with the shared reader in osm_reader.py
+#backend picks the XML parser used to do it
+def get_element(osm_file, tags=('node', 'way'), backend=osm_reader.DEFAULT_BACKEND):
     """Yield element if it is the right type of tag"""
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    return osm_reader.get_element(osm_file, tags, backend)
 
 #this function checks to see if the street type is in the expected set()
-#In not, and the street types matches one of our regex keys, we add it to the mapping dict for cleaning later
-def audit_street_type(street_types, street_name):
-    m = street_type_re.search(street_name)
-    if m:
-        street_type = m.group()
-        if street_type not in expected:
-            street_types[street_type].add(street_name)
-            if ave_re.search(street_type):
-                mapping[street_type] = 'Avenue'
-            elif rd_re.search(street_type):
-                mapping[street_type] = 'Road'
+#In not, it is added to street_types with the street name, learn_mapping proposes its full type
+audit_street_type = street_rules.audit_street_type
+
+#returns mapping plus the full street types our regex keys propose for the audited street types
+def learn_mapping(street_types):
+    return street_rules.learn(street_types, street_rules.StreetRules(mapping, expected)).mapping
 
 
 #this function will return True if the element passed to it is a street
@@ -64,21 +47,20 @@ def is_street_name(elem):
 
 #this function will return True if the element passed to it is a postal code
 def is_postal_code(elem):
-    ispostal = (elem.attrib['k'] == "addr:street")
+    ispostal = (elem.attrib['k'] == "addr:postcode")
     return ispostal
+
+#this function records postal codes that are not a plain 5 digit zip code and how often they occur
+def audit_post_code(post_codes, postal_code):
+    if not (postal_code.isdigit() and len(postal_code) == 5):
+        post_codes[postal_code] += 1
+
 #main function used to control the auditing process
-def audit(osmfile):
-    osm_file = open(osmfile, "r")
-    street_types = defaultdict(set)
-    #iterate through the elements and check to see if they are street names
-    for elem in get_element(osm_file):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                #If the tag is a street name pass it to our auditing function
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
-    return street_types
+#the street type audit runs as a collector of the single pass audit in audit_engine.py
+def audit(osmfile, backend=osm_reader.DEFAULT_BACKEND):
+    import audit_engine  # imported here because audit_engine imports this module
+    report = audit_engine.run_audit(osmfile, [audit_engine.StreetTypeCollector()], backend)
+    return report['street_types']
 
 #function used to update abbreviations 
 def update_name(name, mapping):
@@ -92,6 +74,6 @@ def update_name(name, mapping):
 if __name__ == '__main__':
     st_types = audit(OSMFILE)
     pprint.pprint(dict(st_types))
-    pprint.pprint(dict(mapping))
+    pprint.pprint(learn_mapping(st_types))
     
 
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Single pass audit of an OSM file.
+
+audit.py, tags.py and users.py were written as separate lesson exercises, so auditing a map
+used to mean parsing the whole file once per script.  This module runs all of those checks
+as collectors over one iterparse pass and returns a combined report:
+
+- "street_types": unexpected street types and the street names they were found in
+                  (audit.audit_street_type), and "mapping" the street rules learned from them
+- "key_types":    tag "k" values counted by category (tags.key_type)
+- "users":        unique uids and user names (users.process_map)
+- "post_codes":   postal codes that are not a plain 5 digit zip (audit.audit_post_code)
+
+A collector is any object with a name, an element() and a tag() hook and a report() method.
+element() is called once per top level node/way/relation and tag() once per secondary tag,
+so the tags of each element are only walked once no matter how many collectors are running.
+
+With --save-rules PATH the learned street rules are saved for data.py --street-rules PATH, and
+--rules PATH starts from an earlier (possibly hand edited) rules file instead of the defaults
+(see street_rules.py).
+
+Usage:
+    python audit_engine.py map.osm --save-rules street_rules.json
+"""
+import argparse
+import pprint
+from collections import defaultdict
+
+import audit
+import osm_reader
+import street_rules
+import tags
+
+
+class Collector(object):
+    """Base class for audit collectors, every hook is a no-op by default"""
+    name = None
+
+    def element(self, element):
+        pass
+
+    def tag(self, element, k, v):
+        pass
+
+    def report(self):
+        return None
+
+
+class StreetTypeCollector(Collector):
+    """Unexpected street types found in node and way "addr:street" tags"""
+    name = 'street_types'
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def tag(self, element, k, v):
+        if k == 'addr:street' and element.tag != 'relation':
+            audit.audit_street_type(self.street_types, v)
+
+    def report(self):
+        return dict(self.street_types)
+
+
+class KeyTypeCollector(Collector):
+    """Counts of tag "k" values by category: lower, lower_colon, problemchars and other"""
+    name = 'key_types'
+
+    def __init__(self):
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+
+    def tag(self, element, k, v):
+        if tags.lower.search(k):
+            self.keys['lower'] += 1
+        elif tags.lower_colon.search(k):
+            self.keys['lower_colon'] += 1
+        elif tags.problemchars.search(k):
+            self.keys['problemchars'] += 1
+        else:
+            self.keys['other'] += 1
+
+    def report(self):
+        return self.keys
+
+
+class UserCollector(Collector):
+    """Unique uids and user names across nodes, ways and relations"""
+    name = 'users'
+
+    def __init__(self):
+        self.uids = set()
+        self.users = set()
+
+    def element(self, element):
+        self.uids.add(element.get('uid'))
+        self.users.add(element.get('user'))
+
+    def report(self):
+        return {'users': self.users,
+                'unique_uids': len(self.uids),
+                'unique_users': len(self.users)}
+
+
+class PostCodeCollector(Collector):
+    """Postal codes that are not a plain 5 digit zip code, with how often each was seen"""
+    name = 'post_codes'
+
+    def __init__(self):
+        self.post_codes = defaultdict(int)
+
+    def tag(self, element, k, v):
+        if k == 'addr:postcode':
+            audit.audit_post_code(self.post_codes, v)
+
+    def report(self):
+        return dict(self.post_codes)
+
+
+#collectors run by run_audit when none are passed in
+DEFAULT_COLLECTORS = (StreetTypeCollector, KeyTypeCollector, UserCollector, PostCodeCollector)
+
+
+def run_audit(osm_file, collectors=None, backend=osm_reader.DEFAULT_BACKEND, rules=None):
+    """Run every collector over a single pass of osm_file and return {collector.name: report}
+
+    backend picks the XML parser, see osm_reader.py.  If the street types were collected,
+    report["rules"] is a street_rules.StreetRules learned from them on top of rules (the
+    default street rules if None) and report["mapping"] is its mapping.
+    """
+    if collectors is None:
+        collectors = [collector() for collector in DEFAULT_COLLECTORS]
+    tag_hooks = [collector.tag for collector in collectors]
+    element_hooks = [collector.element for collector in collectors]
+
+    for element in audit.get_element(osm_file, tags=('node', 'way', 'relation'), backend=backend):
+        for hook in element_hooks:
+            hook(element)
+        for tag in element.iter('tag'):
+            k = tag.get('k')
+            v = tag.get('v')
+            for hook in tag_hooks:
+                hook(element, k, v)
+
+    report = {}
+    for collector in collectors:
+        report[collector.name] = collector.report()
+    learned = street_rules.learn(report.get('street_types') or {}, rules)
+    report['rules'] = learned
+    report['mapping'] = dict(learned.mapping)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Audit street types, tag keys, users and postcodes in one pass')
+    parser.add_argument('osm_file', nargs='?', default=audit.OSMFILE, help='input .osm or .osm.pbf file')
+    parser.add_argument('--backend', choices=osm_reader.BACKENDS, default=osm_reader.DEFAULT_BACKEND,
+                        help='XML parser backend')
+    parser.add_argument('--rules', metavar='PATH', dest='rules_path',
+                        help='learn on top of the street rules in this file instead of the defaults')
+    parser.add_argument('--save-rules', metavar='PATH', dest='save_rules_path',
+                        help='save the learned street rules to this file, for data.py --street-rules')
+    args = parser.parse_args()
+    report = run_audit(args.osm_file, backend=args.backend,
+                       rules=street_rules.load(args.rules_path) if args.rules_path else None)
+    if args.save_rules_path:
+        street_rules.save(report['rules'], args.save_rules_path)
+    del report['rules']
+    pprint.pprint(report)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the whole data.py pipeline, stage by stage, on a synthetic or given OSM file.
+
+bench_reader.py and bench_shaper.py time one step each on their own.  This benchmark runs
+parse -> shape -> validate -> write like data.write_elements and splits the time into:
+
+- parse:    waiting for the next element from osm_reader.get_element
+- shape:    data.shape_rows, without the cleaning
+- clean:    the street name and postcode cleaners called by shape_rows
+- validate: data.validate_element
+- write:    data.CsvOutput.write into a temporary directory
+
+Relation members are shaped, cleaned and validated while CsvOutput streams them, so apart
+from their cleaning that time counts as write.  The input is written by osm_generator.py
+from the generator options unless an existing file is given with --input.  The results
+(settings, element counts, seconds per stage, elements/sec and peak RSS) are written to a
+JSON file, and --compare prints the change against an earlier result file.
+
+Usage:
+    python bench_pipeline.py --nodes 200000 --ways 40000 --json bench.json
+    python bench_pipeline.py --input map.osm --json bench.json --compare old_bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer as timer
+
+import compat
+import data
+import osm_generator
+
+STAGES = ('parse', 'shape', 'clean', 'validate', 'write')
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in KB, or None where it is not available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class StageTimes(object):
+    """Seconds spent per stage, with the cleaners wrapped so their time can be told apart"""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.wrapped = []
+
+    def timed_cleaner(self, cleaner):
+        seconds = self.seconds
+
+        def timed(value):
+            start = timer()
+            try:
+                return cleaner(value)
+            finally:
+                seconds['clean'] += timer() - start
+        return timed
+
+    def wrap_cleaners(self):
+        #WAY_TAG_CLEANERS and RELATION_TAG_CLEANERS are the same dict, wrap it once
+        for cleaners in (data.NODE_TAG_CLEANERS, data.WAY_TAG_CLEANERS, data.RELATION_TAG_CLEANERS):
+            if any(cleaners is wrapped for wrapped, original in self.wrapped):
+                continue
+            self.wrapped.append((cleaners, dict(cleaners)))
+            for k, cleaner in cleaners.items():
+                cleaners[k] = self.timed_cleaner(cleaner)
+
+    def restore_cleaners(self):
+        for cleaners, original in self.wrapped:
+            cleaners.update(original)
+        self.wrapped = []
+
+    def add(self, stage, start, clean_start):
+        """Add the time since start to stage, less the cleaning done in the meantime"""
+        seconds = self.seconds
+        seconds[stage] += timer() - start - (seconds['clean'] - clean_start)
+
+
+def run_pipeline(osm_file, out_dir, validate=True, use_cerberus=False, backend=data.osm_reader.DEFAULT_BACKEND):
+    """Run the serial pipeline of data.py over osm_file, writing the csv(s) to out_dir
+
+    Returns (element counts by tag, StageTimes).
+    """
+    times = StageTimes()
+    seconds = times.seconds
+    counts = {'node': 0, 'way': 0, 'relation': 0}
+    validator = data.make_validator(use_cerberus)
+    output = data.CsvOutput([os.path.join(out_dir, path) for path in data.CSV_PATHS])
+    elements = iter(data.get_element(osm_file, tags=('node', 'way', 'relation'), backend=backend,
+                                     stream=('relation',)))
+    times.wrap_cleaners()
+    try:
+        while True:
+            start = timer()
+            element = next(elements, None)
+            seconds['parse'] += timer() - start
+            if element is None:
+                break
+
+            start, clean_start = timer(), seconds['clean']
+            el = data.shape_rows(element)
+            times.add('shape', start, clean_start)
+            if not el:
+                continue
+            counts[element.tag] += 1
+
+            if validate:
+                start = timer()
+                if element.tag == 'relation':
+                    data.validate_element({'relation': el['relation']}, validator)
+                    el['relation_members'] = data.validate_members(el['relation_members'], el['relation_tags'],
+                                                                   validator, use_cerberus)
+                else:
+                    data.validate_element(data.rows_as_dicts(el) if use_cerberus else el, validator)
+                seconds['validate'] += timer() - start
+
+            start, clean_start = timer(), seconds['clean']
+            output.write(element.tag, el)
+            times.add('write', start, clean_start)
+    finally:
+        times.restore_cleaners()
+        output.close()
+    return counts, times
+
+
+def benchmark(osm_file, validate=True, use_cerberus=False, backend=data.osm_reader.DEFAULT_BACKEND):
+    """Return the result dict of one pipeline run over osm_file"""
+    out_dir = tempfile.mkdtemp(prefix='osm_bench_')
+    try:
+        start = timer()
+        counts, times = run_pipeline(osm_file, out_dir, validate, use_cerberus, backend)
+        total = timer() - start
+        output_bytes = sum(os.path.getsize(os.path.join(out_dir, path)) for path in data.CSV_PATHS)
+    finally:
+        shutil.rmtree(out_dir)
+
+    elements = sum(counts.values())
+    return {'input': osm_file,
+            'input_bytes': os.path.getsize(osm_file),
+            'output_bytes': output_bytes,
+            'elements': counts,
+            'seconds': dict((stage, round(value, 4)) for stage, value in times.seconds.items()),
+            'total_seconds': round(total, 4),
+            'elements_per_sec': round(elements / total, 1) if total else None,
+            'peak_rss_kb': peak_rss_kb(),
+            'validate': validate,
+            'use_cerberus': use_cerberus,
+            'backend': backend,
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+#prints the change of each stage, the total and the elements/sec against an earlier result
+def compare(result, old):
+    rows = [(stage, old['seconds'].get(stage), result['seconds'][stage]) for stage in STAGES]
+    rows.append(('total', old.get('total_seconds'), result['total_seconds']))
+    for name, before, after in rows:
+        change = '{0:+7.1f}%'.format(100.0 * (after - before) / before) if before else '      -'
+        print('{0:9s} {1:>10} {2:10.3f}s {3}'.format(name, '{0:.3f}s'.format(before) if before else '-', after,
+                                                     change))
+    print('elements/sec {0} -> {1}'.format(old.get('elements_per_sec'), result['elements_per_sec']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the parse/shape/clean/validate/write stages of data.py')
+    parser.add_argument('--input', metavar='OSM_FILE', help='benchmark this file instead of a synthetic one')
+    parser.add_argument('--json', metavar='PATH', default='bench_pipeline.json', help='file to write the results to')
+    parser.add_argument('--compare', metavar='PATH', help='earlier results file to compare with')
+    parser.add_argument('--no-validate', dest='validate', action='store_false')
+    parser.add_argument('--cerberus', dest='use_cerberus', action='store_true')
+    parser.add_argument('--backend', choices=data.osm_reader.BACKENDS, default=data.osm_reader.DEFAULT_BACKEND)
+    generator = parser.add_argument_group('synthetic input (see osm_generator.py)')
+    generator.add_argument('--nodes', type=int, default=100000)
+    generator.add_argument('--ways', type=int, default=20000)
+    generator.add_argument('--relations', type=int, default=100)
+    generator.add_argument('--node-tags', type=float, default=0.5)
+    generator.add_argument('--way-tags', type=float, default=2.0)
+    generator.add_argument('--key-weight', type=osm_generator.parse_weight, action='append', default=[],
+                           metavar='KEY=WEIGHT')
+    generator.add_argument('--messy-streets', type=int, default=1000)
+    generator.add_argument('--messy-postcodes', type=int, default=1000)
+    generator.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.input:
+        osm_file, settings = args.input, None
+    else:
+        weights = dict(osm_generator.KEY_WEIGHTS)
+        weights.update(args.key_weight)
+        weights = dict((key, weight) for key, weight in weights.items() if weight > 0)
+        settings = {'nodes': args.nodes, 'ways': args.ways, 'relations': args.relations,
+                    'node_tags': args.node_tags, 'way_tags': args.way_tags, 'key_weights': weights,
+                    'messy_streets': args.messy_streets, 'messy_postcodes': args.messy_postcodes,
+                    'seed': args.seed}
+        tmp_dir = tempfile.mkdtemp(prefix='osm_bench_input_')
+        osm_file = os.path.join(tmp_dir, 'synthetic.osm')
+        with compat.open_text_output(osm_file) as out:
+            osm_generator.generate(out, **settings)
+    try:
+        result = benchmark(osm_file, args.validate, args.use_cerberus, args.backend)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+    result['generator'] = settings
+    if settings:
+        result['input'] = None
+
+    with open(args.json, 'w') as out:
+        json.dump(result, out, indent=2, sort_keys=True)
+    for stage in STAGES:
+        print('{0:9s} {1:10.3f}s'.format(stage, result['seconds'][stage]))
+    print('total     {0:10.3f}s {1:10.0f} elements/sec, peak RSS {2} KB'.format(
+        result['total_seconds'], result['elements_per_sec'], result['peak_rss_kb']))
+    if args.compare:
+        with open(args.compare) as old_file:
+            compare(result, json.load(old_file))
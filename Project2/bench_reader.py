@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the osm_reader.py parser backends.
+
+Each available backend reads the whole file once, touching every child of every top level
+element the way the shapers do, and the elements/sec are reported.  Backends whose optional
+package is not installed are reported as skipped.  A .osm.pbf file is read with the pbf backend.
+
+Usage:
+    python bench_reader.py map.osm [backend ...]
+"""
+import sys
+import time
+
+import osm_reader
+
+
+def time_backend(osm_file, backend, tags=('node', 'way', 'relation')):
+    """Return (elements, seconds) for one full read of osm_file with backend"""
+    count = 0
+    start = time.time()
+    for element in osm_reader.get_element(osm_file, tags, backend):
+        for child in element:
+            child.attrib
+        count += 1
+    return count, time.time() - start
+
+
+def main(osm_file, backends=None):
+    if not backends:
+        backends = ('pbf',) if osm_reader.is_pbf(osm_file) else [b for b in osm_reader.BACKENDS if b != 'pbf']
+    for backend in backends:
+        try:
+            count, elapsed = time_backend(osm_file, backend)
+        except ImportError as e:
+            print('{0:6s} skipped: {1}'.format(backend, e))
+            continue
+        print('{0:6s} {1:10d} elements {2:8.3f}s {3:10.0f} elements/sec'.format(
+            backend, count, elapsed, count / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    main(sys.argv[1], sys.argv[2:])
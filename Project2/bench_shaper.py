@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of the table driven data.shape_rows against data.shape_element.
+
+A deterministic set of node and way elements (with street names, postcodes, colon keys and
+nd refs) is built in memory, so only the shaping is timed and not the XML parse.  Before
+timing, the output of both shapers is compared table by table to make sure they agree (as
+csv text, shape_rows has int ids).
+
+The memory of the shaped output is measured too: each shaper runs in a fresh process that
+builds the elements, shapes them all and keeps every result, as a writer would while a batch
+is queued.  The container objects (dicts, lists, tuples) allocated per shaped element with
+their sizes, and the growth of the peak RSS, are reported per element and per million
+elements, which shows what the dict rows of shape_element cost against the records and tuple
+rows of shape_rows.
+
+Usage:
+    python bench_shaper.py [elements] [repeat]
+"""
+import multiprocessing
+import random
+import sys
+import time
+
+import bench_pipeline
+import data
+from compat import ET, text_type
+
+SHAPERS = ('shape_element', 'shape_rows')
+
+KEYS = ['amenity', 'name', 'building', 'highway', 'source', 'addr:street', 'addr:postcode',
+        'addr:housenumber', 'addr:street:name', 'tiger:county', 'building:levels']
+STREETS = ['Canal St', 'Magazine St.', 'St Charles Ave', 'Airline Hwy', 'River Rd', 'Esplanade Avenue']
+POSTCODES = ['70112', '70113-1234', 'LA 70119', '70130']
+
+
+#builds count top level elements, 4 nodes for every way, from a fixed seed
+def build_elements(count, seed=0):
+    rand = random.Random(seed)
+    elements = []
+    for i in range(count):
+        if i % 5 == 4:
+            element = ET.Element('way', id=str(i), user='user', uid='1', version='1',
+                                 changeset='2', timestamp='2017-01-01T00:00:00Z')
+            for ref in range(rand.randint(2, 12)):
+                ET.SubElement(element, 'nd', ref=str(rand.randint(1, count)))
+        else:
+            element = ET.Element('node', id=str(i), lat='29.95', lon='-90.07', user='user', uid='1',
+                                 version='1', changeset='2', timestamp='2017-01-01T00:00:00Z')
+        for k in rand.sample(KEYS, rand.randint(0, 4)):
+            if k == 'addr:street':
+                v = rand.choice(STREETS)
+            elif k == 'addr:postcode':
+                v = rand.choice(POSTCODES)
+            else:
+                v = str(rand.randint(0, 100))
+            ET.SubElement(element, 'tag', k=k, v=v)
+        elements.append(element)
+    return elements
+
+
+#the tables of a shaped element as csv text values, so the shapers can be compared
+def as_text(el):
+    return dict((table, [dict((k, text_type(v)) for k, v in row.items()) for row in rows] if isinstance(rows, list)
+                 else dict((k, text_type(v)) for k, v in rows.items()))
+                for table, rows in data.rows_as_dicts(el).items())
+
+
+#times one pass of shape over all of the elements
+def time_shaper(shape, elements, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for element in elements:
+            shape(element)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+#returns the number and total size of the containers a shaped element is made of
+def containers(el):
+    count, size = 1, sys.getsizeof(el)
+    for rows in el.values():
+        count += 1
+        size += sys.getsizeof(rows)
+        if isinstance(rows, list):
+            count += len(rows)
+            size += sum(sys.getsizeof(row) for row in rows)
+    return count, size
+
+
+#run in a fresh process per shaper: shapes count elements, keeping the results, and returns the
+#containers, their bytes and the peak RSS growth in bytes, per element
+def measure_memory(args):
+    name, count = args
+    shape = getattr(data, name)
+    elements = build_elements(count)
+    peak = bench_pipeline.peak_rss_kb()
+    shaped = [shape(element) for element in elements]
+    grown = bench_pipeline.peak_rss_kb() - peak
+    sizes = [containers(el) for el in shaped]
+    return (sum(count for count, size in sizes) / float(count), sum(size for count, size in sizes) / float(count),
+            grown * 1024.0 / count)
+
+
+def main(count=100000, repeat=3):
+    elements = build_elements(count)
+
+    for element in elements:
+        if as_text(data.shape_rows(element)) != as_text(data.shape_element(element)):
+            raise AssertionError('shape_rows and shape_element differ for {0} {1}'.format(
+                element.tag, element.get('id')))
+
+    legacy = time_shaper(data.shape_element, elements, repeat)
+    table_driven = time_shaper(data.shape_rows, elements, repeat)
+    print('{0} elements, best of {1}'.format(count, repeat))
+    print('shape_element: {0:8.3f}s {1:10.0f} elements/sec'.format(legacy, count / legacy))
+    print('shape_rows:    {0:8.3f}s {1:10.0f} elements/sec'.format(table_driven, count / table_driven))
+    print('speedup:       {0:8.2f}x'.format(legacy / table_driven))
+
+    if bench_pipeline.peak_rss_kb() is None:
+        return
+    print('memory of the shaped elements kept:')
+    for name in SHAPERS:
+        pool = multiprocessing.Pool(1)
+        try:
+            objects, size, rss = pool.apply(measure_memory, ((name, count),))
+        finally:
+            pool.close()
+            pool.join()
+        print('{0:14s} {1:5.2f} containers/element of {2:4.0f} bytes, peak RSS {3:5.0f} bytes/element '
+              '({4:6.1f} MB per million elements)'.format(name + ':', objects, size, rss, rss))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the byte/str conversions around the csv files, on Python 2 or 3.
+
+The elements of an OSM file are shaped once with data.shape_rows and all their rows are kept
+in memory, so only the csv formatting, the UTF-8 conversion and the file writes are timed:
+
+- encode: the per value encode alone (compat.encode_value on every value), which is what
+  UnicodeDictWriter did to every row before the csv module saw it
+- per row: each row encoded to UTF-8 before it reaches a binary file, the way the conversion
+  wrote on Python 2 (csv module over the encoded values), and the way a direct port would on
+  Python 3 (each row formatted to str and the line encoded)
+- writer: data.UnicodeDictWriter over data.open_csv, what the conversion does now: on
+  Python 3 the str rows go straight into a text file that encodes a chunk at a time
+- read: the file written by writer read back with csv.reader and compat.decode_row, what
+  sqlite_loader.py and parquet_output.py do with the csv files of --workers shards
+
+Each method runs repeat times and the best time is reported with its rows/sec and the MB/sec
+of the csv text it stands for.  Run it with both interpreters on the same file to compare them.
+
+Usage:
+    python bench_strings.py map.osm [repeat]
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import compat
+import data
+
+METHODS = ('encode', 'per row', 'writer', 'read')
+
+
+#the tables of each element type in the order data.CsvOutput writes them
+TABLES = {'node': ('node', 'node_tags'), 'way': ('way', 'way_nodes', 'way_tags'),
+          'relation': ('relation', 'relation_members', 'relation_tags')}
+
+
+#returns the rows of every table of the elements of osm_file, in file order
+def shaped_rows(osm_file):
+    rows = []
+    for element in data.get_element(osm_file):
+        el = data.shape_rows(element)
+        for table in TABLES[element.tag]:
+            if table == element.tag:
+                rows.append(el[table])
+            else:
+                rows.extend(el[table])
+    return rows
+
+
+def encode_values(rows, path):
+    for row in rows:
+        [compat.encode_value(value) for value in row]
+
+
+def write_per_row(rows, path):
+    with open(path, 'wb', data.WRITE_BUFFER) as out:
+        if compat.PY2:
+            csv.writer(out).writerows(compat.encode_row(row) for row in rows)
+            return
+        line = compat.CsvBuffer()
+        writer = csv.writer(line)
+        for row in rows:
+            writer.writerow(row)
+            out.write(line.getvalue().encode('utf-8'))
+            line.seek(0)
+            line.truncate()
+
+
+def write_text(rows, path):
+    out = data.open_csv(path)
+    data.UnicodeDictWriter(out, []).writetuples(rows)
+    out.close()
+
+
+def read_text(rows, path):
+    with compat.open_text_input(path) as csv_file:
+        for row in csv.reader(csv_file):
+            compat.decode_row(row)
+
+
+RUNS = {'encode': encode_values, 'per row': write_per_row, 'writer': write_text, 'read': read_text}
+
+
+def main(osm_file, repeat=3):
+    start = time.time()
+    rows = shaped_rows(osm_file)
+    print('Python {0}: {1} rows shaped in {2:.3f}s'.format(sys.version.split()[0], len(rows), time.time() - start))
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'rows.csv')
+    try:
+        write_text(rows, path)
+        megabytes = os.path.getsize(path) / 1e6
+        for method in METHODS:
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                RUNS[method](rows, path)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print('{0:8s} {1:8.3f}s {2:10.0f} rows/sec {3:8.1f} MB/sec'.format(
+                method, best, len(rows) / best if best else 0, megabytes / best if best else 0))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 3)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checkpoints and a quarantine file, so a long conversion survives a crash or a bad element.
+
+If data.process_map crashed or was killed partway through a large extract, the csv files were
+left truncated and the run had to start again from zero, and a single element that failed
+validation aborted the whole run.  With data.py --checkpoint-every N:
+
+- every N elements the csv files (and the quarantine file) are flushed and synced, and a JSON
+  checkpoint records their byte positions, the position of the parser in the input, the
+  number of elements done and the type and id of the last one
+- --resume truncates the csv files back to the recorded positions, reads back from the
+  recorded position (past the last element done, because of the parser read-ahead) to the
+  start tag of the last element done, however many members it has, starts parsing there and
+  skips that element, so the files end up identical to an uninterrupted run.  PBF and
+  compressed input cannot be entered mid-file, so they are parsed from the start and skipped
+  the same way.
+- the checkpoint file is removed once the run completes
+
+With --quarantine PATH, elements that fail validation are written to PATH as an OSM XML
+document, each preceded by a comment with the validation error, and the run goes on.  Relation
+members are streamed and validated in batches, so a relation is held back (see HeldRelation)
+until its last batch of members and its tags are valid, and a relation with a bad member is
+quarantined whole, with none of its rows written.
+
+Checkpointed runs are serial and write csv files; the dangling way node check and the way
+geometry keep state that a checkpoint does not capture, so they cannot be combined with it.
+"""
+import json
+import os
+import tempfile
+
+import osm_reader
+from compat import encode_value, pickle
+
+FORMAT_VERSION = 1
+QUARANTINE_HEADER = b'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n'
+QUARANTINE_FOOTER = b'</osm>\n'
+#bytes read at a time while looking back from the recorded input position for the element to
+#resume from
+RESUME_BLOCK = 1 << 20
+
+
+def sync(open_file):
+    open_file.flush()
+    os.fsync(open_file.fileno())
+
+
+def replace_file(path, data):
+    """Write data to path through a temporary file, so a crash never leaves half a checkpoint"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(data)
+        sync(tmp_file)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        #Windows does not rename over an existing file
+        os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def load(path, input_path):
+    """Return the checkpoint saved at path, after checking that it belongs to input_path"""
+    with open(path) as checkpoint_file:
+        state = json.load(checkpoint_file)
+    if state.get('version') != FORMAT_VERSION:
+        raise ValueError('Checkpoint {0} has an unknown format version'.format(path))
+    if state['input_size'] != os.path.getsize(input_path):
+        raise ValueError('Checkpoint {0} was written for a different input than {1}'.format(path, input_path))
+    return state
+
+
+def skip_done(elements, last):
+    """Yield the elements that come after the element with (tag, id) last"""
+    tag, element_id = last
+    for element in elements:
+        if element.tag == tag and element.get('id') == element_id:
+            break
+    else:
+        raise ValueError('The last checkpointed element, {0} {1}, is not in the input'.format(tag, element_id))
+    for element in elements:
+        yield element
+
+
+class Quarantine(object):
+    """OSM XML file of the elements that failed validation, with their errors as comments"""
+
+    def __init__(self, path, position=None):
+        if position is None:
+            self.file = open(path, 'wb')
+            self.file.write(QUARANTINE_HEADER)
+        else:
+            self.file = open(path, 'r+b')
+            self.file.truncate(position)
+            self.file.seek(position)
+        self.count = 0
+
+    def add(self, element, error):
+        message = str(error).strip().replace('--', '- -')
+        self.file.write(b'<!-- ' + encode_value(message) + b' -->\n')
+        if isinstance(element, osm_reader.OsmElement) and not isinstance(element.children, (list, tuple)):
+            #the members of a streamed relation can only be read once, keep its attributes
+            element = osm_reader.OsmElement(element.tag, dict(element.attrib))
+        self.file.write(osm_reader.tostring(element).strip() + b'\n')
+        self.count += 1
+
+    def append(self, path, count):
+        """Add the count elements of the closed quarantine file at path (e.g. of a shard)"""
+        with open(path, 'rb') as other:
+            other.seek(0, os.SEEK_END)
+            remaining = other.tell() - len(QUARANTINE_HEADER) - len(QUARANTINE_FOOTER)
+            other.seek(len(QUARANTINE_HEADER))
+            while remaining > 0:
+                block = other.read(min(remaining, 1 << 20))
+                if not block:
+                    break
+                self.file.write(block)
+                remaining -= len(block)
+        self.count += count
+
+    def position(self):
+        sync(self.file)
+        return self.file.tell()
+
+    def close(self):
+        self.file.write(QUARANTINE_FOOTER)
+        self.file.close()
+
+
+#reads count records back from the start of a spill file of HeldRelation
+def replay(spill_file, count):
+    spill_file.seek(0)
+    for _ in range(count):
+        yield pickle.load(spill_file)
+
+
+class HeldRelation(object):
+    """A streamed relation held back from the output until all of its rows are valid
+
+    The children of the relation are recorded in a temporary file as the shaper walks them,
+    and the validated relation_members rows in another, so a relation with tens of thousands
+    of members is still never in memory.  hold() returns the members to write once the last
+    batch is valid; if a batch is not, raw() rebuilds the whole relation for the Quarantine.
+    """
+
+    def __init__(self, element):
+        self.tag = element.tag
+        self.attrib = dict(element.attrib)
+        self.children_file = tempfile.TemporaryFile()
+        self.children = 0
+        self.rows_file = tempfile.TemporaryFile()
+        self.recorder = self.record(iter(element))
+        #shape this instead of the parsed element
+        self.element = osm_reader.OsmElement(element.tag, element.attrib, self.recorder)
+
+    def record(self, children):
+        for child in children:
+            pickle.dump((child.tag, dict(child.attrib)), self.children_file, pickle.HIGHEST_PROTOCOL)
+            self.children += 1
+            yield child
+
+    def hold(self, members):
+        """Spill the rows of members (from data.validate_members, which raises at the first
+        invalid batch) and return them for the output once they have all been validated"""
+        count = 0
+        for row in members:
+            pickle.dump(row, self.rows_file, pickle.HIGHEST_PROTOCOL)
+            count += 1
+        return replay(self.rows_file, count)
+
+    def raw(self):
+        """Return the relation with all of its children, reading the ones not shaped yet"""
+        for child in self.recorder:
+            pass
+        children = [osm_reader.OsmElement(tag, attrib) for tag, attrib in replay(self.children_file, self.children)]
+        return osm_reader.OsmElement(self.tag, self.attrib, children)
+
+    def close(self):
+        self.children_file.close()
+        self.rows_file.close()
+
+
+class Checkpointer(object):
+    """Saves a checkpoint every `every` elements written by data.write_elements
+
+    source is the open input file, output a data.CsvOutput and quarantine a Quarantine or None.
+    state is the checkpoint being resumed from, if any.
+    """
+
+    def __init__(self, path, every, input_path, source, output, quarantine=None, state=None):
+        self.path = path
+        self.every = every
+        self.input_path = input_path
+        self.input_size = os.path.getsize(input_path)
+        self.source = source
+        self.output = output
+        self.quarantine = quarantine
+        self.elements = state['elements'] if state else 0
+        self.pending = every
+
+    def done(self, tag, element_id):
+        """Count an element that has been written or quarantined"""
+        self.elements += 1
+        self.pending -= 1
+        if not self.pending:
+            self.pending = self.every
+            self.save(tag, element_id)
+
+    def save(self, tag, element_id):
+        state = {'version': FORMAT_VERSION,
+                 'input': self.input_path,
+                 'input_size': self.input_size,
+                 'input_position': self.source.tell(),
+                 'elements': self.elements,
+                 'last': [tag, element_id],
+                 'outputs': self.output.positions(),
+                 'quarantine': self.quarantine.position() if self.quarantine is not None else None}
+        replace_file(self.path, json.dumps(state, indent=2, sort_keys=True))
+
+    def finish(self):
+        """Remove the checkpoint of a completed run"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The differences between Python 2 and 3 that the conversion (data.py), audit (audit.py,
+audit_engine.py) and sampler (osm_sampler.py) scripts depend on, so they run on both.
+
+The one that matters for speed is the csv text.  Python 2's csv module only writes bytes, so
+every unicode value of every row has to be encoded to UTF-8 before it is written.  On Python 3
+the csv module writes str, and the files are text files that encode to UTF-8 themselves, a
+chunk at a time, on their way into a large buffer:
+
+- text_writer(binary_file) wraps a binary file (e.g. a compressed.ThreadedWriter) so csv text
+  can be written to it, and open_text_output(path) opens a plain csv file that way
+- open_text_input(path) opens a csv file for csv.reader, and decode_row() turns a row read
+  from it into unicode (a no-op on Python 3)
+- encode_row() is the per value encode Python 2 needs (a no-op on Python 3)
+
+bench_strings.py measures what those conversions cost on each version.
+"""
+import io
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    #Python 3.9 dropped cElementTree, ElementTree uses the C accelerator by itself
+    import xml.etree.ElementTree as ET
+
+if PY2:
+    text_type = unicode
+    string_types = basestring
+    integer_types = (int, long)
+    import cPickle as pickle
+    from cStringIO import StringIO as CsvBuffer
+    from Queue import Empty, Full, Queue
+else:
+    text_type = str
+    string_types = str
+    integer_types = (int,)
+    import pickle
+    from io import StringIO as CsvBuffer
+    from queue import Empty, Full, Queue
+
+#bytes buffered per text file
+TEXT_BUFFER = 1 << 20
+
+
+def encode_value(value):
+    return value.encode('utf-8') if isinstance(value, text_type) else value
+
+
+if PY2:
+    def encode_row(row):
+        """Return row with its unicode values encoded to UTF-8, for the csv module"""
+        return [value.encode('utf-8') if isinstance(value, unicode) else value for value in row]
+
+    def decode_row(row):
+        """Return a row read by csv.reader with its values decoded from UTF-8"""
+        return [value.decode('utf-8') for value in row]
+
+    def text_writer(binary_file, chunk_size=TEXT_BUFFER):
+        return binary_file
+
+    def open_text_output(path, buffering=TEXT_BUFFER):
+        return open(path, 'wb', buffering)
+
+    def open_text_input(path):
+        return open(path, 'rb')
+
+else:
+    def encode_row(row):
+        return row
+
+    def decode_row(row):
+        return row
+
+    def text_writer(binary_file, chunk_size=TEXT_BUFFER):
+        """Wrap binary_file so UTF-8 csv text can be written to it, chunk_size characters at a time"""
+        text_file = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+        text_file._CHUNK_SIZE = chunk_size
+        return text_file
+
+    def open_text_output(path, buffering=TEXT_BUFFER):
+        return text_writer(open(path, 'wb', buffering), buffering)
+
+    def open_text_input(path):
+        return open(path, 'r', encoding='utf-8', newline='')
+
+
+def binary_of(text_file):
+    """Return the binary file under a file made by text_writer, flushed so bytes can be added"""
+    text_file.flush()
+    return getattr(text_file, 'buffer', text_file)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Transparent gzip, bzip2 and zstandard streams, (de)compressed in a background thread.
+
+Extracts are usually published as .osm.bz2, which had to be unpacked before the scripts
+could read them, and the csv files are several times the size they would be compressed.
+The compression is picked by file extension (.gz, .bz2 or .zst):
+
+- open_input(path) returns a file-like object whose read() hands out data that a background
+  thread has already decompressed, CHUNK_SIZE bytes of input at a time, at most QUEUE_CHUNKS
+  chunks ahead of the parser.  bz2, zlib and zstandard release the GIL while they work, so
+  bzip2 decoding overlaps with the parsing instead of stalling it.  Files made of several
+  concatenated streams (pbzip2, cat a.gz b.gz) are read to the end.
+- open_output(path, level) returns a file-like object that collects writes into CHUNK_SIZE
+  blocks and compresses and writes them in a background thread, at the given level.
+
+Plain paths are opened as ordinary files.  zstandard needs the optional zstandard package
+(pip install zstandard).  The streams cannot seek, so sharding (data.py --workers) and
+checkpoints need an uncompressed input and csv files respectively.
+"""
+import bz2
+import os
+import threading
+import zlib
+
+from compat import Empty, Full, Queue, string_types
+
+COMPRESSIONS = ('gz', 'bz2', 'zst')
+EXTENSIONS = {'.gz': 'gz', '.gzip': 'gz', '.bz2': 'bz2', '.zst': 'zst'}
+DEFAULT_LEVELS = {'gz': 6, 'bz2': 9, 'zst': 3}
+#bytes read or written per (de)compression step
+CHUNK_SIZE = 1 << 20
+#chunks the background thread may be ahead of the reader or behind the writer
+QUEUE_CHUNKS = 8
+#seconds between checks for a closed stream while the queue is full
+POLL_SECONDS = 0.1
+
+
+def compression_of(path):
+    """Return the compression of path from its extension, or None for a plain file"""
+    if not isinstance(path, string_types):
+        return None
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('.zst files need the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+def make_decompressor(kind):
+    if kind == 'gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if kind == 'bz2':
+        return bz2.BZ2Decompressor()
+    return import_zstandard().ZstdDecompressor().decompressobj()
+
+
+def make_compressor(kind, level=None):
+    if level is None:
+        level = DEFAULT_LEVELS[kind]
+    if kind == 'gz':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if kind == 'bz2':
+        return bz2.BZ2Compressor(level)
+    return import_zstandard().ZstdCompressor(level=level).compressobj()
+
+
+def decompress_stream(raw, kind, chunk_size=CHUNK_SIZE):
+    """Yield the decompressed data of the open file raw, across concatenated streams"""
+    decompressor = make_decompressor(kind)
+    while True:
+        data = raw.read(chunk_size)
+        if not data:
+            return
+        while data:
+            try:
+                out = decompressor.decompress(data)
+            except EOFError:
+                #bz2 after the end of a stream that ended exactly at a chunk boundary
+                decompressor = make_decompressor(kind)
+                continue
+            data = getattr(decompressor, 'unused_data', b'')
+            if data:
+                decompressor = make_decompressor(kind)
+            if out:
+                yield out
+
+
+class ThreadedReader(object):
+    """Read-only file-like object over a compressed file, decompressed by a background thread"""
+
+    def __init__(self, path, kind, chunk_size=CHUNK_SIZE, queue_chunks=QUEUE_CHUNKS):
+        self.raw = open(path, 'rb')
+        self.kind = kind
+        self.chunk_size = chunk_size
+        self.queue = Queue(queue_chunks)
+        self.buffer = b''
+        self.offset = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=POLL_SECONDS)
+                return
+            except Full:
+                pass
+
+    def run(self):
+        try:
+            for out in decompress_stream(self.raw, self.kind, self.chunk_size):
+                if self.closed:
+                    return
+                self.put(out)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.put(None)
+
+    def read(self, size=-1):
+        chunks = []
+        wanted = size
+        while wanted != 0 and not self.done:
+            if self.offset >= len(self.buffer):
+                item = self.queue.get()
+                if item is None:
+                    self.done = True
+                    if self.error is not None:
+                        raise self.error
+                    break
+                self.buffer, self.offset = item, 0
+            end = len(self.buffer) if wanted < 0 else min(len(self.buffer), self.offset + wanted)
+            chunks.append(self.buffer[self.offset:end])
+            if wanted > 0:
+                wanted -= end - self.offset
+            self.offset = end
+        return b''.join(chunks)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        """Return the bytes of the compressed file read so far, including the read-ahead"""
+        return self.raw.tell() if not self.raw.closed else os.path.getsize(self.raw.name)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        #unblock the thread if it is waiting on a full queue
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+        self.thread.join()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ThreadedWriter(object):
+    """Write-only file-like object that compresses to path in a background thread"""
+
+    def __init__(self, path, kind, level=None, chunk_size=CHUNK_SIZE, queue_chunks=QUEUE_CHUNKS):
+        self.raw = open(path, 'wb')
+        self.name = path
+        self.compressor = make_compressor(kind, level)
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.pending_size = 0
+        self.written = 0
+        self.queue = Queue(queue_chunks)
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    self.raw.write(self.compressor.flush())
+                    return
+                if self.error is None:
+                    self.raw.write(self.compressor.compress(data))
+        except Exception as e:
+            self.error = e
+            #keep taking data so write() never blocks, close() reports the error
+            while self.queue.get() is not None:
+                pass
+        finally:
+            self.raw.close()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.pending.append(data)
+        self.pending_size += len(data)
+        self.written += len(data)
+        if self.pending_size >= self.chunk_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        """Hand the pending writes to the compressing thread"""
+        if self.pending:
+            self.queue.put(b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def tell(self):
+        """Return the uncompressed bytes written so far"""
+        return self.written
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_input(path):
+    """Open path for reading, decompressing it in a background thread if it is compressed"""
+    kind = compression_of(path)
+    return ThreadedReader(path, kind) if kind else open(path, 'rb')
+
+
+def open_output(path, level=None):
+    """Open path for writing, compressing it in a background thread if it has a compressed extension"""
+    kind = compression_of(path)
+    return ThreadedWriter(path, kind, level) if kind else open(path, 'wb')
@@ -154,14 +154,34 @@ The final return value for a "way" element should look something like:
                'value': '366409'}]}
 """
 
+import argparse
 import csv
-import codecs
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
 import pprint
 import re
-import xml.etree.cElementTree as ET
-from collections import defaultdict
-import cerberus
+import shutil
+import tempfile
+from collections import defaultdict, namedtuple
+from timeit import default_timer as timer
+import checkpoint
+import compat
+import compressed
+import fast_validator
+import geometry
+import metrics
+import normcache
+import osm_reader
+import pbf_reader
+import refcheck
 import schema
+import street_rules
+import tagstats
+
+log = logging.getLogger(__name__)
 
 #Input File Here
 OSM_PATH = "D:\\UdacityDAND\\Project2\\MapsDatabase\\new-orleans_louisiana_sample.osm"
@@ -172,10 +192,19 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
+
+#Output files in the order process_map opens them
+CSV_PATHS = (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH,
+             RELATIONS_PATH, RELATION_MEMBERS_PATH, RELATION_TAGS_PATH)
 
 #regex keys definitions here
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+#regex key for the start of a top level element, used to split the input into shards
+ELEMENT_START = re.compile(br'<(?:node|way|relation)[\s/>]')
 
 #import schema definitions from provided file schema.py
 SCHEMA = schema.schema
@@ -186,58 +215,73 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
-
-#define regex keys for different street type abbreviations here
-street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
-ave_re = re.compile(r'\bAv', re.IGNORECASE)
-rd_re = re.compile(r'\bRd', re.IGNORECASE)
-st_re = re.compile(r'\bSt', re.IGNORECASE)
-lp_re = re.compile(r'\bLp', re.IGNORECASE)
-blvd_re = re.compile(r'\bBlvd', re.IGNORECASE)
-hwy_re = re.compile(r'\bHwy', re.IGNORECASE)
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'member_id', 'type', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+#column order of each table of a shaped element
+TABLE_FIELDS = {'node': NODE_FIELDS, 'node_tags': NODE_TAGS_FIELDS, 'way': WAY_FIELDS,
+                'way_nodes': WAY_NODES_FIELDS, 'way_tags': WAY_TAGS_FIELDS, 'relation': RELATION_FIELDS,
+                'relation_members': RELATION_MEMBERS_FIELDS, 'relation_tags': RELATION_TAGS_FIELDS}
+#column order of each csv in CSV_PATHS
+CSV_FIELDS = (NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS,
+              RELATION_FIELDS, RELATION_MEMBERS_FIELDS, RELATION_TAGS_FIELDS)
+#positional records of the tables, in their column order.  shape_rows makes the node, way and
+#relation rows records and keeps the tag, way node and member rows plain tuples of the same
+#layout (RECORDS[table]._make(row) gives them field names)
+NodeRecord = namedtuple('NodeRecord', NODE_FIELDS)
+WayRecord = namedtuple('WayRecord', WAY_FIELDS)
+RelationRecord = namedtuple('RelationRecord', RELATION_FIELDS)
+RECORDS = {'node': NodeRecord, 'node_tags': namedtuple('NodeTagRecord', NODE_TAGS_FIELDS),
+           'way': WayRecord, 'way_nodes': namedtuple('WayNodeRecord', WAY_NODES_FIELDS),
+           'way_tags': namedtuple('WayTagRecord', WAY_TAGS_FIELDS), 'relation': RelationRecord,
+           'relation_members': namedtuple('RelationMemberRecord', RELATION_MEMBERS_FIELDS),
+           'relation_tags': namedtuple('RelationTagRecord', RELATION_TAGS_FIELDS)}
+#relation members are validated in batches of this many rows as they are written
+MEMBER_BATCH = 1000
+#bytes buffered per output csv file, a line buffered file would flush every line
+WRITE_BUFFER = 1 << 20
 
 #define regex key for numeric character cheks
 non_decimal = re.compile(r'[^\d]+')
 
-expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
-            "Trail", "Parkway", "Commons", "Bayou", "Circle", "Bend", "Highway", "Point", "Way", 
-            "Hollow", "Trace", "Run", "Loop", "Knee", "Ridge", "Park", "Hill", "Cove", "Alley"]
+#the street type rules are shared with audit.py, see street_rules.py
+expected = street_rules.EXPECTED
 
 # Mapping dict to keep track of abbreviations to clean
-mapping = { "St": "Street",
-            "St.": "Street" }
+mapping = dict(street_rules.DEFAULT_MAPPING)
 
 #keeps track of postal codes that we change
 postcode_changes = {}
-#this function checks to see if the street type is in the expected set()
-#In not, and the street types matches one of our regex keys, we add it to the mapping dict for cleaning later
-def audit_street_type(street_types, street_name):
-    m = street_type_re.search(street_name)
-    if m:
-        street_type = m.group()
-        if street_type not in expected:
-            street_types[street_type].add(street_name)
-            if ave_re.search(street_type):
-                mapping[street_type] = 'Avenue'
-            elif rd_re.search(street_type):
-                mapping[street_type] = 'Road'
-            elif st_re.search(street_type):
-                mapping[street_type] = 'Street'
-            elif lp_re.search(street_type):
-                mapping[street_type] = 'Loop'
-            elif blvd_re.search(street_type):
-                mapping[street_type] = 'Boulevard'
-            elif hwy_re.search(street_type):
-                mapping[street_type] = 'Highway'
+
+#the frozen street rules the street name cleaner applies, see use_street_rules
+street_rules_in_use = street_rules.PASSTHROUGH
+
+#the signature of the street rules and the postcode cleaning, see normcache.py
+def cleaning_signature(rules):
+    return hashlib.md5(repr((rules.signature, non_decimal.pattern)).encode('utf-8')).hexdigest()
+
+#cleaned street names and postcodes by raw value, see normcache.py
+#the signature makes a saved cache invalid once the cleaning rules are changed
+normalization_cache = normcache.NormalizationCache(signature=cleaning_signature(street_rules_in_use))
+
+#makes the street name cleaner apply rules (a street_rules.StreetRules, e.g. loaded from the file
+#saved by audit_engine.py --save-rules), before any element is shaped
+def use_street_rules(rules):
+    global street_rules_in_use
+    street_rules_in_use = rules
+    normalization_cache.signature = cleaning_signature(rules)
+
+#records unexpected street types, shared with audit.py
+audit_street_type = street_rules.audit_street_type
 
 """this function checks to see if the postal code is all numeric digits and > len=5
 if not, it will remove the non numeric characters"""
 def audit_post_code(postal_code,postcode_changes):
-    print postal_code
+    log.debug('postcode %s', postal_code)
     if not postal_code.isdigit() and len(postal_code) > 5:
         new_postal = non_decimal.sub('',postal_code)
         postcode_changes[postal_code] = new_postal
-        print postcode_changes
+        log.debug('postcode %s changed to %s', postal_code, new_postal)
         return new_postal
     else:
         return postal_code
@@ -298,7 +342,7 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                     # if the tag has a colon, handle the multiple components to accurately represent key and type
                     elif len(split_tag) > 1 and is_street_name(tag):
                         keyiter = iter(split_tag)
-                        keyiter.next()
+                        next(keyiter)
                         key = ''
                         for item in keyiter:
                             key += item + ":"
@@ -316,7 +360,7 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                     #here we check if the type is postal_code and audit accordingly
                     elif len(split_tag) > 1 and is_postal_code(tag):
                         keyiter = iter(split_tag)
-                        keyiter.next()
+                        next(keyiter)
                         key = ''
                         for item in keyiter:
                             key += item + ":"
@@ -334,7 +378,7 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                     #here we know type is not street
                     elif len(split_tag) > 1: 
                         keyiter = iter(split_tag)
-                        keyiter.next()
+                        next(keyiter)
                         key = ''
                         for item in keyiter:
                             key += item + ":"
@@ -363,7 +407,7 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                         tag_dict['type'] = 'regular'
                     if len(split_tag) > 1:
                         keyiter = iter(split_tag)
-                        keyiter.next()
+                        next(keyiter)
                         key = ''
                         for item in keyiter:
                             key += item + ":"
@@ -371,107 +415,912 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                         tag_dict['value'] = elem.attrib['v']
                         tag_dict['type'] = split_tag[0]
                     tags.append(tag_dict)
-                #if tag is type 'nd' keep track of position and store in way_nodes dict
-                elif elem.tag == 'nd':
-                    nd_dict = {}
-                    nd_dict['id'] = element.attrib['id']
-                    nd_dict['node_id'] = elem.attrib['ref']
-                    nd_dict['position'] = i
-                    way_nodes.append(nd_dict)
-                    i += 1
+            #if tag is type 'nd' keep track of position and store in way_nodes dict
+            #(nd children have no "tag" descendants, so this has to sit outside the loop above)
+            if elem.tag == 'nd':
+                nd_dict = {}
+                nd_dict['id'] = element.attrib['id']
+                nd_dict['node_id'] = elem.attrib['ref']
+                nd_dict['position'] = i
+                way_nodes.append(nd_dict)
+                i += 1
         #print {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
 
+# ================================================== #
+#               Table Driven Shaper                  #
+# ================================================== #
+#cleans a street name with the street rules in use, one regex search per distinct name
+#without rules (data.py --street-rules) the names are written as they are, like shape_element does
+#the audit classification is cached next to the cleaned name, as [street type, mapped type] if the
+#street type is unexpected (the rules are frozen, so a restored entry has nothing to replay)
+def clean_street_name(value):
+    cached = normalization_cache.get('street', value)
+    if cached is None:
+        rules = street_rules_in_use
+        cleaned = rules.clean(value)
+        street_type = rules.street_type(value)
+        classification = [street_type, rules.mapping.get(street_type)] if street_type else None
+        normalization_cache.put('street', value, cleaned, classification)
+        return cleaned
+    return cached[0]
+
+def clean_post_code(value):
+    cached = normalization_cache.get('postcode', value)
+    if cached is None:
+        cleaned = audit_post_code(value, postcode_changes)
+        normalization_cache.put('postcode', value, cleaned, cleaned if cleaned != value else None)
+        return cleaned
+    if cached[2] and cached[1] is not None:
+        postcode_changes[value] = cached[1]
+    return cached[0]
+
+#cleaners per tag "k" value: each takes the "v" value and returns the value to write
+NODE_TAG_CLEANERS = {'addr:street': clean_street_name, 'addr:postcode': clean_post_code}
+WAY_TAG_CLEANERS = {'addr:street': clean_street_name}
+RELATION_TAG_CLEANERS = WAY_TAG_CLEANERS
+
+#(key, type) split of every tag "k" value seen so far, there are only a few thousand distinct ones
+KEY_SPLITS = {}
+MAX_KEY_SPLITS = 100000
+#one shared string object per distinct key and type in KEY_SPLITS, works for unicode too
+INTERNED = {}
+
+def split_key(k, default_tag_type='regular'):
+    """Split a tag "k" value into (key, type) at the first colon"""
+    split = KEY_SPLITS.get(k)
+    if split is None:
+        tag_type, colon, key = k.partition(':')
+        split = (key, tag_type) if colon else (k, default_tag_type)
+        if len(KEY_SPLITS) < MAX_KEY_SPLITS:
+            split = tuple(INTERNED.setdefault(part, part) for part in split)
+            KEY_SPLITS[k] = split
+    return split
+
+
+#converts an element id to int once, for its record and all of its rows
+#an id that is not a number is kept as it is, for the validator to report
+def element_id_of(attrib):
+    element_id = attrib['id']
+    try:
+        return int(element_id)
+    except ValueError:
+        return element_id
+
+
+def shape_children(element_id, element, cleaners):
+    """Return (tags, way_nodes) rows for the children of element in a single walk
+
+    tags holds one (id, key, value, type) tuple per secondary tag and way_nodes one
+    (id, node_id, position) tuple per nd child.
+    """
+    tags = []
+    way_nodes = []
+    for child in element:
+        attrib = child.attrib
+        if child.tag == 'tag':
+            k = attrib['k']
+            value = attrib['v']
+            cleaner = cleaners.get(k)
+            if cleaner is not None:
+                value = cleaner(value)
+            key, tag_type = KEY_SPLITS.get(k) or split_key(k)
+            tags.append((element_id, key, value, tag_type))
+        elif child.tag == 'nd':
+            way_nodes.append((element_id, attrib['ref'], len(way_nodes)))
+    return tags, way_nodes
+
+
+def shape_relation(element, cleaners=RELATION_TAG_CLEANERS):
+    """Shape a relation into its RelationRecord, relation_members and relation_tags tables
+
+    relation_members is a generator of (id, member_id, type, role, position) tuples that walks
+    the children of element as it is consumed, so the members are never all in memory.  The
+    (id, key, value, type) tuples of relation_tags are collected during that walk and are only
+    complete once relation_members is exhausted.
+    """
+    attrib = element.attrib
+    element_id = element_id_of(attrib)
+    tags = []
+
+    def members():
+        position = 0
+        for child in element:
+            child_attrib = child.attrib
+            if child.tag == 'member':
+                yield (element_id, child_attrib['ref'], child_attrib['type'], child_attrib['role'], position)
+                position += 1
+            elif child.tag == 'tag':
+                k = child_attrib['k']
+                value = child_attrib['v']
+                cleaner = cleaners.get(k)
+                if cleaner is not None:
+                    value = cleaner(value)
+                key, tag_type = KEY_SPLITS.get(k) or split_key(k)
+                tags.append((element_id, key, value, tag_type))
+
+    return {'relation': RelationRecord(element_id, attrib['user'], attrib['uid'], attrib['version'],
+                                       attrib['changeset'], attrib['timestamp']),
+            'relation_members': members(),
+            'relation_tags': tags}
+
+
+def shape_rows(element):
+    """Table driven version of shape_element
+
+    Returns the same tables as shape_element, except that the node and way rows are a
+    NodeRecord/WayRecord and the rows of the tag and way node tables are tuples in
+    NODE_TAGS_FIELDS/WAY_TAGS_FIELDS/WAY_NODES_FIELDS order, all of them positional (see
+    RECORDS).  The element id is an int, shared by the record and every row.  Relations are
+    shaped too, see shape_relation.
+    """
+    attrib = element.attrib
+    if element.tag == 'node':
+        element_id = element_id_of(attrib)
+        tags, way_nodes = shape_children(element_id, element, NODE_TAG_CLEANERS)
+        return {'node': NodeRecord(element_id, attrib['lat'], attrib['lon'], attrib['user'], attrib['uid'],
+                                   attrib['version'], attrib['changeset'], attrib['timestamp']),
+                'node_tags': tags}
+    elif element.tag == 'way':
+        element_id = element_id_of(attrib)
+        tags, way_nodes = shape_children(element_id, element, WAY_TAG_CLEANERS)
+        return {'way': WayRecord(element_id, attrib['user'], attrib['uid'], attrib['version'], attrib['changeset'],
+                                 attrib['timestamp']),
+                'way_nodes': way_nodes,
+                'way_tags': tags}
+    elif element.tag == 'relation':
+        return shape_relation(element)
+
+
+#converts the records and tuple rows of shape_rows back into the dict rows of shape_element
+def rows_as_dicts(el):
+    converted = {}
+    for table, rows in el.items():
+        fields = TABLE_FIELDS[table]
+        if isinstance(rows, list):
+            rows = [row if isinstance(row, dict) else dict(zip(fields, row)) for row in rows]
+        elif isinstance(rows, tuple):
+            rows = dict(zip(fields, rows))
+        converted[table] = rows
+    return converted
+
+
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=osm_reader.DEFAULT_BACKEND, stream=()):
+    """Yield element if it is the right type of tag, see osm_reader.py for the parser backends"""
+    return osm_reader.get_element(osm_file, tags, backend, stream)
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+
+#the compiled validator is used unless cerberus is asked for, cerberus is only imported then
+def make_validator(use_cerberus=False):
+    if use_cerberus:
+        import cerberus
+        return cerberus.Validator()
+    return fast_validator.CompiledValidator(SCHEMA, TABLE_FIELDS)
 
 
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
+        field, errors = next(iter(validator.errors.items()))
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
         error_string = pprint.pformat(errors)
-        print element
-        
+        log.debug('invalid element %r', element)
+
         raise Exception(message_string.format(field, error_string))
 
 
+def validate_members(members, tags, validator, use_cerberus=False, batch_size=MEMBER_BATCH):
+    """Yield the relation_members rows of a shaped relation, validating them in batches
+
+    The relation_tags are validated once the members are exhausted, which is when they are
+    complete.
+    """
+    batch = []
+    for row in members:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            validate_element(rows_as_dicts({'relation_members': batch}) if use_cerberus
+                             else {'relation_members': batch}, validator)
+            for member in batch:
+                yield member
+            batch = []
+    rest = {'relation_members': batch, 'relation_tags': tags}
+    validate_element(rows_as_dicts(rest) if use_cerberus else rest, validator)
+    for member in batch:
+        yield member
+
+
 class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
+    """Extend csv.DictWriter to handle Unicode input
+
+    On Python 2 every unicode value is encoded to UTF-8 for the csv module.  On Python 3 the
+    csv module writes the str values as they are and the file encodes them (see compat.py).
+    """
+
+    if compat.PY2:
+        def writerow(self, row):
+            super(UnicodeDictWriter, self).writerow({
+                k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.items()
+            })
+
+        def writerows(self, rows):
+            for row in rows:
+                self.writerow(row)
+
+        def writetuple(self, row):
+            """Write one row that is already a sequence in fieldnames order, such as a NodeRecord"""
+            self.writer.writerow([(v.encode('utf-8') if isinstance(v, unicode) else v) for v in row])
+
+        def writetuples(self, rows):
+            """Write rows that are already sequences in fieldnames order, rows can be a generator"""
+            self.writer.writerows([(v.encode('utf-8') if isinstance(v, unicode) else v) for v in row]
+                                  for row in rows)
+    else:
+        def writetuple(self, row):
+            """Write one row that is already a sequence in fieldnames order, such as a NodeRecord"""
+            self.writer.writerow(row)
+
+        def writetuples(self, rows):
+            """Write rows that are already sequences in fieldnames order, rows can be a generator"""
+            self.writer.writerows(rows)
+
+
+#opens an output csv file, compressed if its path has a compressed extension
+#on Python 3 it is a UTF-8 text file over a WRITE_BUFFER bytes buffer (or the compressing writer)
+def open_csv(path, level=None):
+    if compressed.compression_of(path):
+        return compat.text_writer(compressed.open_output(path, level), WRITE_BUFFER)
+    return compat.open_text_output(path, WRITE_BUFFER)
+
 
-    def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-        })
+class CsvOutput(object):
+    """Writes elements shaped by shape_rows to the csv files, one per table
+
+    With positions (from positions() of an earlier run) the existing files are cut back to
+    those byte positions and appended to, for checkpoint.py.  Paths ending in .gz, .bz2 or
+    .zst are compressed at level in a background thread, see compressed.py.
+    """
+
+    def __init__(self, paths=CSV_PATHS, header=True, positions=None, level=None):
+        if positions is None:
+            self.files = [open_csv(path, level) for path in paths]
+        else:
+            self.files = []
+            for path, position in zip(paths, positions):
+                csv_file = open(path, 'r+b')
+                csv_file.truncate(position)
+                csv_file.seek(position)
+                self.files.append(compat.text_writer(csv_file))
+            header = False
+        (nodes_file, nodes_tags_file, ways_file, way_nodes_file, way_tags_file,
+         relations_file, relation_members_file, relation_tags_file) = self.files
+
+        self.nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
+        self.node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
+        self.ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
+        self.way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
+        self.way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+        self.relations_writer = UnicodeDictWriter(relations_file, RELATION_FIELDS)
+        self.relation_members_writer = UnicodeDictWriter(relation_members_file, RELATION_MEMBERS_FIELDS)
+        self.relation_tags_writer = UnicodeDictWriter(relation_tags_file, RELATION_TAGS_FIELDS)
+
+        if header:
+            self.nodes_writer.writeheader()
+            self.node_tags_writer.writeheader()
+            self.ways_writer.writeheader()
+            self.way_nodes_writer.writeheader()
+            self.way_tags_writer.writeheader()
+            self.relations_writer.writeheader()
+            self.relation_members_writer.writeheader()
+            self.relation_tags_writer.writeheader()
+
+    def write(self, tag, el):
+        if tag == 'node':
+            self.nodes_writer.writetuple(el['node'])
+            self.node_tags_writer.writetuples(el['node_tags'])
+        elif tag == 'way':
+            self.ways_writer.writetuple(el['way'])
+            self.way_nodes_writer.writetuples(el['way_nodes'])
+            self.way_tags_writer.writetuples(el['way_tags'])
+        elif tag == 'relation':
+            self.relations_writer.writetuple(el['relation'])
+            #members first, the tags are complete once they have been consumed
+            self.relation_members_writer.writetuples(el['relation_members'])
+            self.relation_tags_writer.writetuples(el['relation_tags'])
+
+    def positions(self):
+        """Flush and sync the files and return their byte positions"""
+        for csv_file in self.files:
+            checkpoint.sync(csv_file)
+        return [csv_file.tell() for csv_file in self.files]
+
+    def close(self):
+        for csv_file in self.files:
+            csv_file.close()
+
+# ================================================== #
+#               Parallel Mode                        #
+# ================================================== #
+class ShardReader(object):
+    """File-like view of one byte range of an OSM file, wrapped in the file's own <osm> root"""
+
+    def __init__(self, filename, prolog, start, end):
+        self._file = open(filename, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._prolog = prolog
+        self._epilog = b'</osm>\n'
+
+    def read(self, size=65536):
+        if self._prolog:
+            data, self._prolog = self._prolog, b''
+            return data
+        if self._remaining > 0:
+            data = self._file.read(min(size, self._remaining))
+            self._remaining -= len(data)
+            if data:
+                return data
+            self._remaining = 0
+        data, self._epilog = self._epilog, b''
+        return data
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+#scans forward from offset and returns the byte offset of the next top level element
+#reads in blocks that overlap by a few bytes so a tag split across two blocks is still found
+def next_element_offset(osm_file, offset, block_size=1 << 20):
+    osm_file.seek(offset)
+    carry = b''
+    while True:
+        block = osm_file.read(block_size)
+        if not block:
+            return None
+        data = carry + block
+        m = ELEMENT_START.search(data)
+        if m:
+            return offset - len(carry) + m.start()
+        carry = data[-10:]
+        offset += len(block)
+
+
+#scans backwards from before, a block at a time, and returns the byte offset of the start tag of the
+#top level element tag with id element_id, or None if it is not between first and before
+#the blocks overlap by a few KB so a start tag split across two blocks is still found
+def element_offset(osm_file, tag, element_id, first, before, block_size=checkpoint.RESUME_BLOCK):
+    start_tag = re.compile(b'<' + tag.encode('ascii') + br"""\b[^>]*\sid=["']""" + re.escape(element_id.encode('ascii'))
+                           + br"""["']""")
+    end = before
+    carry = b''
+    while end > first:
+        start = max(first, end - block_size)
+        osm_file.seek(start)
+        data = osm_file.read(end - start) + carry
+        last = None
+        for m in start_tag.finditer(data):
+            last = m
+        if last is not None:
+            return start + last.start()
+        carry = data[:4096]
+        end = start
+    return None
+
+
+def document_bounds(osm_file):
+    """Return (prolog, offset of the first top level element, offset of </osm>) of an open file
+
+    The offsets are None if there are no elements.
+    """
+    first = next_element_offset(osm_file, 0)
+    if first is None:
+        return b'', None, None
+    osm_file.seek(0)
+    prolog = osm_file.read(first)
+    osm_file.seek(0, os.SEEK_END)
+    size = osm_file.tell()
+    osm_file.seek(max(first, size - 4096))
+    tail = osm_file.read()
+    end = size - len(tail) + tail.rfind(b'</osm>') if b'</osm>' in tail else size
+    return prolog, first, end
+
+
+def find_shards(file_in, shards):
+    """Split file_in at top level element boundaries into at most shards byte ranges
+
+    Returns the prolog (everything before the first element, including the <osm> tag)
+    and a list of (start, end) byte offsets that together cover every top level element.
+    PBF files are split at blob boundaries instead and have no prolog (None).
+    """
+    if osm_reader.is_pbf(file_in):
+        return None, pbf_reader.find_shards(file_in, shards)
+    with open(file_in, 'rb') as osm_file:
+        prolog, first, end = document_bounds(osm_file)
+        if first is None:
+            return b'', []
+        starts = [first]
+        for i in range(1, shards):
+            offset = next_element_offset(osm_file, first + (end - first) * i // shards)
+            if offset is not None and starts[-1] < offset < end:
+                starts.append(offset)
+    return prolog, list(zip(starts, starts[1:] + [end]))
+
+
+#the quarantine file of a shard, next to its csv files
+def shard_quarantine_path(paths):
+    return paths[0] + '.quarantine'
+
+
+#worker for process_map_parallel: shapes one shard into its own set of headerless csv files
+#settings holds the process_map keyword arguments that apply to shaping
+#with settings['quarantine'] the invalid elements go to the shard's own quarantine file
+#returns the shard's run summary along with its normalization cache entries
+def process_shard(args):
+    file_in, prolog, start, end, paths, settings = args
+    #a worker process shapes several shards, only count this one
+    normalization_cache.hits = normalization_cache.misses = 0
+    if settings.get('street_rules_path'):
+        use_street_rules(street_rules.load(settings['street_rules_path']))
+    if settings.get('norm_cache_path'):
+        normalization_cache.load(settings['norm_cache_path'])
+    if prolog is None:
+        reader = None
+        elements = pbf_reader.get_element(file_in, ('node', 'way', 'relation'), start, end)
+    else:
+        reader = ShardReader(file_in, prolog, start, end)
+        elements = get_element(reader, tags=('node', 'way', 'relation'), backend=settings['backend'],
+                               stream=('relation',))
+    shard_metrics = metrics.Metrics(interval=None)
+    shard_stats = tagstats.TagStats(settings['stats_top']) if settings.get('stats_top') else None
+    quarantine = checkpoint.Quarantine(shard_quarantine_path(paths)) if settings.get('quarantine') else None
+    try:
+        write_elements(elements, CsvOutput(paths, header=False), settings['validate'], settings['use_cerberus'],
+                       run_metrics=shard_metrics, quarantine=quarantine, tag_stats=shard_stats)
+    finally:
+        if reader is not None:
+            reader.close()
+        if quarantine is not None:
+            quarantine.close()
+    summary = run_summary()
+    summary['quarantined'] = quarantine.count if quarantine is not None else 0
+    summary['normalization_cache_entries'] = normalization_cache.export()
+    summary['metrics'] = shard_metrics.export()
+    summary['tag_stats'] = shard_stats.export() if shard_stats is not None else None
+    return summary
+
+
+#concatenates the per shard csv files in shard order behind a single header
+def merge_shards(shard_paths, paths=CSV_PATHS, level=None):
+    for i, (path, field_names) in enumerate(zip(paths, CSV_FIELDS)):
+        with open_csv(path, level) as out_file:
+            UnicodeDictWriter(out_file, field_names).writeheader()
+            out_bytes = compat.binary_of(out_file)
+            for shard in shard_paths:
+                with open(shard[i], 'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, out_bytes, 1 << 20)
+
+
+def process_map_parallel(file_in, workers, settings, shards=None, output=None, way_node_check=None,
+                         geometry_writer=None, run_metrics=None, csv_paths=CSV_PATHS, level=None, tag_stats=None,
+                         quarantine=None):
+    """Shape byte range shards of file_in in a process pool and merge the csv(s)
+
+    The merged files are byte-identical to a serial run because each shard covers whole top
+    level elements and the shards are concatenated back in file order.  If an output such as
+    sqlite_loader.SQLiteOutput is given the shard csv(s) are loaded into it, in the same order.
+    settings are the shaping keyword arguments of process_map.  A refcheck.WayNodeCheck is
+    run over the shard csv(s) in file order before they are merged, and then a
+    geometry.GeometryWriter.  The counts and stage timings of the shards are added to
+    run_metrics, which reports the progress as shards complete.  Without an output the
+    shards are merged into csv_paths, compressed at level if they have a compressed extension.
+    The tag statistics of the shards (settings['stats_top'] set) are merged into tag_stats.
+    With a checkpoint.Quarantine (settings['quarantine'] set) each shard quarantines its invalid
+    elements in its own file, and those are appended to quarantine in shard order.
+    """
+    prolog, ranges = find_shards(file_in, shards or workers * 4)
+    tmp_dir = tempfile.mkdtemp(prefix='osm_shards_')
+    try:
+        jobs = []
+        for i, (start, end) in enumerate(ranges):
+            paths = [os.path.join(tmp_dir, '{0}.{1}'.format(i, os.path.basename(path))) for path in CSV_PATHS]
+            jobs.append((file_in, prolog, start, end, paths, settings))
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            for job, summary in zip(jobs, pool.imap(process_shard, jobs)):
+                if run_metrics is not None:
+                    run_metrics.merge(summary['metrics'])
+                    run_metrics.maybe_report(run_metrics.bytes_done + job[3] - job[2])
+                postcode_changes.update(summary['postcode_changes'])
+                normalization_cache.hits += summary['normalization_cache']['hits']
+                normalization_cache.misses += summary['normalization_cache']['misses']
+                normalization_cache.update(summary['normalization_cache_entries'])
+                if tag_stats is not None:
+                    tag_stats.merge(summary['tag_stats'])
+                if quarantine is not None:
+                    quarantine.append(shard_quarantine_path(job[4]), summary['quarantined'])
+        finally:
+            pool.close()
+            pool.join()
+
+        if way_node_check is not None:
+            for job in jobs:
+                way_node_check.check_csvs(job[4])
+        if geometry_writer is not None:
+            for job in jobs:
+                geometry_writer.add_csvs(job[4])
+        if output is None:
+            merge_shards([job[4] for job in jobs], csv_paths, level)
+        else:
+            try:
+                for job in jobs:
+                    output.load_csvs(job[4])
+            finally:
+                output.close()
+    finally:
+        shutil.rmtree(tmp_dir)
 
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-    validate_count = 0
-    element_count = 1
-
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    if validate_count == 100:
-                        print "validating 100x" + str(element_count) + "th element"
-                        validate_count = 0
-                        element_count += 1
-                    validate_element(el, validator)
-                    validate_count += 1
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+def write_elements(elements, output, validate, use_cerberus=False, way_node_check=None, geometry_writer=None,
+                   run_metrics=None, quarantine=None, checkpointer=None, tag_stats=None):
+    """Shape each element, validate it if asked and write it to output
+
+    With a refcheck.WayNodeCheck the node ids are recorded and the way_nodes rows checked
+    against them before they are written.  With a geometry.GeometryWriter the node coordinates
+    are stored and the geometry of each way is written as the way is reached.  The elements
+    and the time spent in each stage are counted in run_metrics (a metrics.Metrics), and the
+    written elements are counted in tag_stats (a tagstats.TagStats) if there is one.
+    With a checkpoint.Quarantine the elements that fail validation are written there instead of
+    raising, relations included: each relation is held back in a checkpoint.HeldRelation until
+    its members and tags are all valid, so none of the rows of a quarantined relation are
+    written.  A checkpoint.Checkpointer is told about every element done.
+    """
+    validator = make_validator(use_cerberus)
+    if run_metrics is None:
+        run_metrics = metrics.Metrics(interval=None)
+    shape = run_metrics.shaper(shape_rows)
+    elements = iter(elements)
+
+    try:
+        while True:
+            start = timer()
+            element = next(elements, None)
+            parsed = timer()
+            if element is None:
+                break
+            tag = element.tag
+            held = None
+            if tag == 'relation' and validate is True and quarantine is not None:
+                held = checkpoint.HeldRelation(element)
+            el = shape(element if held is None else held.element)
+            shaped = timer()
+            if not el:
+                continue
+            if validate is True:
+                try:
+                    if tag == 'relation':
+                        validate_element({'relation': el['relation']}, validator)
+                        if held is not None:
+                            el['relation_members'] = held.hold(validate_members(
+                                el['relation_members'], el['relation_tags'], validator, use_cerberus))
+                    else:
+                        validate_element(rows_as_dicts(el) if use_cerberus else el, validator)
+                except Exception as e:
+                    if quarantine is None:
+                        raise
+                    quarantine.add(element if held is None else held.raw(), e)
+                    if held is not None:
+                        held.close()
+                    if checkpointer is not None:
+                        checkpointer.done(tag, element.get('id'))
+                    continue
+            if tag == 'relation':
+                #the members are validated while the output streams them, unless they are held
+                if validate is True and held is None:
+                    el['relation_members'] = validate_members(el['relation_members'], el['relation_tags'], validator,
+                                                              use_cerberus)
+                validated = checked = timer()
+            else:
+                validated = timer()
+
+                if way_node_check is not None:
+                    if tag == 'node':
+                        way_node_check.add_node(el['node'].id)
+                    elif tag == 'way':
+                        el['way_nodes'] = way_node_check.check(el['way_nodes'])
+                if geometry_writer is not None:
+                    if tag == 'node':
+                        node = el['node']
+                        geometry_writer.add_node(node.id, node.lat, node.lon)
+                    elif tag == 'way':
+                        geometry_writer.add_way(el['way'].id, [row[1] for row in el['way_nodes']], el['way_tags'])
+                checked = timer()
+            output.write(tag, el)
+            written = timer()
+            if held is not None:
+                held.close()
+            if tag_stats is not None:
+                tag_stats.add(tag, el)
+            run_metrics.add(tag, parsed - start, shaped - parsed, validated - shaped,
+                            checked - validated + timer() - written, written - checked)
+            if checkpointer is not None:
+                checkpointer.done(tag, element.get('id'))
+    finally:
+        output.close()
+
+
+def run_summary():
+    """Return the postcode changes and normalization cache counters of this run"""
+    return {'postcode_changes': postcode_changes,
+            'normalization_cache': normalization_cache.stats()}
+
+
+#opens file_in for a resumed run, at the start tag of the last element done, found by reading back
+#from the checkpointed position however large the element is (from the first element if it is not
+#found, checkpoint.skip_done then reports it), for PBF and compressed input from the start
+def resume_source(file_in, backend, state):
+    if backend == 'pbf' or compressed.compression_of(file_in):
+        return compressed.open_input(file_in)
+    tag, element_id = state['last']
+    with open(file_in, 'rb') as osm_file:
+        prolog, first, end = document_bounds(osm_file)
+        start = element_offset(osm_file, tag, element_id, first, state['input_position'])
+    return ShardReader(file_in, prolog, start if start is not None else first, end)
+
+
+def process_map(file_in, validate, workers=1, sqlite_path=None, use_cerberus=False, norm_cache_path=None,
+                backend=osm_reader.DEFAULT_BACKEND, dangling=None, parquet_dir=None, rtree=False, geometry_path=None,
+                node_store='sparse', progress=metrics.PROGRESS_INTERVAL, metrics_path=None, profile_path=None,
+                profile_every=1, checkpoint_path=None, checkpoint_every=None, resume=False, quarantine_path=None,
+                compression=None, compression_level=None, pipelined=False, batch_size=None, queue_batches=None,
+                ordered=True, stats_path=None, stats_top=tagstats.TOP, street_rules_path=None):
+    """Iteratively process each XML element and write to csv(s)
+
+    With workers > 1 the file is split into shards that are shaped in parallel.
+    With sqlite_path the tables are bulk loaded into that SQLite database instead of csv(s), with
+    an R*Tree index of the nodes and way bounding boxes if rtree (see spatial.py), and with
+    parquet_dir they are written to typed Parquet files in that directory.
+    Elements are validated with the compiled schema validator, or cerberus if use_cerberus.
+    With norm_cache_path the cleaned street names and postcodes are loaded from and saved to
+    that file, so the next run can reuse them.  backend picks the XML parser (see osm_reader.py);
+    .osm.pbf input is read with pbf_reader.py and gives the same csv(s) as the equivalent XML.
+    dangling is None to skip the check of way_nodes against the node ids, "report" to count
+    the rows whose node is not in the file, or "drop" to also leave them out (see refcheck.py).
+    With geometry_path the WKT geometry and bounding box of each way are written to that csv,
+    from a "sparse" or "dense" on-disk store of the node coordinates (see geometry.py).
+    A progress line is logged every progress seconds (None or 0 to turn it off), and the
+    stage timings of metrics.py are added to the summary and saved as JSON to metrics_path.
+    With profile_path the shaping of every profile_every-th element is profiled with cProfile
+    and the stats saved there (serial runs only).
+    With checkpoint_every a checkpoint is saved to checkpoint_path every that many elements of a
+    serial csv run, and resume continues from it (see checkpoint.py).  With quarantine_path the
+    elements that fail validation are written to that file instead of stopping the run.
+    Input ending in .gz, .bz2 or .zst is decompressed on the fly, and compression ("gz", "bz2"
+    or "zst") compresses the csv files at compression_level (see compressed.py).
+    With pipelined the input is parsed, shaped by a pool of worker processes and written by a
+    thread per csv file in overlapping stages, batch_size elements at a time with at most
+    queue_batches batches waiting between two stages, in input order unless ordered is False
+    (see pipeline.py).
+    With stats_path the exact and sketched tag and user statistics of tagstats.py, with top lists
+    of stats_top entries, are added to the summary and saved as JSON to stats_path.
+    With street_rules_path the addr:street values are cleaned with the street rules saved in
+    that file by audit_engine.py --save-rules (see street_rules.py), otherwise they are kept.
+    """
+    if (checkpoint_every or resume) and (workers > 1 or sqlite_path or parquet_dir or dangling or geometry_path):
+        raise ValueError('Checkpoints need a serial run that writes csv files, without the dangling check or geometry')
+    if (checkpoint_every or resume) and compression:
+        raise ValueError('Checkpoints need uncompressed csv files')
+    if stats_path and (checkpoint_every or resume):
+        raise ValueError('The tag statistics of a checkpointed run would only cover the elements after a resume')
+    if pipelined and (checkpoint_every or resume or sqlite_path or parquet_dir or dangling or geometry_path):
+        raise ValueError('The pipelined run writes csv files, without checkpoints, the dangling check or geometry')
+    if workers > 1 and not pipelined and compressed.compression_of(file_in):
+        log.warning('%s is compressed and cannot be split into shards, shaping it serially', file_in)
+        workers = 1
+    csv_paths = [path + '.' + compression for path in CSV_PATHS] if compression else CSV_PATHS
+    state = checkpoint.load(checkpoint_path, file_in) if resume else None
+    if street_rules_path:
+        use_street_rules(street_rules.load(street_rules_path))
+    if norm_cache_path:
+        normalization_cache.load(norm_cache_path)
+    if sqlite_path:
+        import sqlite_loader  # imported here because sqlite_loader imports this module
+        output = sqlite_loader.SQLiteOutput(sqlite_path, rtree=rtree)
+    elif parquet_dir:
+        import parquet_output  # imported here because parquet_output imports this module
+        output = parquet_output.ParquetOutput(parquet_dir)
+    else:
+        output = None
+    way_node_check = refcheck.WayNodeCheck(drop=dangling == 'drop') if dangling else None
+    geometry_writer = geometry.GeometryWriter(geometry_path, node_store) if geometry_path else None
+    profiler = None
+    if profile_path and workers <= 1 and not pipelined:
+        profiler = metrics.ShapeProfiler(profile_path, profile_every)
+    run_metrics = metrics.Metrics(os.path.getsize(file_in), interval=progress, profiler=profiler)
+    quarantine = None
+    pipeline_summary = None
+    tag_stats = tagstats.TagStats(stats_top) if stats_path else None
+    if quarantine_path:
+        quarantine = checkpoint.Quarantine(quarantine_path, state['quarantine'] if state else None)
+
+    try:
+        if pipelined:
+            import pipeline  # imported here because pipeline imports this module
+            if osm_reader.is_pbf(file_in):
+                backend = 'pbf'
+            source = compressed.open_input(file_in)
+            try:
+                run_metrics.position = source.tell
+                stages = pipeline.Pipeline(csv_paths, validate, use_cerberus, workers, norm_cache_path,
+                                           batch_size or pipeline.BATCH_SIZE, queue_batches or pipeline.QUEUE_BATCHES,
+                                           ordered, compression_level, run_metrics, quarantine, tag_stats,
+                                           street_rules_path)
+                #relations are parsed whole, the pool workers get them as plain records
+                pipeline_summary = stages.run(get_element(source, tags=('node', 'way', 'relation'), backend=backend))
+            finally:
+                source.close()
+            postcode_changes.update(stages.postcode_changes)
+            normalization_cache.hits += stages.cache_hits
+            normalization_cache.misses += stages.cache_misses
+            normalization_cache.update(stages.cache_entries)
+        elif workers > 1:
+            settings = {'validate': validate, 'use_cerberus': use_cerberus, 'norm_cache_path': norm_cache_path,
+                        'backend': backend, 'stats_top': stats_top if tag_stats is not None else None,
+                        'street_rules_path': street_rules_path, 'quarantine': quarantine is not None}
+            process_map_parallel(file_in, workers, settings, output=output, way_node_check=way_node_check,
+                                 geometry_writer=geometry_writer, run_metrics=run_metrics, csv_paths=csv_paths,
+                                 level=compression_level, tag_stats=tag_stats, quarantine=quarantine)
+        else:
+            #read through our own handle, so the progress can tell how far into the file the parser is
+            if osm_reader.is_pbf(file_in):
+                backend = 'pbf'
+            source = compressed.open_input(file_in) if state is None else resume_source(file_in, backend, state)
+            try:
+                run_metrics.position = source.tell
+                elements = get_element(source, tags=('node', 'way', 'relation'), backend=backend, stream=('relation',))
+                if state is not None:
+                    elements = checkpoint.skip_done(elements, state['last'])
+                    output = CsvOutput(positions=state['outputs'])
+                output = output or CsvOutput(csv_paths, level=compression_level)
+                checkpointer = None
+                if checkpoint_every:
+                    checkpointer = checkpoint.Checkpointer(checkpoint_path, checkpoint_every, file_in, source, output,
+                                                           quarantine, state)
+                write_elements(elements, output, validate, use_cerberus, way_node_check, geometry_writer,
+                               run_metrics, quarantine, checkpointer, tag_stats)
+            finally:
+                source.close()
+            if checkpointer is not None:
+                checkpointer.finish()
+    finally:
+        if geometry_writer is not None:
+            geometry_writer.close()
+        if quarantine is not None:
+            quarantine.close()
+        run_metrics.close()
+
+    if norm_cache_path:
+        normalization_cache.save(norm_cache_path)
+    summary = run_summary()
+    if way_node_check is not None:
+        summary['dangling_way_nodes'] = way_node_check.report()
+    if geometry_writer is not None:
+        summary['geometry'] = geometry_writer.report()
+    summary['metrics'] = run_metrics.summary()
+    if pipeline_summary is not None:
+        summary['pipeline'] = pipeline_summary
+    if tag_stats is not None:
+        summary['tag_stats'] = tag_stats.report()
+        with open(stats_path, 'w') as stats_file:
+            json.dump(summary['tag_stats'], stats_file, indent=2, sort_keys=True)
+    if quarantine is not None:
+        summary['quarantined'] = quarantine.count
+    if metrics_path:
+        with open(metrics_path, 'w') as metrics_file:
+            json.dump(summary['metrics'], metrics_file, indent=2, sort_keys=True)
+    return summary
 
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-    process_map(OSM_PATH, validate=True)
-    pprint(postcode_changes)
+    parser = argparse.ArgumentParser(description='Shape an OSM XML file into csv files for SQL import')
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH,
+                        help='input .osm (optionally .gz/.bz2/.zst compressed) or .osm.pbf file')
+    parser.add_argument('--no-validate', dest='validate', action='store_false',
+                        help='skip schema validation of the shaped elements')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to shape shards of the input with')
+    parser.add_argument('--sqlite', metavar='DB', dest='sqlite_path',
+                        help='load the tables straight into this SQLite database instead of csv files')
+    parser.add_argument('--rtree', action='store_true',
+                        help='with --sqlite, also build an R*Tree index for bounding box queries (see spatial.py)')
+    parser.add_argument('--parquet', metavar='DIR', dest='parquet_dir',
+                        help='write the tables to typed Parquet files in this directory instead of csv files')
+    parser.add_argument('--cerberus', dest='use_cerberus', action='store_true',
+                        help='validate with cerberus instead of the compiled schema validator')
+    parser.add_argument('--norm-cache', metavar='PATH', dest='norm_cache_path',
+                        help='load and save the street name/postcode normalization cache at this path')
+    parser.add_argument('--street-rules', metavar='PATH', dest='street_rules_path',
+                        help='clean the addr:street values with the rules saved by audit_engine.py --save-rules')
+    parser.add_argument('--backend', choices=osm_reader.BACKENDS, default=osm_reader.DEFAULT_BACKEND,
+                        help='XML parser backend (.pbf input is always read with pbf)')
+    parser.add_argument('--dangling', choices=('report', 'drop'),
+                        help='check way_nodes against the node ids and report or drop the dangling ones')
+    parser.add_argument('--geometry', metavar='PATH', dest='geometry_path',
+                        help='also write the WKT geometry and bounding box of each way to this csv file')
+    parser.add_argument('--node-store', choices=geometry.STORES, default='sparse',
+                        help='on-disk node coordinate store for --geometry: sparse (sorted ids) or dense (mmap by id)')
+    parser.add_argument('--progress', metavar='SECONDS', type=float, default=metrics.PROGRESS_INTERVAL,
+                        help='log the throughput and ETA every SECONDS (0 to turn it off)')
+    parser.add_argument('--metrics', metavar='PATH', dest='metrics_path',
+                        help='save the element counts and stage timings to this JSON file')
+    parser.add_argument('--profile-shape', metavar='PATH', dest='profile_path',
+                        help='profile the shaping of the elements with cProfile and save the stats to PATH')
+    parser.add_argument('--profile-every', metavar='N', type=int, default=1,
+                        help='with --profile-shape, only profile every Nth element')
+    parser.add_argument('--checkpoint-every', metavar='N', type=int,
+                        help='save a checkpoint every N elements, so the run can be resumed (serial csv runs)')
+    parser.add_argument('--checkpoint', metavar='PATH', dest='checkpoint_path', default='data_checkpoint.json',
+                        help='checkpoint file for --checkpoint-every and --resume')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run from its checkpoint')
+    parser.add_argument('--quarantine', metavar='PATH', dest='quarantine_path',
+                        help='write the elements that fail validation to this OSM file instead of stopping')
+    parser.add_argument('--compress', choices=compressed.COMPRESSIONS, dest='compression',
+                        help='compress the csv files (nodes.csv.gz, ...), .gz/.bz2/.zst input is always read directly')
+    parser.add_argument('--compress-level', type=int, dest='compression_level',
+                        help='compression level of --compress (default gz 6, bz2 9, zst 3)')
+    parser.add_argument('--pipeline', dest='pipelined', action='store_true',
+                        help='parse, shape (in --workers processes) and write in overlapping stages, see pipeline.py')
+    parser.add_argument('--batch-size', metavar='N', type=int,
+                        help='with --pipeline, elements per batch handed to the shaping workers (default 1000)')
+    parser.add_argument('--queue-batches', metavar='N', type=int,
+                        help='with --pipeline, batches a stage queue holds before the stage before it waits (default 8)')
+    parser.add_argument('--unordered', dest='ordered', action='store_false',
+                        help='with --pipeline, write each batch as soon as it is shaped instead of in input order')
+    parser.add_argument('--stats', metavar='PATH', dest='stats_path',
+                        help='save exact and approximate tag/user statistics of the run to this JSON file')
+    parser.add_argument('--stats-top', metavar='N', type=int, default=tagstats.TOP,
+                        help='with --stats, length of the top users, keys and key=value lists')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO',
+                        help='DEBUG also logs every postcode the cleaner sees')
+    args = parser.parse_args()
+    if args.rtree and not args.sqlite_path:
+        parser.error('--rtree needs --sqlite')
+    if args.profile_path and (args.workers > 1 or args.pipelined):
+        parser.error('--profile-shape needs a serial run (--workers 1, without --pipeline)')
+    if args.stats_path and (args.checkpoint_every or args.resume):
+        parser.error('--stats cannot be combined with --checkpoint-every or --resume')
+    if args.pipelined and (args.checkpoint_every or args.resume or args.sqlite_path or args.parquet_dir or
+                           args.dangling or args.geometry_path):
+        parser.error('--pipeline writes csv files, without --checkpoint-every, --resume, --dangling or --geometry')
+    if (args.checkpoint_every or args.resume) and (args.workers > 1 or args.sqlite_path or args.parquet_dir or
+                                                   args.dangling or args.geometry_path or args.compression):
+        parser.error('--checkpoint-every and --resume need a serial run that writes uncompressed csv files, '
+                     'without --dangling or --geometry')
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
+    # Note: Validation with cerberus is ~ 10X slower. The compiled validator in
+    # fast_validator.py reports the same errors and costs a few percent.
+    summary = process_map(args.osm_file, validate=args.validate, workers=args.workers,
+                          sqlite_path=args.sqlite_path, use_cerberus=args.use_cerberus,
+                          norm_cache_path=args.norm_cache_path, backend=args.backend, dangling=args.dangling,
+                          parquet_dir=args.parquet_dir, rtree=args.rtree, geometry_path=args.geometry_path,
+                          node_store=args.node_store, progress=args.progress, metrics_path=args.metrics_path,
+                          profile_path=args.profile_path, profile_every=args.profile_every,
+                          checkpoint_path=args.checkpoint_path, checkpoint_every=args.checkpoint_every,
+                          resume=args.resume, quarantine_path=args.quarantine_path, compression=args.compression,
+                          compression_level=args.compression_level, pipelined=args.pipelined,
+                          batch_size=args.batch_size, queue_batches=args.queue_batches, ordered=args.ordered,
+                          stats_path=args.stats_path, stats_top=args.stats_top,
+                          street_rules_path=args.street_rules_path)
+    pprint.pprint(summary)
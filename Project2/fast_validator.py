@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compiled validator for the flat tables described in schema.py.
+
+cerberus walks the nested schema rule by rule for every element, which is what made
+validation ~10X slower than shaping.  The schema in schema.py only ever uses a handful of
+rules (required, type and an int()/float() coerce) over flat rows, so instead it is compiled
+once into one generated check function per table.  Each function reads every field once,
+tries the coercion and checks the type inline, and only builds an error dict when something
+is wrong.
+
+CompiledValidator is a drop in replacement for cerberus.Validator in data.validate_element:
+validate() returns True or False and the errors attribute has the same shape and messages
+cerberus reports, e.g.
+
+    {'node_tags': [{0: [{'id': ["field 'id' cannot be coerced: invalid literal for int()...",
+                                'must be of integer type']}]}]}
+
+Rows may also be tuples in the column order given by table_fields (as data.shape_rows emits
+them); their errors are reported by field name just like dict rows.  Like cerberus, validation
+does not modify the document that is passed in.
+"""
+import schema
+from compat import integer_types, string_types
+
+#python types accepted by each schema "type", matching cerberus
+TYPE_CHECKS = {
+    'integer': '(isinstance(value, INTEGER_TYPES) and not isinstance(value, bool))',
+    'float': '(isinstance(value, NUMBER_TYPES) and not isinstance(value, bool))',
+    'string': 'isinstance(value, STRING_TYPES)',
+}
+
+#template for the check of a single field, filled in per field of a table
+FIELD_TEMPLATE = '''
+    try:
+        value = row[{name!r}]
+    except KeyError:
+        errors = add_error(errors, {name!r}, 'required field')
+    else:
+        if value is None:
+            errors = add_error(errors, {name!r}, 'null value not allowed')
+        else:
+{coerce}
+            if not {type_check}:
+                errors = add_error(errors, {name!r}, 'must be of {type} type')
+'''
+
+COERCE_TEMPLATE = '''            try:
+                value = {coerce}(value)
+            except Exception as e:
+                errors = add_error(errors, {name!r}, "field '{name}' cannot be coerced: %s" % e)'''
+
+
+def add_error(errors, field, message):
+    """Append message to the error list of field, creating the errors dict on first use"""
+    if errors is None:
+        errors = {}
+    errors.setdefault(field, []).append(message)
+    return errors
+
+
+def compile_row_check(name, rules, order=None):
+    """Generate functions that check one row against a table's field rules
+
+    Returns (check, check_sequence): check takes a dict row, check_sequence a tuple row with
+    its values in the column order given by order (None if no order is given).  Both return
+    None for a valid row or a cerberus style {field: [messages]} dict.
+
+    Valid rows take a single expression: every coerce succeeding already implies its type, so
+    only the uncoerced string fields need an isinstance check.  Anything that fails it (or
+    raises) is re-checked field by field to build the error messages.
+    """
+    fields = sorted(rules)
+    if order is not None and sorted(order) != fields:
+        raise ValueError('Column order {0} does not match the fields of {1}'.format(order, name))
+    slow = ['def full_check(row):', '    errors = None']
+    fast_coerce = []
+    fast_types = ['len(row) == {0}'.format(len(fields))]
+    seq_coerce = []
+    seq_types = list(fast_types)
+    for field in fields:
+        rule = rules[field]
+        unsupported = set(rule) - set(['required', 'type', 'coerce'])
+        if unsupported or not rule.get('required'):
+            raise ValueError('Cannot compile rule(s) {0} of field {1}.{2}'.format(
+                sorted(unsupported) or ['required: False'], name, field))
+        coerce = rule.get('coerce')
+        if coerce is not None and coerce not in (int, float):
+            raise ValueError('Cannot compile coerce {0!r} of field {1}.{2}'.format(coerce, name, field))
+        if coerce:
+            coerce_code = COERCE_TEMPLATE.format(name=field, coerce=coerce.__name__)
+            fast_coerce.append('{0}(row[{1!r}])'.format(coerce.__name__, field))
+            if order is not None:
+                seq_coerce.append('{0}(row[{1}])'.format(coerce.__name__, order.index(field)))
+        else:
+            coerce_code = '            pass'
+            fast_types.append(TYPE_CHECKS[rule['type']].replace('value', 'row[{0!r}]'.format(field)))
+            if order is not None:
+                seq_types.append(TYPE_CHECKS[rule['type']].replace('value', 'row[{0}]'.format(order.index(field))))
+        slow.append(FIELD_TEMPLATE.format(name=field, coerce=coerce_code, type=rule['type'],
+                                          type_check=TYPE_CHECKS[rule['type']]))
+    slow.append('''
+    if errors is not None or len(row) != {count}:
+        for field in row:
+            if field not in FIELDS:
+                errors = add_error(errors, field, 'unknown field')
+    return errors
+'''.format(count=len(fields)))
+    slow.append('''
+def full_check_sequence(row):
+    errors = full_check(dict(zip(ORDER, row)))
+    for i in range(len(ORDER), len(row)):
+        errors = add_error(errors, i, 'unknown field')
+    return errors
+''')
+    fast = '''
+def check_{name}(row):
+    try:
+        if {types}:
+            {coerce}
+            return None
+    except Exception:
+        pass
+    return {fallback}(row)
+'''
+    source = '\n'.join(slow) + fast.format(name=name, types=' and '.join(fast_types),
+                                          coerce='; '.join(fast_coerce) or 'pass', fallback='full_check')
+    if order is not None:
+        source += fast.format(name=name + '_sequence', types=' and '.join(seq_types),
+                              coerce='; '.join(seq_coerce) or 'pass', fallback='full_check_sequence')
+
+    namespace = {'add_error': add_error, 'FIELDS': frozenset(fields), 'ORDER': order,
+                 'INTEGER_TYPES': integer_types, 'NUMBER_TYPES': integer_types + (float,), 'STRING_TYPES': string_types}
+    exec(source, namespace)
+    return namespace['check_{0}'.format(name)], namespace.get('check_{0}_sequence'.format(name))
+
+
+class CompiledValidator(object):
+    """cerberus.Validator compatible validator for a schema of dict and list-of-dict tables"""
+
+    def __init__(self, schema=schema.schema, table_fields=None):
+        """table_fields maps table names to their column order, for validating tuple rows"""
+        self.schema = schema
+        self.errors = {}
+        self.checks = {}
+        table_fields = table_fields or {}
+        for table, rules in schema.items():
+            order = table_fields.get(table)
+            if rules['type'] == 'dict':
+                self.checks[table] = ('dict',) + compile_row_check(table, rules['schema'], order)
+            elif rules['type'] == 'list' and rules['schema']['type'] == 'dict':
+                self.checks[table] = ('list',) + compile_row_check(table, rules['schema']['schema'], order)
+            else:
+                raise ValueError('Cannot compile table {0} of type {1}'.format(table, rules['type']))
+
+    def validate(self, document, schema=None):
+        """Return True if document is valid, otherwise fill in self.errors and return False
+
+        schema is accepted for compatibility with cerberus.Validator.validate; it must be the
+        schema this validator was compiled from.
+        """
+        if schema is not None and schema is not self.schema:
+            raise ValueError('CompiledValidator can only validate against the schema it was compiled from')
+        checks = self.checks
+        try:
+            for table, rows in document.items():
+                kind, check, check_sequence = checks[table]
+                if kind == 'dict':
+                    if (check_sequence if isinstance(rows, tuple) else check)(rows) is not None:
+                        break
+                else:
+                    for row in rows:
+                        if (check_sequence if isinstance(row, tuple) else check)(row) is not None:
+                            break
+                    else:
+                        continue
+                    break
+            else:
+                self.errors = {}
+                return True
+        except Exception:
+            pass
+        self.errors = self.collect_errors(document)
+        return not self.errors
+
+    def collect_errors(self, document):
+        """Build the cerberus style errors dict for an invalid document"""
+        errors = {}
+        for table, rows in document.items():
+            try:
+                kind, check, check_sequence = self.checks[table]
+            except KeyError:
+                errors[table] = ['unknown field']
+                continue
+            if kind == 'dict':
+                if isinstance(rows, tuple) and check_sequence is not None:
+                    row_errors = check_sequence(rows)
+                elif not isinstance(rows, dict):
+                    errors[table] = ['must be of dict type']
+                    continue
+                else:
+                    row_errors = check(rows)
+                if row_errors is not None:
+                    errors[table] = [row_errors]
+            else:
+                if not isinstance(rows, list):
+                    errors[table] = ['must be of list type']
+                    continue
+                item_errors = {}
+                for i, row in enumerate(rows):
+                    if isinstance(row, tuple) and check_sequence is not None:
+                        row_errors = check_sequence(row)
+                    elif not isinstance(row, dict):
+                        item_errors[i] = ['must be of dict type']
+                        continue
+                    else:
+                        row_errors = check(row)
+                    if row_errors is not None:
+                        item_errors[i] = [row_errors]
+                if item_errors:
+                    errors[table] = [item_errors]
+        return errors
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Way geometry assembled from an external memory store of node coordinates.
+
+A way only lists the ids of its nodes, so its geometry used to need a join of ways_nodes with
+nodes in SQL.  GeometryWriter instead records the coordinates of every node in a file backed
+store while the nodes are shaped, and since all of the nodes come before the ways in an OSM
+file, each way can be resolved as soon as it is shaped.  It writes one row per way with:
+
+- type:     POLYGON for closed ways with an area tag (building, landuse, ...), else LINESTRING
+- geometry: the WKT of the way, lon/lat pairs with 7 decimals
+- min_lat, min_lon, max_lat, max_lon: the bounding box
+- missing_nodes: refs whose node is not in the extract (they are left out of the geometry)
+
+Coordinates are stored as 32 bit integers of 1e-7 degrees in one of two stores, both on disk
+so extracts larger than RAM work:
+
+- "sparse": (id, lat, lon) records appended in id order, OSM files list nodes sorted by id.
+            Lookups bisect an in-memory list of the first id of every BLOCK_RECORDS records
+            and then the records of that block in a memory map of the file, so the OS page
+            cache decides what stays in memory.  The file is 16 bytes per node whatever the
+            ids are, so this is the default.
+- "dense":  a memory mapped array indexed by node id, 8 bytes per possible id.  One lookup
+            per ref and no sort order needed, but the file spans the highest id (sparse files
+            keep that cheap on Linux), so it suits planet-sized inputs.
+
+Usage:
+    python data.py map.osm --geometry ways_geometry.csv
+"""
+import csv
+import mmap
+import os
+import struct
+import tempfile
+from bisect import bisect_right
+from itertools import groupby
+from operator import itemgetter
+
+from compat import open_text_input, open_text_output
+
+GEOMETRY_FIELDS = ['id', 'type', 'geometry', 'min_lat', 'min_lon', 'max_lat', 'max_lon', 'missing_nodes']
+STORES = ('sparse', 'dense')
+
+#coordinates are stored as integers of 1e-7 degrees
+COORD_SCALE = 10 ** 7
+#(id, lat, lon) records per block of the sparse store
+BLOCK_RECORDS = 1024
+#the dense store grows its file by at least this many bytes
+DENSE_GROWTH = 1 << 24
+
+#closed ways with one of these keys are areas, unless tagged area=no
+AREA_KEYS = frozenset(['area', 'building', 'landuse', 'leisure', 'natural', 'amenity', 'place', 'water',
+                       'waterway', 'parking', 'shop', 'tourism', 'historic', 'military', 'aeroway'])
+
+
+# ================================================== #
+#               Coordinate Stores                    #
+# ================================================== #
+class SparseCoordStore(object):
+    """Sorted (id, lat, lon) file with a block index, for nodes written in increasing id order"""
+    record = struct.Struct('<qii')
+    id_record = struct.Struct('<q')
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.pending = []
+        self.fence = []
+        self.records = 0
+        self.last_id = None
+        self.map = None
+        self.mapped = 0
+
+    def put(self, node_id, lat, lon):
+        if self.last_id is not None and node_id <= self.last_id:
+            raise ValueError('The sparse node store needs nodes sorted by id (node {0} after {1}), '
+                             'use the dense store'.format(node_id, self.last_id))
+        self.last_id = node_id
+        self.pending.extend((node_id, lat, lon))
+        if len(self.pending) >= 3 * BLOCK_RECORDS:
+            self.flush()
+
+    def flush(self):
+        """Write the pending records, a block may be short if nodes are added after a lookup"""
+        count = len(self.pending) // 3
+        if not count:
+            return
+        self.file.seek(self.records * self.record.size)
+        self.file.write(struct.pack('<' + 'qii' * count, *self.pending))
+        self.file.flush()
+        for i in range(0, count, BLOCK_RECORDS):
+            self.fence.append((self.pending[3 * i], self.records + i))
+        self.records += count
+        self.pending = []
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), self.records * self.record.size, access=mmap.ACCESS_READ)
+        self.mapped = self.records
+
+    def get(self, node_id):
+        """Return the (lat, lon) integers of node_id, or None if it was not stored"""
+        if self.pending:
+            self.flush()
+        if not self.records:
+            return None
+        if self.mapped != self.records:
+            self.remap()
+        i = bisect_right(self.fence, (node_id, self.records)) - 1
+        if i < 0:
+            return None
+        lo = self.fence[i][1]
+        hi = self.fence[i + 1][1] if i + 1 < len(self.fence) else self.records
+        #bisect the records of the block for the last id <= node_id
+        size = self.record.size
+        unpack_from = self.id_record.unpack_from
+        data = self.map
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if unpack_from(data, mid * size)[0] <= node_id:
+                lo = mid
+            else:
+                hi = mid
+        found, lat, lon = self.record.unpack_from(data, lo * size)
+        if found != node_id:
+            return None
+        return lat, lon
+
+    def nbytes(self):
+        return (self.records + len(self.pending) // 3) * self.record.size
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+        os.remove(self.path)
+
+
+class DenseCoordStore(object):
+    """Memory mapped array of (lat, lon) indexed by node id"""
+    record = struct.Struct('<II')
+    #offsets that keep every stored value above 0, which marks a missing node
+    LAT_OFFSET = 1000000000
+    LON_OFFSET = 2000000000
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w+b')
+        self.size = DENSE_GROWTH
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.nodes = 0
+
+    def grow(self, needed):
+        self.map.close()
+        self.size = max(needed, self.size * 2, self.size + DENSE_GROWTH)
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def put(self, node_id, lat, lon):
+        if node_id < 0:
+            raise ValueError('The dense node store cannot hold negative id {0}, use the sparse store'.format(node_id))
+        offset = node_id * self.record.size
+        if offset + self.record.size > self.size:
+            self.grow(offset + self.record.size)
+        self.record.pack_into(self.map, offset, lat + self.LAT_OFFSET, lon + self.LON_OFFSET)
+        self.nodes += 1
+
+    def get(self, node_id):
+        """Return the (lat, lon) integers of node_id, or None if it was not stored"""
+        offset = node_id * self.record.size
+        if node_id < 0 or offset + self.record.size > self.size:
+            return None
+        lat, lon = self.record.unpack_from(self.map, offset)
+        if not lat:
+            return None
+        return lat - self.LAT_OFFSET, lon - self.LON_OFFSET
+
+    def nbytes(self):
+        return self.nodes * self.record.size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        os.remove(self.path)
+
+
+def make_store(kind='sparse', directory=None):
+    """Return a new coordinate store of kind in a temporary file in directory"""
+    handle, path = tempfile.mkstemp(prefix='osm_nodes_', suffix='.' + kind, dir=directory)
+    os.close(handle)
+    if kind == 'dense':
+        return DenseCoordStore(path)
+    elif kind == 'sparse':
+        return SparseCoordStore(path)
+    raise ValueError('Unknown node store {0!r}, expected one of {1}'.format(kind, ', '.join(STORES)))
+
+
+# ================================================== #
+#               Geometry                             #
+# ================================================== #
+def to_scaled(value):
+    return int(round(float(value) * COORD_SCALE))
+
+
+def format_coordinate(value):
+    return '{0:.7f}'.format(float(value) / COORD_SCALE)
+
+
+#True if a closed way with these (id, key, value, type) tag rows is an area
+def is_area(tags):
+    for row in tags:
+        if row[3] == 'regular':
+            if row[1] == 'area':
+                return row[2] != 'no'
+            if row[1] in AREA_KEYS:
+                return True
+    return False
+
+
+class GeometryWriter(object):
+    """Builds the geometry of each way from a coordinate store and writes it to a csv file"""
+
+    def __init__(self, path, store='sparse', store_dir=None):
+        self.store = make_store(store, store_dir or os.path.dirname(os.path.abspath(path)))
+        self.file = open_text_output(path)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(GEOMETRY_FIELDS)
+        self.counts = {'ways': 0, 'LINESTRING': 0, 'POLYGON': 0, 'empty': 0, 'missing_nodes': 0}
+
+    def add_node(self, node_id, lat, lon):
+        self.store.put(int(node_id), to_scaled(lat), to_scaled(lon))
+
+    def add_way(self, way_id, refs, tags=()):
+        """Resolve refs and write the geometry row of way_id, tags are its way_tags rows"""
+        get = self.store.get
+        coords = []
+        missing = 0
+        for ref in refs:
+            coord = get(int(ref))
+            if coord is None:
+                missing += 1
+            else:
+                coords.append(coord)
+        self.counts['ways'] += 1
+        self.counts['missing_nodes'] += missing
+        if len(coords) < 2:
+            self.counts['empty'] += 1
+            self.writer.writerow([way_id, '', '', '', '', '', '', missing])
+            return
+
+        lats = [lat for lat, lon in coords]
+        lons = [lon for lat, lon in coords]
+        points = ', '.join('{0} {1}'.format(format_coordinate(lon), format_coordinate(lat)) for lat, lon in coords)
+        if len(coords) >= 4 and coords[0] == coords[-1] and is_area(tags):
+            geometry_type, wkt = 'POLYGON', 'POLYGON (({0}))'.format(points)
+        else:
+            geometry_type, wkt = 'LINESTRING', 'LINESTRING ({0})'.format(points)
+        self.counts[geometry_type] += 1
+        self.writer.writerow([way_id, geometry_type, wkt, format_coordinate(min(lats)), format_coordinate(min(lons)),
+                              format_coordinate(max(lats)), format_coordinate(max(lons)), missing])
+
+    def add_csvs(self, paths):
+        """Add the nodes and ways of a set of headerless shard csv(s), in data.CSV_PATHS order
+
+        Every way of the ways csv gets a row, like add_way gives it in a serial run, also when
+        it has no way_nodes rows (none in the input, or all of them dropped as dangling).  The
+        way_nodes and way_tags rows of a way follow the ways in the same file order, so their
+        groups are joined to the ways as they come up, without assuming any id order.
+        """
+        with open_text_input(paths[0]) as nodes_file:
+            for line in nodes_file:
+                node_id, lat, lon, rest = line.split(',', 3)
+                self.add_node(node_id, lat, lon)
+
+        with open_text_input(paths[2]) as ways_file, open_text_input(paths[3]) as way_nodes_file, \
+                open_text_input(paths[4]) as way_tags_file:
+            nodes = groupby((line.split(',', 2) for line in way_nodes_file), itemgetter(0))
+            tags = groupby(csv.reader(way_tags_file), itemgetter(0))
+            way_nodes = next(nodes, (None, ()))
+            way_tags = next(tags, (None, ()))
+            for line in ways_file:
+                way_id = line.split(',', 1)[0]
+                refs = []
+                if way_nodes[0] == way_id:
+                    refs = [row[1] for row in way_nodes[1]]
+                    way_nodes = next(nodes, (None, ()))
+                tag_rows = ()
+                if way_tags[0] == way_id:
+                    tag_rows = list(way_tags[1])
+                    way_tags = next(tags, (None, ()))
+                self.add_way(way_id, refs, tag_rows)
+
+    def report(self):
+        report = dict(self.counts)
+        report['node_store_bytes'] = self.store.nbytes()
+        return report
+
+    def close(self):
+        self.file.close()
+        self.store.close()
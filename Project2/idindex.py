@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact sets of OSM element ids.
+
+A Python set of ints costs roughly 60 bytes per id, which is several GB for the node ids of a
+large extract.  IdBitmap splits the id space into pages of 65536 ids and stores each page that
+has members in one of two forms, like a roaring bitmap:
+- a sorted array('H') of the 16 bit offsets in the page, 2 bytes per id, while the page has
+  fewer than ARRAY_LIMIT ids.  The ids of a metro extract are spread thinly over the whole id
+  range, so most pages stay in this form.
+- an 8KB bitmap, 1 bit per possible id, once the page is denser than that.  A planet file
+  with hundreds of millions of nodes fills most pages and costs about 1 bit per id.
+
+Membership tests are a dict lookup plus a bit test or a C level binary search of at most
+ARRAY_LIMIT entries.
+"""
+from array import array
+from bisect import bisect_left
+
+PAGE_SHIFT = 16
+PAGE_MASK = (1 << PAGE_SHIFT) - 1
+BITMAP_BYTES = 1 << (PAGE_SHIFT - 3)
+#a page becomes a bitmap when its offset array would be as big as the bitmap
+ARRAY_LIMIT = BITMAP_BYTES // 2
+
+
+def to_bitmap(offsets):
+    bitmap = bytearray(BITMAP_BYTES)
+    for offset in offsets:
+        bitmap[offset >> 3] |= 1 << (offset & 7)
+    return bitmap
+
+
+class IdBitmap(object):
+    """Set of integer ids stored as pages of sorted offsets or bitmaps"""
+
+    def __init__(self, ids=()):
+        self.pages = {}
+        self.count = 0
+        self.update(ids)
+
+    def add(self, element_id):
+        key = element_id >> PAGE_SHIFT
+        offset = element_id & PAGE_MASK
+        page = self.pages.get(key)
+        if page is None:
+            self.pages[key] = array('H', (offset,))
+        elif type(page) is bytearray:
+            bit = 1 << (offset & 7)
+            if page[offset >> 3] & bit:
+                return
+            page[offset >> 3] |= bit
+        else:
+            i = bisect_left(page, offset)
+            if i < len(page) and page[i] == offset:
+                return
+            if len(page) < ARRAY_LIMIT:
+                page.insert(i, offset)
+            else:
+                page = self.pages[key] = to_bitmap(page)
+                page[offset >> 3] |= 1 << (offset & 7)
+        self.count += 1
+
+    def update(self, ids):
+        for element_id in ids:
+            self.add(element_id)
+
+    def __contains__(self, element_id):
+        page = self.pages.get(element_id >> PAGE_SHIFT)
+        if page is None:
+            return False
+        offset = element_id & PAGE_MASK
+        if type(page) is bytearray:
+            return bool(page[offset >> 3] & (1 << (offset & 7)))
+        i = bisect_left(page, offset)
+        return i < len(page) and page[i] == offset
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        """Return the bytes used by the page contents"""
+        return sum(len(page) if type(page) is bytearray else len(page) * page.itemsize
+                   for page in self.pages.values())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Counters, stage timers, progress reporting and profiling hooks for data.process_map.
+
+data.write_elements used to report progress with a "validating 100x...th element" print, and
+the postcode cleaner printed every postcode it saw.  Instead, write_elements now records
+in a Metrics object:
+
+- the number of elements and the seconds spent in each stage (parse, shape, validate, check,
+  write) per element type.  check is the way node check, geometry and tag statistics of
+  refcheck.py, geometry.py and tagstats.py, and relation members count as write because the
+  outputs stream them
+- the bytes consumed from the input, from which a progress line with the MB/s, elements/sec,
+  percentage and ETA is logged at INFO level every interval seconds
+
+summary() returns all of it as a dict that data.py --metrics PATH saves as JSON.  A
+ShapeProfiler can be attached to run data.shape_rows (the shaper the pipeline uses, see
+shape_element) under cProfile for every element, or only for every Nth one to sample a large
+file cheaply; the stats are saved for pstats/snakeviz.
+
+Diagnostics go through the logging module, so they cost a level check when disabled.
+"""
+import cProfile
+import logging
+from timeit import default_timer as timer
+
+log = logging.getLogger(__name__)
+
+STAGES = ('parse', 'shape', 'validate', 'check', 'write')
+TAGS = ('node', 'way', 'relation')
+#seconds between progress lines
+PROGRESS_INTERVAL = 10.0
+#elements between checks of the clock for a progress line
+PROGRESS_EVERY = 1024
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class ShapeProfiler(object):
+    """Runs a shaper under cProfile for every `every`th call and saves the stats to path"""
+
+    def __init__(self, path, every=1):
+        self.path = path
+        self.every = max(1, every)
+        self.calls = 0
+        self.profiled = 0
+        self.profile = cProfile.Profile()
+
+    def wrap(self, shape):
+        def profiled(element):
+            self.calls += 1
+            if self.calls % self.every:
+                return shape(element)
+            self.profiled += 1
+            return self.profile.runcall(shape, element)
+        return profiled
+
+    def save(self):
+        self.profile.dump_stats(self.path)
+        log.info('saved the shaping profile of %d of %d elements to %s', self.profiled, self.calls, self.path)
+
+
+class Metrics(object):
+    """Element counts and stage seconds per element type, with periodic progress logging
+
+    position is a function returning the bytes of the input consumed so far (None if it cannot
+    be told) and total_bytes the size of the input, for the percentage and ETA.
+    """
+
+    def __init__(self, total_bytes=None, position=None, interval=PROGRESS_INTERVAL, profiler=None):
+        self.total_bytes = total_bytes
+        self.position = position
+        self.interval = interval
+        self.profiler = profiler
+        self.counts = dict.fromkeys(TAGS, 0)
+        self.seconds = dict((tag, [0.0] * len(STAGES)) for tag in TAGS)
+        self.bytes_done = 0
+        self.start = timer()
+        self.last_report = self.start
+        self.pending = PROGRESS_EVERY
+
+    def shaper(self, shape):
+        """Return shape, wrapped by the profiler if there is one"""
+        return self.profiler.wrap(shape) if self.profiler is not None else shape
+
+    def add(self, tag, parse, shape, validate, check, write):
+        """Count one element of type tag and the seconds of each of its stages"""
+        self.counts[tag] += 1
+        seconds = self.seconds[tag]
+        seconds[0] += parse
+        seconds[1] += shape
+        seconds[2] += validate
+        seconds[3] += check
+        seconds[4] += write
+        self.pending -= 1
+        if not self.pending:
+            self.pending = PROGRESS_EVERY
+            if self.position is not None:
+                self.bytes_done = self.position()
+            self.maybe_report()
+
+    def merge(self, exported):
+        """Add the counts and seconds of another run, e.g. a shard shaped by a worker process"""
+        for tag in TAGS:
+            self.counts[tag] += exported['counts'][tag]
+            self.seconds[tag] = [a + b for a, b in zip(self.seconds[tag], exported['seconds'][tag])]
+
+    def export(self):
+        return {'counts': self.counts, 'seconds': self.seconds}
+
+    def maybe_report(self, bytes_done=None):
+        if bytes_done is not None:
+            self.bytes_done = bytes_done
+        now = timer()
+        if self.interval and now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now):
+        if not log.isEnabledFor(logging.INFO):
+            return
+        elapsed = now - self.start
+        elements = sum(self.counts.values())
+        line = '{0} elements, {1:.1f} MB, {2:.0f} elements/sec, {3:.2f} MB/s'.format(
+            elements, self.bytes_done / 1e6, elements / elapsed, self.bytes_done / 1e6 / elapsed)
+        if self.total_bytes and self.bytes_done:
+            fraction = min(1.0, float(self.bytes_done) / self.total_bytes)
+            line += ', {0:.1f}% ETA {1}'.format(100 * fraction, format_duration(elapsed / fraction - elapsed))
+        log.info(line)
+
+    def summary(self):
+        """Return the counts, stage seconds and throughput of the run as a JSON-ready dict"""
+        elapsed = timer() - self.start
+        elements = sum(self.counts.values())
+        stages = dict((stage, round(sum(self.seconds[tag][i] for tag in TAGS), 4))
+                      for i, stage in enumerate(STAGES))
+        return {'elapsed_seconds': round(elapsed, 4),
+                'elements': dict(self.counts),
+                'elements_per_sec': round(elements / elapsed, 1) if elapsed else None,
+                'input_bytes': self.total_bytes,
+                'bytes_per_sec': round(self.total_bytes / elapsed, 1) if self.total_bytes and elapsed else None,
+                'stage_seconds': stages,
+                'stage_seconds_by_type': dict((tag, dict((stage, round(value, 4)) for stage, value in
+                                                         zip(STAGES, self.seconds[tag])))
+                                              for tag in TAGS if self.counts[tag])}
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.save()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memoized normalization of street names and postcodes.
+
+A metro extract has millions of addr:street and addr:postcode tags but only a few thousand
+distinct values, and every one of them used to go through the street type regexes and
+non_decimal.sub again.  NormalizationCache keeps, per kind of value, the cleaned value and
+the audit classification of each raw value it has seen, so the cleaning work is done once per
+distinct value.
+
+Each kind has a bounded cache made of two generations: lookups are served from the newer one
+and a hit in the older one is promoted.  When the newer generation fills up the older one is
+dropped, so the values that have not been used for the longest time are the ones evicted, at
+the cost of one dict lookup per hit instead of relinking an ordered dict.
+
+The cache can be saved to a JSON file and loaded by the next run.  Entries read from the file
+are handed back with a restored flag the first time they are used, so the caller can replay the
+audit side effects (e.g. recording a postcode change) that a cache hit would otherwise skip.
+The file records a signature of the cleaning rules and is ignored if the rules have changed.
+"""
+import json
+import os
+
+#number of raw values kept per kind
+DEFAULT_SIZE = 50000
+
+
+class GenerationCache(object):
+    """Bounded approximate LRU cache of raw value -> (cleaned, classification)"""
+
+    def __init__(self, maxsize=DEFAULT_SIZE):
+        self.limit = max(1, maxsize // 2)
+        self.new = {}
+        self.old = {}
+
+    def get(self, raw):
+        entry = self.new.get(raw)
+        if entry is None:
+            entry = self.old.pop(raw, None)
+            if entry is not None:
+                self.put(raw, entry)
+        return entry
+
+    def put(self, raw, entry):
+        if len(self.new) >= self.limit:
+            self.old = self.new
+            self.new = {}
+        self.new[raw] = entry
+
+    def items(self):
+        merged = dict(self.old)
+        merged.update(self.new)
+        return merged.items()
+
+    def __len__(self):
+        return len(self.new) + len(self.old)
+
+
+class NormalizationCache(object):
+    """Per kind caches of cleaned values and audit classifications, with hit/miss counters"""
+
+    def __init__(self, maxsize=DEFAULT_SIZE, signature=None):
+        self.maxsize = maxsize
+        self.signature = signature
+        self.caches = {}
+        self.restored = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, raw):
+        """Return (cleaned, classification, restored) for raw, or None if it has to be cleaned"""
+        cache = self.caches.get(kind)
+        entry = cache.get(raw) if cache is not None else None
+        if entry is not None:
+            self.hits += 1
+            return entry
+        restored = self.restored.get(kind)
+        if restored:
+            entry = restored.pop(raw, None)
+            if entry is not None:
+                self.hits += 1
+                self.put(kind, raw, entry[0], entry[1])
+                return entry[0], entry[1], True
+        self.misses += 1
+        return None
+
+    def put(self, kind, raw, cleaned, classification=None):
+        cache = self.caches.get(kind)
+        if cache is None:
+            cache = self.caches[kind] = GenerationCache(self.maxsize)
+        cache.put(raw, (cleaned, classification, False))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(float(self.hits) / lookups, 4) if lookups else 0.0,
+                'size': sum(len(cache) for cache in self.caches.values())}
+
+    def export(self):
+        """Return {kind: [[raw, cleaned, classification], ...]} for every cached value"""
+        entries = {}
+        for kind, restored in self.restored.items():
+            entries[kind] = [[raw, entry[0], entry[1]] for raw, entry in restored.items()]
+        for kind, cache in self.caches.items():
+            entries.setdefault(kind, []).extend(
+                [raw, entry[0], entry[1]] for raw, entry in cache.items())
+        return entries
+
+    def update(self, entries):
+        """Add exported entries (e.g. from a worker process) that are not cached yet"""
+        for kind, rows in entries.items():
+            cache = self.caches.get(kind)
+            for raw, cleaned, classification in rows:
+                if cache is None or cache.get(raw) is None:
+                    self.put(kind, raw, cleaned, classification)
+                    cache = self.caches[kind]
+
+    def save(self, path):
+        with open(path, 'w') as cache_file:
+            json.dump({'signature': self.signature, 'entries': self.export()}, cache_file)
+
+    def load(self, path):
+        """Load the entries saved by a previous run, if its cleaning rules were the same"""
+        if not os.path.exists(path):
+            return False
+        with open(path) as cache_file:
+            saved = json.load(cache_file)
+        if saved.get('signature') != self.signature:
+            return False
+        for kind, rows in saved['entries'].items():
+            self.restored[kind] = dict((raw, (cleaned, classification))
+                                       for raw, cleaned, classification in rows[-self.maxsize:])
+        return True
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental update of a SQLite database loaded by sqlite_loader.py from an osmChange diff.
+
+Refreshing the database used to mean running data.process_map over the whole extract again.
+An osmChange (.osc, .osc.gz or .osc.bz2) file lists only the elements created, modified and deleted
+since the extract was made, in <create>, <modify> and <delete> blocks.  Each changed element
+is shaped with data.shape_rows, so the same street name and postcode cleaning is applied (pass
+the --street-rules file of the load again), and validated like a full load.  Then its rows are
+replaced in the database:
+
+- create/modify: the element row and its tag/way node/member rows are deleted and inserted
+  again, so a modify of an element that is not in the database yet becomes an insert
+- delete: the element row and its child rows are deleted
+
+The version attribute is compared with the version already stored for the element, and changes
+that are not newer (e.g. a diff that is applied twice, or overlapping diffs) are skipped and
+counted as stale, as are deletes of elements that are not in the database.  All of the
+changes of a file are applied in one transaction, so a failed update leaves the database as
+it was.
+
+If the database has the R*Tree index of spatial.py, the entries of the changed nodes are
+replaced, and the boxes of the changed ways and of the ways that use a changed node are
+recomputed, in the same transaction.  The summary tables of analytics.py are updated in it too:
+the rows of a changed element are subtracted before they are replaced and added again after,
+and the database generation is bumped so saved analytics results are not served any more.
+
+Usage:
+    python osc_update.py map.db changes.osc.gz
+"""
+import argparse
+import pprint
+import sqlite3
+
+import analytics
+import compressed
+import data
+import spatial
+import sqlite_loader
+import street_rules
+from compat import ET
+
+ACTIONS = ('create', 'modify', 'delete')
+#element table and child tables of each element type
+ELEMENT_TABLES = {'node': ('nodes', ('nodes_tags',)),
+                  'way': ('ways', ('ways_nodes', 'ways_tags')),
+                  'relation': ('relations', ('relations_members', 'relations_tags'))}
+#(shaped table, database table) in insert order, relation members before the relation tags
+SHAPED_TABLES = [('node', 'nodes'), ('node_tags', 'nodes_tags'), ('way', 'ways'), ('way_nodes', 'ways_nodes'),
+                 ('way_tags', 'ways_tags'), ('relation', 'relations'), ('relation_members', 'relations_members'),
+                 ('relation_tags', 'relations_tags')]
+
+
+def iter_changes(osc_file):
+    """Yield (action, element) for each element of an osmChange file, in file order"""
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    block = None
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ACTIONS:
+                block = elem
+        elif elem.tag in ELEMENT_TABLES and block is not None:
+            yield block.tag, elem
+            block.clear()
+        elif elem.tag in ACTIONS:
+            block = None
+            root.clear()
+
+
+class ChangeApplier(object):
+    """Applies shaped changes to an open connection, counting them per element type and action"""
+
+    def __init__(self, conn, validate=True, use_cerberus=False):
+        self.conn = conn
+        self.validate = validate
+        self.use_cerberus = use_cerberus
+        self.validator = data.make_validator(use_cerberus)
+        self.fields = dict((name, fields) for name, fields, create in sqlite_loader.TABLES)
+        self.inserts = dict((name, 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            name, ', '.join(fields), ', '.join('?' * len(fields)))) for name, fields, create in sqlite_loader.TABLES)
+        self.counts = dict((tag, dict((action, 0) for action in ACTIONS)) for tag in ELEMENT_TABLES)
+        self.counts['stale'] = 0
+        #ids of the applied changes, for the spatial index
+        self.changed = dict((tag, set()) for tag in ELEMENT_TABLES)
+        self.summaries = analytics.has_summaries(conn)
+
+    def current_version(self, tag, element_id):
+        row = self.conn.execute('SELECT version FROM {0} WHERE id = ?'.format(ELEMENT_TABLES[tag][0]),
+                                (element_id,)).fetchone()
+        return int(row[0]) if row is not None else None
+
+    def delete(self, tag, element_id):
+        table, child_tables = ELEMENT_TABLES[tag]
+        for name in child_tables + (table,):
+            self.conn.execute('DELETE FROM {0} WHERE id = ?'.format(name), (element_id,))
+
+    def insert(self, tag, el):
+        """Insert the rows of an element shaped by data.shape_rows, validating them if asked"""
+        if self.validate:
+            if tag == 'relation':
+                data.validate_element({'relation': el['relation']}, self.validator)
+                el['relation_members'] = data.validate_members(el['relation_members'], el['relation_tags'],
+                                                               self.validator, self.use_cerberus)
+            else:
+                data.validate_element(data.rows_as_dicts(el) if self.use_cerberus else el, self.validator)
+        for shaped, name in SHAPED_TABLES:
+            if shaped not in el:
+                continue
+            rows = el[shaped]
+            if isinstance(rows, tuple):
+                #the node, way or relation record
+                rows = [rows]
+            self.conn.executemany(self.inserts[name], rows)
+
+    def apply(self, action, element):
+        tag = element.tag
+        element_id = int(element.get('id'))
+        current = self.current_version(tag, element_id)
+        if current is None and action == 'delete' or current is not None and current >= int(element.get('version')):
+            self.counts['stale'] += 1
+            return
+        if current is not None:
+            if self.summaries:
+                analytics.count_element(self.conn, tag, element_id, -1)
+            self.delete(tag, element_id)
+        if action != 'delete':
+            self.insert(tag, data.shape_rows(element))
+            if self.summaries:
+                analytics.count_element(self.conn, tag, element_id, 1)
+        self.counts[tag][action] += 1
+        self.changed[tag].add(element_id)
+
+    def update_spatial_index(self):
+        """Bring the R*Tree entries of the changed nodes and ways, if there is an index, up to date"""
+        if not spatial.has_index(self.conn):
+            return
+        node_ids = self.changed['node']
+        way_ids = set(self.changed['way'])
+        for node_id in node_ids:
+            way_ids.update(row[0] for row in self.conn.execute(
+                'SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?', (node_id,)))
+        spatial.update_nodes(self.conn, node_ids)
+        spatial.update_ways(self.conn, way_ids)
+
+
+def apply_changes(db_path, osc_path, validate=True, use_cerberus=False):
+    """Apply the osmChange file at osc_path to the database at db_path in one transaction
+
+    Returns the number of changes applied per element type and action, and the stale count.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            applier = ChangeApplier(conn, validate, use_cerberus)
+            with compressed.open_input(osc_path) as osc_file:
+                for action, element in iter_changes(osc_file):
+                    applier.apply(action, element)
+            applier.update_spatial_index()
+            if applier.summaries:
+                analytics.changes_applied(conn, sum(len(ids) for ids in applier.changed.values()))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return applier.counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply an osmChange diff to a database loaded by data.py --sqlite')
+    parser.add_argument('db', help='SQLite database to update')
+    parser.add_argument('osc_file', help='.osc change file, optionally .gz/.bz2/.zst compressed')
+    parser.add_argument('--no-validate', dest='validate', action='store_false',
+                        help='skip schema validation of the shaped elements')
+    parser.add_argument('--cerberus', dest='use_cerberus', action='store_true',
+                        help='validate with cerberus instead of the compiled schema validator')
+    parser.add_argument('--street-rules', metavar='PATH', dest='street_rules_path',
+                        help='clean the addr:street values with these street rules, as data.py --street-rules did')
+    args = parser.parse_args()
+    if args.street_rules_path:
+        data.use_street_rules(street_rules.load(args.street_rules_path))
+    pprint.pprint(apply_changes(args.db, args.osc_file, args.validate, args.use_cerberus))
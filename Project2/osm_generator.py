@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deterministic generator of synthetic OSM XML files for benchmarks.
+
+The only sample in the repository is a few bytes long, so it cannot show how the pipeline
+scales.  generate() writes an .osm file of any size that looks like a city extract:
+
+- nodes with increasing ids and coordinates in the New Orleans area
+- ways of 2 to MAX_WAY_NODES nodes that are close in id order, like a real extract, about
+  CLOSED_WAYS of them closed into rings, plus a few refs to nodes that are not in the file
+- relations whose members are ways and nodes
+- tags drawn from a weighted key distribution, 0 to 2x the mean count per element
+- exactly messy_streets addr:street values with abbreviated street types (St, Ave, Blvd, ...)
+  and exactly messy_postcodes addr:postcode values that need cleaning (70113-1234, LA 70119),
+  placed on random elements (postcodes on nodes, which is where data.py cleans them)
+
+The same seed and settings always give a byte-identical file.
+
+Usage:
+    python osm_generator.py synthetic.osm --nodes 100000 --ways 20000 --messy-streets 500
+"""
+import argparse
+import random
+from bisect import bisect_right
+from xml.sax.saxutils import quoteattr
+
+from compat import open_text_output
+
+#tag key -> relative weight, for the tags that are not messy address values
+KEY_WEIGHTS = {'highway': 20, 'name': 15, 'building': 15, 'source': 10, 'amenity': 5, 'addr:housenumber': 8,
+               'addr:street': 8, 'addr:postcode': 6, 'addr:city': 4, 'tiger:county': 4, 'tiger:cfcc': 3,
+               'building:levels': 2, 'surface': 3, 'oneway': 3, 'created_by': 2}
+#values of the keys that need realistic ones, the others get a numbered value
+VALUES = {'highway': ['residential', 'service', 'footway', 'primary', 'secondary', 'tertiary'],
+          'building': ['yes', 'house', 'commercial', 'church'],
+          'amenity': ['restaurant', 'fast_food', 'school', 'place_of_worship', 'parking'],
+          'addr:city': ['New Orleans', 'Metairie', 'Kenner'],
+          'tiger:county': ['Orleans, LA', 'Jefferson, LA'],
+          'surface': ['asphalt', 'concrete', 'paved'],
+          'oneway': ['yes', 'no']}
+STREET_NAMES = ['Canal', 'Magazine', 'Saint Charles', 'Airline', 'River', 'Esplanade', 'Tchoupitoulas',
+                'Claiborne', 'Carrollton', 'Napoleon', 'Elysian Fields', 'Gentilly', 'Freret', 'Prytania',
+                'Burgundy', 'Chartres', 'Decatur', 'Royal', 'Dauphine', 'Rampart']
+CLEAN_TYPES = ['Street', 'Avenue', 'Boulevard', 'Drive', 'Road', 'Highway', 'Lane', 'Court']
+MESSY_TYPES = ['St', 'St.', 'Ave', 'Ave.', 'Blvd', 'Hwy', 'Rd', 'Lp', 'street', 'ave']
+MESSY_POSTCODES = ['{0}-{1:04d}', 'LA {0}', 'LA {0}-{1:04d}', '{0} {1:04d}']
+USERS = 500
+BBOX = (29.85, -90.25, 30.10, -89.90)
+MAX_WAY_NODES = 12
+CLOSED_WAYS = 0.2
+DANGLING_REFS = 0.001
+MEMBERS_PER_RELATION = 20
+TIMESTAMP = '2017-{0:02d}-{1:02d}T{2:02d}:{3:02d}:00Z'
+
+
+def weighted_keys(key_weights):
+    """Return (keys, cumulative weights) for a key -> weight dict, in a stable order"""
+    keys = sorted(key_weights)
+    cumulative = []
+    total = 0
+    for key in keys:
+        total += key_weights[key]
+        cumulative.append(total)
+    return keys, cumulative
+
+
+class TagMaker(object):
+    """Draws the tags of one element from a weighted key distribution"""
+
+    def __init__(self, rand, key_weights):
+        self.rand = rand
+        self.keys, self.cumulative = weighted_keys(key_weights)
+
+    def key(self):
+        point = self.rand.random() * self.cumulative[-1]
+        return self.keys[min(bisect_right(self.cumulative, point), len(self.keys) - 1)]
+
+    def value(self, key):
+        rand = self.rand
+        if key == 'addr:street':
+            return '{0} {1}'.format(rand.choice(STREET_NAMES), rand.choice(CLEAN_TYPES))
+        if key == 'addr:postcode':
+            return str(rand.randint(70001, 70190))
+        if key in VALUES:
+            return rand.choice(VALUES[key])
+        return '{0} {1}'.format(key.split(':')[-1], rand.randint(1, 1000))
+
+    def tags(self, mean):
+        """Return a list of (k, v) with 0 to 2 * mean distinct keys"""
+        count = self.rand.randint(0, int(round(2 * mean)))
+        tags = {}
+        for _ in range(count):
+            key = self.key()
+            tags[key] = self.value(key)
+        return sorted(tags.items())
+
+
+def messy_street(rand):
+    return '{0} {1}'.format(rand.choice(STREET_NAMES), rand.choice(MESSY_TYPES))
+
+
+def messy_postcode(rand):
+    return rand.choice(MESSY_POSTCODES).format(rand.randint(70001, 70190), rand.randint(0, 9999))
+
+
+def write_start(out, tag, attrs, rand, element_id):
+    out.write('  <{0} id="{1}"{2} version="{3}" timestamp="{4}" changeset="{5}" uid="{6}" user="user_{6}"'.format(
+        tag, element_id, attrs, rand.randint(1, 9),
+        TIMESTAMP.format(rand.randint(1, 12), rand.randint(1, 28), rand.randint(0, 23), rand.randint(0, 59)),
+        rand.randint(1, 50000000), rand.randint(1, USERS)))
+
+
+def write_tags(out, tags):
+    for k, v in tags:
+        out.write('\n    <tag k={0} v={1}/>'.format(quoteattr(k), quoteattr(v)))
+
+
+def generate(out_file, nodes=10000, ways=2000, relations=20, node_tags=0.5, way_tags=2.0,
+             key_weights=None, messy_streets=100, messy_postcodes=100, seed=0):
+    """Write a synthetic OSM XML document to the open file out_file
+
+    node_tags and way_tags are the mean number of tags per node and per way (relations use
+    way_tags), drawn from key_weights (KEY_WEIGHTS by default).  Returns the element counts.
+    """
+    rand = random.Random(seed)
+    maker = TagMaker(rand, key_weights or KEY_WEIGHTS)
+    #the elements that get a messy value, by position in the file
+    elements = nodes + ways + relations
+    street_at = set(rand.sample(range(elements), min(messy_streets, elements)))
+    postcode_at = set(rand.sample(range(nodes), min(messy_postcodes, nodes)))
+
+    out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="osm_generator.py">\n')
+    min_lat, min_lon, max_lat, max_lon = BBOX
+    position = 0
+    for node_id in range(1, nodes + 1):
+        write_start(out_file, 'node', ' lat="{0:.7f}" lon="{1:.7f}"'.format(
+            rand.uniform(min_lat, max_lat), rand.uniform(min_lon, max_lon)), rand, node_id)
+        tags = dict(maker.tags(node_tags))
+        if position in street_at:
+            tags['addr:street'] = messy_street(rand)
+        if position in postcode_at:
+            tags['addr:postcode'] = messy_postcode(rand)
+        position += 1
+        if tags:
+            out_file.write('>')
+            write_tags(out_file, sorted(tags.items()))
+            out_file.write('\n  </node>\n')
+        else:
+            out_file.write('/>\n')
+
+    first_way = nodes + 1
+    for way_id in range(first_way, first_way + ways):
+        write_start(out_file, 'way', '', rand, way_id)
+        out_file.write('>')
+        start = rand.randint(1, max(1, nodes - 3 * MAX_WAY_NODES))
+        refs = [min(nodes, start + i * rand.randint(1, 3)) for i in range(rand.randint(2, MAX_WAY_NODES))]
+        if rand.random() < DANGLING_REFS:
+            refs[-1] = nodes + ways + relations + rand.randint(1, 1000)
+        if len(refs) >= 3 and rand.random() < CLOSED_WAYS:
+            refs.append(refs[0])
+        for ref in refs:
+            out_file.write('\n    <nd ref="{0}"/>'.format(ref))
+        tags = dict(maker.tags(way_tags))
+        if position in street_at:
+            tags['addr:street'] = messy_street(rand)
+        position += 1
+        write_tags(out_file, sorted(tags.items()))
+        out_file.write('\n  </way>\n')
+
+    first_relation = first_way + ways
+    for relation_id in range(first_relation, first_relation + relations):
+        write_start(out_file, 'relation', '', rand, relation_id)
+        out_file.write('>')
+        for _ in range(rand.randint(1, 2 * MEMBERS_PER_RELATION)):
+            if ways and rand.random() < 0.8:
+                member, ref = 'way', rand.randint(first_way, first_way + ways - 1)
+            else:
+                member, ref = 'node', rand.randint(1, max(1, nodes))
+            out_file.write('\n    <member type="{0}" ref="{1}" role="{2}"/>'.format(
+                member, ref, rand.choice(['outer', 'inner', ''])))
+        tags = dict(maker.tags(way_tags))
+        tags['type'] = rand.choice(['multipolygon', 'route'])
+        if position in street_at:
+            tags['addr:street'] = messy_street(rand)
+        position += 1
+        write_tags(out_file, sorted(tags.items()))
+        out_file.write('\n  </relation>\n')
+    out_file.write('</osm>\n')
+    return {'nodes': nodes, 'ways': ways, 'relations': relations,
+            'messy_streets': len(street_at), 'messy_postcodes': len(postcode_at)}
+
+
+def parse_weight(text):
+    key, equals, weight = text.rpartition('=')
+    if not equals or not key:
+        raise argparse.ArgumentTypeError('expected KEY=WEIGHT, got {0!r}'.format(text))
+    return key, float(weight)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a deterministic synthetic OSM XML file')
+    parser.add_argument('out_file', help='.osm file to write')
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--ways', type=int, default=2000)
+    parser.add_argument('--relations', type=int, default=20)
+    parser.add_argument('--node-tags', type=float, default=0.5, help='mean number of tags per node')
+    parser.add_argument('--way-tags', type=float, default=2.0, help='mean number of tags per way and relation')
+    parser.add_argument('--key-weight', type=parse_weight, action='append', default=[], metavar='KEY=WEIGHT',
+                        help='set the weight of a tag key in the key distribution (0 removes it), repeatable')
+    parser.add_argument('--messy-streets', type=int, default=100, help='number of abbreviated addr:street values')
+    parser.add_argument('--messy-postcodes', type=int, default=100, help='number of addr:postcode values to clean')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    weights = dict(KEY_WEIGHTS)
+    weights.update(args.key_weight)
+    weights = dict((key, weight) for key, weight in weights.items() if weight > 0)
+    with open_text_output(args.out_file) as out:
+        print(generate(out, args.nodes, args.ways, args.relations, args.node_tags, args.way_tags, weights,
+                       args.messy_streets, args.messy_postcodes, args.seed))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Shared reader for the top level elements of an OSM XML file, with selectable parser backends.
+
+Every script used to carry its own copy of get_element built on cElementTree.iterparse.  They
+now all call osm_reader.get_element, which yields the top level node/way/relation elements of
+a file (a path or a file-like object) using one of these backends:
+
+- "etree": xml.etree.cElementTree.iterparse, clearing the root after each element.  This is
+           what the scripts always used and stays the default.
+- "lxml":  lxml.etree.iterparse with tag= filtering, so only the wanted elements are reported,
+           and elem.clear() plus deleting the already processed siblings to keep memory flat.
+           Needs the optional lxml package.
+- "expat": a pyexpat streaming parser that never builds Element objects.  It yields
+           OsmElement records: a tag, an attrib dict and a list of child records, which
+           support the parts of the Element API the scripts use (get, iteration, iter).
+
+All backends yield objects with the same .tag/.attrib/.get()/iteration behaviour, so
+shape_element, shape_rows and the audit collectors work unchanged with any of them.
+data.py asks the etree backend to stream the children of relations, see get_element.
+tostring() serializes either kind back to XML for osm_sampler.py.
+
+.osm.pbf files are read by pbf_reader.py, which yields OsmElement records too.  It is picked
+automatically for paths ending in .pbf, or with the "pbf" backend for file-like objects.
+Paths ending in .gz, .bz2 or .zst are decompressed on the fly, see compressed.py.
+
+bench_reader.py reports the elements/sec of each backend on a given file.
+"""
+from xml.parsers import expat
+
+import compressed
+from compat import ET, string_types
+
+BACKENDS = ('etree', 'lxml', 'expat', 'pbf')
+DEFAULT_BACKEND = 'etree'
+
+#bytes read from the input per expat feed
+READ_SIZE = 1 << 16
+
+
+class OsmElement(object):
+    """Lightweight stand-in for an Element: a tag, its attributes and its child records"""
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib, children=()):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = children
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def items(self):
+        return self.attrib.items()
+
+    def keys(self):
+        return self.attrib.keys()
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def iter(self, tag=None):
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self.children:
+            for descendant in child.iter(tag):
+                yield descendant
+
+    def __repr__(self):
+        return '<OsmElement {0} {1}>'.format(self.tag, self.attrib.get('id', ''))
+
+
+# ================================================== #
+#               Backends                             #
+# ================================================== #
+#Uses code that ensures the elements are not stored in memory
+#Reference: https://discussions.udacity.com/t/lingering-questions-as-i-head-into-sql-portion-of-p3/237251/27
+def iter_etree(osm_file, tags, stream=()):
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in stream and elem.tag in tags:
+                children = stream_children(context, elem)
+                yield OsmElement(elem.tag, dict(elem.attrib), children)
+                for child in children:
+                    pass
+                root.clear()
+        elif elem.tag in tags:
+            yield elem
+            root.clear()
+
+
+#yields each child of parent as soon as it has been parsed and then drops it, so a relation
+#with tens of thousands of members never has them all in memory
+def stream_children(context, parent):
+    for event, child in context:
+        if event == 'end':
+            if child is parent:
+                return
+            yield child
+            parent.clear()
+
+
+def iter_lxml(osm_file, tags, stream=()):
+    try:
+        from lxml import etree
+    except ImportError:
+        raise ImportError('The "lxml" backend needs the lxml package (pip install lxml)')
+    for event, elem in etree.iterparse(osm_file, events=('end',), tag=tags):
+        yield elem
+        elem.clear()
+        parent = elem.getparent()
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+class ExpatHandler(object):
+    """pyexpat callbacks that collect the wanted top level elements as OsmElement records"""
+
+    def __init__(self, tags):
+        self.tags = frozenset(tags)
+        self.depth = 0
+        self.current = None
+        self.done = []
+
+    def start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 2:
+            if name in self.tags:
+                self.current = OsmElement(name, attrs, [])
+        elif self.depth == 3 and self.current is not None:
+            self.current.children.append(OsmElement(name, attrs))
+
+    def end(self, name):
+        if self.depth == 2 and self.current is not None:
+            self.done.append(self.current)
+            self.current = None
+        self.depth -= 1
+
+
+def iter_expat(osm_file, tags, stream=()):
+    handler = ExpatHandler(tags)
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.buffer_text = True
+
+    opened = not hasattr(osm_file, 'read')
+    source = open(osm_file, 'rb') if opened else osm_file
+    try:
+        while True:
+            data = source.read(READ_SIZE)
+            parser.Parse(data, not data)
+            if handler.done:
+                for element in handler.done:
+                    yield element
+                del handler.done[:]
+            if not data:
+                break
+    finally:
+        if opened:
+            source.close()
+
+
+def iter_pbf(osm_file, tags, stream=()):
+    import pbf_reader  # imported here because pbf_reader imports this module
+    return pbf_reader.get_element(osm_file, tags)
+
+
+ITERATORS = {'etree': iter_etree, 'lxml': iter_lxml, 'expat': iter_expat, 'pbf': iter_pbf}
+
+
+#runs iterator over a compressed file, decompressed in a background thread
+def iter_compressed(osm_file, iterator, tags, stream):
+    with compressed.open_input(osm_file) as source:
+        for element in iterator(source, tags, stream):
+            yield element
+
+
+# ================================================== #
+#               Reader API                           #
+# ================================================== #
+#True if osm_file is the path of a PBF file rather than OSM XML
+def is_pbf(osm_file):
+    return isinstance(osm_file, string_types) and osm_file.lower().endswith('.pbf')
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=DEFAULT_BACKEND, stream=()):
+    """Yield element if it is the right type of tag, parsed with the given backend
+
+    Paths ending in .pbf are always read with the pbf backend, and .gz/.bz2/.zst paths are
+    decompressed in a background thread as they are parsed.  With the etree backend the
+    elements whose tag is in stream are yielded as soon as their start tag is parsed, with
+    children that are parsed while they are iterated and can only be iterated once.  The other
+    backends ignore stream.
+    """
+    if is_pbf(osm_file):
+        backend = 'pbf'
+    try:
+        iterator = ITERATORS[backend]
+    except KeyError:
+        raise ValueError('Unknown parser backend {0!r}, expected one of {1}'.format(backend, ', '.join(BACKENDS)))
+    if compressed.compression_of(osm_file):
+        return iter_compressed(osm_file, iterator, tuple(tags), tuple(stream))
+    return iterator(osm_file, tuple(tags), tuple(stream))
+
+
+#quotes and escapes an attribute value the way ElementTree does
+def escape_attrib(value):
+    value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return u'"{0}"'.format(value.replace('"', '&quot;').replace('\n', '&#10;'))
+
+
+def tostring(element, encoding='utf-8'):
+    """Serialize an Element or OsmElement (and its children) to an XML string"""
+    if not isinstance(element, OsmElement):
+        return ET.tostring(element, encoding=encoding)
+    attrib = u''.join(u' {0}={1}'.format(k, escape_attrib(v)) for k, v in sorted(element.attrib.items()))
+    if not element.children:
+        xml = u'<{0}{1} />'.format(element.tag, attrib)
+    else:
+        children = u''.join(tostring(child, None) for child in element.children)
+        xml = u'<{0}{1}>{2}</{0}>'.format(element.tag, attrib, children)
+    return xml.encode(encoding) if encoding else xml
@@ -1,37 +1,184 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+"""
+Take a sample of an OSM file (.osm or .osm.pbf) for testing the audit and data scripts.
 
-import xml.etree.cElementTree as ET  # Use cElementTree or lxml if too slow
+The top level elements to keep are picked by one of:
+- every k-th element (the default, k = 10)
+- a random fraction of the elements (--fraction)
+- a random sample of a target number of elements (--size), drawn with reservoir sampling
 
-#OSM_FILE should be the file for input into the sampler script
-#OSM_FILE = "new-orleans_louisiana.osm"  
-OSM_FILE = "D:\\UdacityDAND\\Project2\\MapsDatabase\\new-orleans_louisiana.osm"  
+With --bbox only the nodes inside the bounding box, and the ways and relations with a member
+inside it, are candidates for the sample.
+
+A plain sample drops most of the nodes of the ways it keeps.  With --closed every node
+referenced by a kept way is written too, so the sample has no dangling way nodes.  Since the
+nodes come before the ways in the file, closed and --size samples take two passes: the first
+one records the ids to keep in IdBitmap sets (see idindex.py), the second one writes them.
+Other samples are written in a single pass.
+
+Usage:
+    python osm_sampler.py [osm_file] [sample_file] [-k K | --fraction F | --size N]
+                          [--bbox MINLAT MINLON MAXLAT MAXLON] [--closed] [--seed SEED]
+"""
+import argparse
+import itertools
+import random
+
+import osm_reader  # set BACKEND to "lxml" or "expat" if cElementTree is too slow
+from idindex import IdBitmap
+
+#OSM_FILE should be the file for input into the sampler script (.osm or .osm.pbf)
+#OSM_FILE = "new-orleans_louisiana.osm"
+OSM_FILE = "D:\\UdacityDAND\\Project2\\MapsDatabase\\new-orleans_louisiana.osm"
 #SAMPLE_FILE should be file intended as output from the sample script
 SAMPLE_FILE = "D:\\UdacityDAND\\Project2\\MapsDatabase\\new-orleans_louisiana_sample.osm"
 
 k = 10 # Parameter: take every k-th top level element
+BACKEND = osm_reader.DEFAULT_BACKEND # Parameter: XML parser backend, see osm_reader.py
+WRITE_BUFFER = 1 << 20 # Parameter: bytes buffered before writing to SAMPLE_FILE
+
+TAGS = ('node', 'way', 'relation')
+
+
+def get_element(osm_file, tags=TAGS, backend=BACKEND):
+    """Yield element if it is the right type of tag, parsed with the BACKEND parser"""
+    return osm_reader.get_element(osm_file, tags, backend)
+
+
+# ================================================== #
+#               Selection                            #
+# ================================================== #
+def in_bbox(element, bbox):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return (min_lat <= float(element.get('lat')) <= max_lat and
+            min_lon <= float(element.get('lon')) <= max_lon)
+
+
+class BboxFilter(object):
+    """Passes the nodes inside bbox and the ways/relations with a member that passed"""
+
+    def __init__(self, bbox):
+        self.bbox = bbox
+        self.inside = dict((tag, IdBitmap()) for tag in TAGS)
+
+    def __call__(self, element):
+        if element.tag == 'node':
+            hit = in_bbox(element, self.bbox)
+        elif element.tag == 'way':
+            nodes = self.inside['node']
+            hit = any(int(child.get('ref')) in nodes for child in element if child.tag == 'nd')
+        else:
+            hit = any(int(child.get('ref')) in self.inside[child.get('type')]
+                      for child in element if child.tag == 'member' and child.get('type') in self.inside)
+        if hit:
+            self.inside[element.tag].add(int(element.get('id')))
+        return hit
+
+
+#returns a function that says whether to keep the next candidate element
+def make_chooser(every=k, fraction=None, seed=0):
+    if fraction is not None:
+        rand = random.Random(seed)
+        return lambda: rand.random() < fraction
+    counter = itertools.count()
+    return lambda: next(counter) % every == 0
+
+
+def pick(elements, bbox_filter=None, choose=None):
+    """Yield the elements that pass bbox_filter and are chosen, both optional"""
+    for element in elements:
+        if bbox_filter is not None and not bbox_filter(element):
+            continue
+        if choose is None or choose():
+            yield element
+
+
+#the way refs of element if it is a way and the sample is closed
+def way_refs(element, closed):
+    if closed and element.tag == 'way':
+        return [int(child.get('ref')) for child in element if child.tag == 'nd']
+    return ()
+
+
+def select(elements, bbox_filter=None, choose=None, size=None, closed=False, seed=0):
+    """First pass: return {tag: IdBitmap} of the ids to write
+
+    With size the ids come from a reservoir sample of that many candidates, otherwise every
+    chosen candidate is kept.  If closed, the nodes of the kept ways are added as well.
+    """
+    keep = dict((tag, IdBitmap()) for tag in TAGS)
+    if size is None:
+        for element in pick(elements, bbox_filter, choose):
+            keep[element.tag].add(int(element.get('id')))
+            keep['node'].update(way_refs(element, closed))
+        return keep
+
+    rand = random.Random(seed)
+    reservoir = []
+    for seen, element in enumerate(pick(elements, bbox_filter)):
+        if seen < size:
+            reservoir.append((element.tag, int(element.get('id')), way_refs(element, closed)))
+        else:
+            #what randint(0, seen) does on Python 2; Python 3's randint draws differently, so
+            #the same seed would pick another sample there
+            slot = int(rand.random() * (seen + 1))
+            if slot < size:
+                reservoir[slot] = (element.tag, int(element.get('id')), way_refs(element, closed))
+    for tag, element_id, refs in reservoir:
+        keep[tag].add(element_id)
+        keep['node'].update(refs)
+    return keep
+
+
+# ================================================== #
+#               Output                               #
+# ================================================== #
+def write_sample(sample_file, elements):
+    """Stream elements to sample_file through a WRITE_BUFFER byte buffer, return counts per tag"""
+    counts = dict((tag, 0) for tag in TAGS)
+    with open(sample_file, 'wb', WRITE_BUFFER) as output:
+        output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write(b'<osm>\n  ')
+        for element in elements:
+            output.write(osm_reader.tostring(element, encoding='utf-8'))
+            counts[element.tag] += 1
+        output.write(b'</osm>')
+    return counts
+
+
+def sample(osm_file=OSM_FILE, sample_file=SAMPLE_FILE, every=k, fraction=None, size=None, bbox=None,
+           closed=False, seed=0, backend=BACKEND):
+    """Write a sample of osm_file to sample_file and return the number of elements written per tag
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
+    bbox is (min lat, min lon, max lat, max lon).  fraction and size samples are reproducible
+    for a given seed.
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    bbox_filter = BboxFilter(bbox) if bbox is not None else None
+    choose = make_chooser(every, fraction, seed) if size is None else None
+    if size is None and not closed:
+        return write_sample(sample_file, pick(get_element(osm_file, backend=backend), bbox_filter, choose))
 
-#Open output file and loop until we get to the end of the input file
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+    keep = select(get_element(osm_file, backend=backend), bbox_filter, choose, size, closed, seed)
+    return write_sample(sample_file, (element for element in get_element(osm_file, backend=backend)
+                                      if int(element.get('id')) in keep[element.tag]))
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
 
-    output.write('</osm>')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a sample of an OSM file')
+    parser.add_argument('osm_file', nargs='?', default=OSM_FILE, help='input .osm or .osm.pbf file')
+    parser.add_argument('sample_file', nargs='?', default=SAMPLE_FILE, help='output .osm file')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('-k', type=int, dest='every', default=k, help='take every k-th top level element')
+    mode.add_argument('--fraction', type=float, help='take this random fraction of the elements')
+    mode.add_argument('--size', type=int, help='take this many elements at random')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MINLAT', 'MINLON', 'MAXLAT', 'MAXLON'),
+                        help='only sample nodes inside this box and ways/relations with a member inside it')
+    parser.add_argument('--closed', action='store_true', help='also write every node of the sampled ways')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for --fraction and --size')
+    parser.add_argument('--backend', choices=osm_reader.BACKENDS, default=BACKEND,
+                        help='XML parser backend (.pbf input is always read with pbf)')
+    args = parser.parse_args()
 
+    print(sample(args.osm_file, args.sample_file, every=args.every, fraction=args.fraction, size=args.size,
+                 bbox=args.bbox, closed=args.closed, seed=args.seed, backend=args.backend))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write shaped OSM elements to one typed Parquet file per table.
+
+The csv files store every value as text, so pandas or the SQL import has to parse them all
+again, and repeated strings such as tag keys and user names are stored once per row.
+ParquetOutput buffers the rows of each table as columns and writes them out every
+ROW_GROUP_ROWS rows as one Parquet row group with real column types:
+
+- int64 ids, uids, changesets and member/node refs, int32 positions
+- float64 lat/lon
+- dictionary encoded user, key, type and role, which repeat a lot
+- plain strings for tag values, versions and timestamps (versions stay strings, as in schema.py)
+
+The values are converted column at a time by Arrow when a row group is written rather than
+one by one in Python.  The files are read back with pandas.read_parquet or pyarrow.parquet.
+
+Needs the optional pyarrow package (pip install pyarrow).
+
+Usage:
+    python data.py map.osm --parquet map_parquet
+"""
+import csv
+import os
+
+import data
+from compat import decode_row, open_text_input, string_types
+
+#rows per row group, and per flush of the column buffers
+ROW_GROUP_ROWS = 65536
+
+#column kind by column name
+COLUMN_KINDS = {'id': 'int64', 'node_id': 'int64', 'member_id': 'int64', 'uid': 'int64', 'changeset': 'int64',
+                'position': 'int32', 'lat': 'float64', 'lon': 'float64',
+                'user': 'dictionary', 'key': 'dictionary', 'type': 'dictionary', 'role': 'dictionary',
+                'value': 'string', 'version': 'string', 'timestamp': 'string'}
+
+#table name and column names of each table, in csv order
+TABLES = [(os.path.splitext(os.path.basename(path))[0], fields)
+          for path, fields in zip(data.CSV_PATHS, data.CSV_FIELDS)]
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet output needs the pyarrow package (pip install pyarrow)')
+    return pyarrow
+
+
+def arrow_type(pa, kind):
+    if kind == 'dictionary':
+        return pa.dictionary(pa.int32(), pa.string())
+    return getattr(pa, kind)()
+
+
+def to_arrow(pa, kind, values):
+    """Build a typed Arrow array of kind from a column buffer of str/unicode or numbers"""
+    if kind in ('string', 'dictionary'):
+        array = pa.array(values, type=pa.string())
+        return array.dictionary_encode() if kind == 'dictionary' else array
+    if values and isinstance(values[0], string_types):
+        return pa.array(values, type=pa.string()).cast(arrow_type(pa, kind))
+    return pa.array(values, type=arrow_type(pa, kind))
+
+
+class ParquetTable(object):
+    """Column buffers of one table, written to its Parquet file a row group at a time"""
+
+    def __init__(self, pa, path, fields, row_group_rows=ROW_GROUP_ROWS):
+        self.pa = pa
+        self.fields = fields
+        self.kinds = [COLUMN_KINDS[field] for field in fields]
+        self.columns = [[] for field in fields]
+        self.row_group_rows = row_group_rows
+        self.rows = 0
+        self.schema = pa.schema([pa.field(field, arrow_type(pa, kind), nullable=False)
+                                 for field, kind in zip(fields, self.kinds)])
+        self.writer = pa.parquet.ParquetWriter(path, self.schema)
+
+    def add_rows(self, rows):
+        """Buffer rows (sequences in column order), rows can be a generator"""
+        columns = self.columns
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+            self.rows += 1
+            if self.rows >= self.row_group_rows:
+                self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        pa = self.pa
+        arrays = [to_arrow(pa, kind, column) for kind, column in zip(self.kinds, self.columns)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema), row_group_size=self.rows)
+        for column in self.columns:
+            del column[:]
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ParquetOutput(object):
+    """Output for data.write_elements that writes each table to directory/<table>.parquet
+
+    Like the csv outputs, existing files in directory are replaced.
+    """
+
+    def __init__(self, directory, row_group_rows=ROW_GROUP_ROWS):
+        pa = import_pyarrow()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.tables = dict((name, ParquetTable(pa, os.path.join(directory, name + '.parquet'), fields,
+                                               row_group_rows))
+                           for name, fields in TABLES)
+
+    def write(self, tag, el):
+        tables = self.tables
+        if tag == 'node':
+            tables['nodes'].add_rows([el['node']])
+            tables['nodes_tags'].add_rows(el['node_tags'])
+        elif tag == 'way':
+            tables['ways'].add_rows([el['way']])
+            tables['ways_nodes'].add_rows(el['way_nodes'])
+            tables['ways_tags'].add_rows(el['way_tags'])
+        elif tag == 'relation':
+            tables['relations'].add_rows([el['relation']])
+            #members first, the tags are complete once they have been consumed
+            tables['relations_members'].add_rows(el['relation_members'])
+            tables['relations_tags'].add_rows(el['relation_tags'])
+
+    def load_csvs(self, paths):
+        """Load one set of headerless csv files (as written by data.CsvOutput) in table order"""
+        for (name, fields), path in zip(TABLES, paths):
+            with open_text_input(path) as csv_file:
+                self.tables[name].add_rows(decode_row(row) for row in csv.reader(csv_file))
+
+    def close(self):
+        if self.tables is None:
+            return
+        for table in self.tables.values():
+            table.close()
+        self.tables = None
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pure Python reader for OSM PBF (.osm.pbf) files.
+
+Extracts are distributed as PBF, which is roughly 10X smaller than the XML and does not need
+an XML parser at all.  This module decodes the format directly so that data.py, the audit
+scripts and osm_sampler.py can read .osm.pbf files without converting them to .osm first
+(osm_reader.get_element picks it for any path ending in .pbf).
+
+The file is a sequence of blobs, each preceded by a 4 byte length and a BlobHeader:
+- the "OSMHeader" blob lists the features needed to read the file, which are checked against
+  SUPPORTED_FEATURES
+- each "OSMData" blob holds a zlib compressed PrimitiveBlock: a string table plus groups of
+  nodes, dense nodes, ways and relations whose strings are indexes into the string table
+
+Dense nodes store ids, coordinates, timestamps, changesets, uids and user names as deltas from
+the previous node, and way refs and relation member ids are delta coded too.  The blobs are
+decompressed ahead of the decoder in a thread pool (zlib releases the GIL while it inflates).
+
+Elements are yielded as osm_reader.OsmElement records with the same attributes and tag/nd/member
+children as the XML, so the shaping and cleaning code does not know the difference.
+Coordinates are written with up to 7 decimals and no trailing zeros and timestamps as
+YYYY-MM-DDTHH:MM:SSZ, the way osmium writes them to XML.
+
+Reference: https://wiki.openstreetmap.org/wiki/PBF_Format
+"""
+import struct
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from compat import PY2
+from osm_reader import OsmElement
+
+#features of the OSMHeader block this reader can handle
+SUPPORTED_FEATURES = ('OsmSchema-V0.6', 'DenseNodes')
+#number of threads decompressing blobs ahead of the decoder
+DECOMPRESS_THREADS = 4
+#relation member type enum
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+
+# ================================================== #
+#               Protocol Buffers                     #
+# ================================================== #
+def read_varint(buf, pos):
+    """Return the varint in bytearray buf at pos and the position after it"""
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+#int32/int64 fields are written as unsigned 64 bit varints, negative values wrap around
+def signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+#sint32/sint64 fields are zigzag encoded
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def iter_fields(buf, pos, end):
+    """Yield (field number, value) for each field of the message in buf[pos:end]
+
+    Varint values are ints, length delimited values are (start, end) spans into buf.
+    """
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {0}'.format(wire_type))
+        yield key >> 3, value
+
+
+def unpack_varints(buf, span):
+    """Decode a packed repeated varint field"""
+    pos, end = span
+    values = []
+    append = values.append
+    while pos < end:
+        result = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+
+def unpack_deltas(buf, span):
+    """Decode a packed, delta coded sint32/sint64 field into absolute values"""
+    values = []
+    total = 0
+    for value in unpack_varints(buf, span):
+        total += (value >> 1) ^ -(value & 1)
+        values.append(total)
+    return values
+
+
+# ================================================== #
+#               Blobs                                #
+# ================================================== #
+def iter_blobs(osm_file, start=0, end=None):
+    """Yield (type, blob bytes) for each blob in osm_file from byte offset start up to end"""
+    opened = not hasattr(osm_file, 'read')
+    source = open(osm_file, 'rb') if opened else osm_file
+    try:
+        source.seek(start)
+        offset = start
+        while end is None or offset < end:
+            size = source.read(4)
+            if len(size) < 4:
+                return
+            header_size = struct.unpack('>I', size)[0]
+            header = bytearray(source.read(header_size))
+            blob_type, data_size = None, 0
+            for field, value in iter_fields(header, 0, len(header)):
+                if field == 1:
+                    blob_type = bytes(header[value[0]:value[1]]).decode('utf-8')
+                elif field == 3:
+                    data_size = value
+            yield blob_type, source.read(data_size)
+            offset += 4 + header_size + data_size
+    finally:
+        if opened:
+            source.close()
+
+
+def find_shards(osm_file, shards):
+    """Split osm_file at blob boundaries into at most shards (start, end) byte ranges"""
+    offsets = []
+    with open(osm_file, 'rb') as source:
+        offset = 0
+        while True:
+            size = source.read(4)
+            if len(size) < 4:
+                break
+            header_size = struct.unpack('>I', size)[0]
+            header = bytearray(source.read(header_size))
+            data_size = dict(iter_fields(header, 0, len(header))).get(3, 0)
+            offsets.append(offset)
+            source.seek(data_size, 1)
+            offset += 4 + header_size + data_size
+    if not offsets:
+        return []
+    step = max(1, -(-len(offsets) // shards))
+    starts = offsets[::step]
+    return list(zip(starts, starts[1:] + [offset]))
+
+
+def decode_blob(blob):
+    """Return the uncompressed contents of a Blob message"""
+    buf = bytearray(blob)
+    for field, value in iter_fields(buf, 0, len(buf)):
+        if field == 1:
+            return bytes(buf[value[0]:value[1]])
+        elif field == 3:
+            return zlib.decompress(bytes(buf[value[0]:value[1]]))
+        elif field in (4, 5, 6, 7):
+            raise ValueError('Unsupported PBF blob compression (field {0}), only raw and zlib are read'.format(field))
+    raise ValueError('PBF blob has no data')
+
+
+def check_header(data):
+    """Raise ValueError if the OSMHeader block needs a feature this reader does not support"""
+    buf = bytearray(data)
+    for field, value in iter_fields(buf, 0, len(buf)):
+        if field == 4:
+            feature = bytes(buf[value[0]:value[1]]).decode('utf-8')
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError('PBF file needs the unsupported feature {0!r}'.format(feature))
+
+
+def iter_blocks(osm_file, start=0, end=None, threads=DECOMPRESS_THREADS):
+    """Yield the decompressed PrimitiveBlock of each OSMData blob, in file order
+
+    Up to 2 blobs per thread are decompressed ahead of the consumer, so memory stays bounded.
+    """
+    pool = ThreadPool(threads) if threads > 1 else None
+    pending = deque()
+    try:
+        for blob_type, blob in iter_blobs(osm_file, start, end):
+            if blob_type == 'OSMHeader':
+                check_header(decode_blob(blob))
+            elif blob_type == 'OSMData':
+                if pool is None:
+                    yield decode_blob(blob)
+                    continue
+                pending.append(pool.apply_async(decode_blob, (blob,)))
+                if len(pending) >= threads * 2:
+                    yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+# ================================================== #
+#               Primitive Blocks                     #
+# ================================================== #
+#strings are kept as str when they are plain ascii, like cElementTree returns them on Python 2
+def to_text(value):
+    if not PY2:
+        return value.decode('utf-8')
+    try:
+        value.decode('ascii')
+        return value
+    except UnicodeDecodeError:
+        return value.decode('utf-8')
+
+
+def format_coordinate(nanodegrees):
+    """Format a coordinate with up to 7 decimals and no trailing zeros"""
+    units = nanodegrees // 100 if nanodegrees % 100 == 0 else int(round(nanodegrees / 100.0))
+    sign = '-' if units < 0 else ''
+    whole, fraction = divmod(abs(units), 10000000)
+    if fraction:
+        return '{0}{1}.{2}'.format(sign, whole, ('%07d' % fraction).rstrip('0'))
+    return '{0}{1}'.format(sign, whole)
+
+
+def format_timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+class Block(object):
+    """String table and coordinate/date scaling of one PrimitiveBlock"""
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        #the elements of a block usually share a handful of timestamps
+        self.timestamps = {}
+        for field, value in iter_fields(buf, 0, len(buf)):
+            if field == 1:
+                self.strings = [to_text(bytes(buf[s:e])) for number, (s, e) in iter_fields(buf, *value)
+                                if number == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+
+    def lat(self, value):
+        return format_coordinate(self.lat_offset + self.granularity * value)
+
+    def lon(self, value):
+        return format_coordinate(self.lon_offset + self.granularity * value)
+
+    def timestamp(self, value):
+        text = self.timestamps.get(value)
+        if text is None:
+            text = self.timestamps[value] = format_timestamp(value * self.date_granularity // 1000)
+        return text
+
+    def info(self, span, attrib):
+        """Add the version/timestamp/changeset/uid/user of an Info message to attrib"""
+        for field, value in iter_fields(self.buf, *span):
+            if field == 1:
+                attrib['version'] = str(signed(value))
+            elif field == 2:
+                attrib['timestamp'] = self.timestamp(signed(value))
+            elif field == 3:
+                attrib['changeset'] = str(signed(value))
+            elif field == 4:
+                attrib['uid'] = str(signed(value))
+            elif field == 5:
+                attrib['user'] = self.strings[value]
+        return attrib
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [OsmElement('tag', {'k': strings[k], 'v': strings[v]}) for k, v in zip(keys, vals)]
+
+    def element(self, tag, span):
+        """Decode a Node, Way or Relation message"""
+        buf = self.buf
+        attrib = {}
+        keys = vals = refs = roles = types = ()
+        lat = lon = 0
+        for field, value in iter_fields(buf, *span):
+            if field == 1:
+                attrib['id'] = str(zigzag(value) if tag == 'node' else signed(value))
+            elif field == 2:
+                keys = unpack_varints(buf, value)
+            elif field == 3:
+                vals = unpack_varints(buf, value)
+            elif field == 4:
+                self.info(value, attrib)
+            elif field == 8:
+                if tag == 'node':
+                    lat = zigzag(value)
+                elif tag == 'way':
+                    refs = unpack_deltas(buf, value)
+                else:
+                    roles = unpack_varints(buf, value)
+            elif field == 9:
+                if tag == 'node':
+                    lon = zigzag(value)
+                elif tag == 'relation':
+                    refs = unpack_deltas(buf, value)
+            elif field == 10 and tag == 'relation':
+                types = unpack_varints(buf, value)
+
+        children = self.tags(keys, vals)
+        if tag == 'node':
+            attrib['lat'] = self.lat(lat)
+            attrib['lon'] = self.lon(lon)
+        elif tag == 'way':
+            children = [OsmElement('nd', {'ref': str(ref)}) for ref in refs] + children
+        else:
+            strings = self.strings
+            children = [OsmElement('member', {'type': MEMBER_TYPES[member_type], 'ref': str(ref),
+                                              'role': strings[role]})
+                        for member_type, ref, role in zip(types, refs, roles)] + children
+        return OsmElement(tag, attrib, children)
+
+    def dense_nodes(self, span):
+        """Decode a DenseNodes message into node elements"""
+        buf = self.buf
+        strings = self.strings
+        ids = lats = lons = keys_vals = ()
+        versions = timestamps = changesets = uids = user_sids = ()
+        for field, value in iter_fields(buf, *span):
+            if field == 1:
+                ids = unpack_deltas(buf, value)
+            elif field == 5:
+                for info_field, info_value in iter_fields(buf, *value):
+                    if info_field == 1:
+                        versions = unpack_varints(buf, info_value)
+                    elif info_field == 2:
+                        timestamps = unpack_deltas(buf, info_value)
+                    elif info_field == 3:
+                        changesets = unpack_deltas(buf, info_value)
+                    elif info_field == 4:
+                        uids = unpack_deltas(buf, info_value)
+                    elif info_field == 5:
+                        user_sids = unpack_deltas(buf, info_value)
+            elif field == 8:
+                lats = unpack_deltas(buf, value)
+            elif field == 9:
+                lons = unpack_deltas(buf, value)
+            elif field == 10:
+                keys_vals = unpack_varints(buf, value)
+
+        has_info = len(versions) == len(ids)
+        kv = 0
+        nodes = []
+        lat, lon, timestamp = self.lat, self.lon, self.timestamp
+        for i, node_id in enumerate(ids):
+            attrib = {'id': str(node_id), 'lat': lat(lats[i]), 'lon': lon(lons[i])}
+            if has_info:
+                attrib['version'] = str(versions[i])
+                attrib['timestamp'] = timestamp(timestamps[i])
+                attrib['changeset'] = str(changesets[i])
+                attrib['uid'] = str(uids[i])
+                attrib['user'] = strings[user_sids[i]]
+            children = []
+            if keys_vals:
+                while keys_vals[kv]:
+                    children.append(OsmElement('tag', {'k': strings[keys_vals[kv]],
+                                                       'v': strings[keys_vals[kv + 1]]}))
+                    kv += 2
+                kv += 1
+            nodes.append(OsmElement('node', attrib, children))
+        return nodes
+
+
+def decode_block(data, tags):
+    """Yield the elements of a PrimitiveBlock whose type is in tags"""
+    block = Block(bytearray(data))
+    buf = block.buf
+    for group in block.groups:
+        for field, value in iter_fields(buf, *group):
+            if field == 1 and 'node' in tags:
+                yield block.element('node', value)
+            elif field == 2 and 'node' in tags:
+                for node in block.dense_nodes(value):
+                    yield node
+            elif field == 3 and 'way' in tags:
+                yield block.element('way', value)
+            elif field == 4 and 'relation' in tags:
+                yield block.element('relation', value)
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), start=0, end=None, threads=DECOMPRESS_THREADS):
+    """Yield element if it is the right type of tag, for the blobs from byte offset start to end"""
+    tags = frozenset(tags)
+    for data in iter_blocks(osm_file, start, end, threads):
+        for element in decode_block(data, tags):
+            yield element
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Staged producer/consumer version of the serial data.process_map loop.
+
+In a serial run one loop parses an element, shapes it, validates it and writes it to the csv
+files, so the parser waits on the writes and the writes wait on the parser.  With data.py
+--pipeline the work is split into stages connected by bounded queues:
+
+- parse: the main process parses the input and turns each element into a raw record, a plain
+  (tag, attrib, [(child tag, child attrib), ...]) tuple that pickles cheaply, collected into
+  batches of batch_size records
+- shape: a pool of worker processes shapes and validates a batch at a time with
+  data.shape_rows and the schema validator, and formats its rows into one block of csv text
+  per output table, which is cheaper to send back than the rows
+- write: one writer thread per output table takes the csv blocks of its table from its own
+  queue and writes them to its csv file through a large buffer, releasing the GIL meanwhile
+
+The queues hold at most queue_batches batches, which is the backpressure: the parser stops
+when that many batches are waiting for the pool, and the rows of a finished batch are only
+taken from the pool when every writer queue has room for them, so a slow disk holds the
+parser back instead of filling the memory.  With ordered (the default) the batches are
+written in input order and the csv files are byte-identical to a serial run; unordered
+writes each batch as soon as it is shaped, which keeps the pool busy when the batches take
+uneven time, and keeps the rows of a batch together and in order.
+
+Relations are parsed whole instead of streamed, so a relation's members are in memory at
+once.  The elements that fail validation are written to a checkpoint.Quarantine if there is
+one, like in a serial run, and members included.  The dangling way node check, the way
+geometry and checkpoints need the elements one at a time in order and are not available here.
+With a tagstats.TagStats, each batch is counted by the worker that shapes it and the counts
+are merged into it as the batch is written.
+
+Usage:
+    python data.py map.osm --pipeline --workers 3 --batch-size 2000 --queue-batches 8
+"""
+import csv
+import logging
+import multiprocessing
+import threading
+from collections import deque
+from timeit import default_timer as timer
+
+import data
+import metrics
+import osm_reader
+import street_rules
+import tagstats
+from compat import CsvBuffer, Queue, encode_row
+
+log = logging.getLogger(__name__)
+
+#records per batch handed to the shaping pool
+BATCH_SIZE = 1000
+#batches a queue holds before the stage feeding it has to wait
+QUEUE_BATCHES = 8
+#seconds between checks for any finished batch when the order does not matter
+POLL_SECONDS = 0.005
+#shaped tables in data.CSV_PATHS order, with the element type their write time counts for
+TABLES = ('node', 'node_tags', 'way', 'way_nodes', 'way_tags', 'relation', 'relation_members', 'relation_tags')
+TABLE_TAGS = ('node', 'node', 'way', 'way', 'way', 'relation', 'relation', 'relation')
+
+#shaping settings of a pool worker, set by init_worker
+_settings = {}
+
+
+def raw_record(element):
+    """Return the (tag, attrib, children) tuple of a parsed element, see the module docstring"""
+    return element.tag, dict(element.attrib), [(child.tag, dict(child.attrib)) for child in element]
+
+
+def to_element(record):
+    tag, attrib, children = record
+    return osm_reader.OsmElement(tag, attrib, [osm_reader.OsmElement(child_tag, child_attrib)
+                                               for child_tag, child_attrib in children])
+
+
+def init_worker(validate, use_cerberus, norm_cache_path, quarantine, stats_top, street_rules_path=None):
+    _settings.update(validate=validate, use_cerberus=use_cerberus, quarantine=quarantine, stats_top=stats_top,
+                     validator=data.make_validator(use_cerberus), sent={})
+    if street_rules_path:
+        data.use_street_rules(street_rules.load(street_rules_path))
+    if norm_cache_path:
+        data.normalization_cache.load(norm_cache_path)
+
+
+#returns the normalization cache entries of this worker that were not returned with an earlier batch
+def new_cache_entries():
+    entries = {}
+    for kind, rows in data.normalization_cache.export().items():
+        sent = _settings['sent'].setdefault(kind, set())
+        rows = [row for row in rows if row[0] not in sent]
+        if rows:
+            sent.update(row[0] for row in rows)
+            entries[kind] = rows
+    return entries
+
+
+def validate_rows(tag, el, validator, use_cerberus):
+    if tag == 'relation':
+        data.validate_element({'relation': el['relation']}, validator)
+        el['relation_members'] = list(data.validate_members(el['relation_members'], el['relation_tags'],
+                                                            validator, use_cerberus))
+    else:
+        data.validate_element(data.rows_as_dicts(el) if use_cerberus else el, validator)
+
+
+def shape_batch(batch):
+    """Shape, validate and encode a batch of raw records in a pool worker
+
+    Returns a dict with the csv text and the row count of each table in TABLES order, the
+    records that failed validation with their errors, the metrics.Metrics and tagstats.TagStats
+    exports of the batch and the postcode changes and normalization cache counters and new
+    entries of the batch.
+    """
+    validate = _settings['validate']
+    use_cerberus = _settings['use_cerberus']
+    validator = _settings['validator']
+    tables = [[] for _ in TABLES]
+    invalid = []
+    batch_metrics = metrics.Metrics(interval=None)
+    batch_stats = tagstats.TagStats(_settings['stats_top']) if _settings['stats_top'] else None
+    data.postcode_changes.clear()
+    cache = data.normalization_cache
+    cache.hits = cache.misses = 0
+
+    for record in batch:
+        start = timer()
+        tag = record[0]
+        el = data.shape_rows(to_element(record))
+        if not el:
+            continue
+        if tag == 'relation':
+            el['relation_members'] = list(el['relation_members'])
+        shaped = timer()
+        if validate is True:
+            try:
+                validate_rows(tag, el, validator, use_cerberus)
+            except Exception as e:
+                if not _settings['quarantine']:
+                    raise
+                invalid.append((record, str(e)))
+                continue
+        validated = timer()
+        for rows, table in zip(tables, TABLES):
+            table_rows = el.get(table)
+            if table_rows is None:
+                continue
+            if isinstance(table_rows, tuple):
+                rows.append(encode_row(table_rows))
+            else:
+                rows.extend(map(encode_row, table_rows))
+        encoded = timer()
+        if batch_stats is not None:
+            batch_stats.add(tag, el)
+        batch_metrics.add(tag, 0.0, shaped - start, validated - shaped, timer() - encoded, encoded - validated)
+
+    texts = []
+    for rows in tables:
+        text = CsvBuffer()
+        csv.writer(text).writerows(rows)
+        texts.append(text.getvalue())
+    return {'tables': texts,
+            'rows': [len(rows) for rows in tables],
+            'invalid': invalid,
+            'metrics': batch_metrics.export(),
+            'tag_stats': batch_stats.export() if batch_stats is not None else None,
+            'postcode_changes': dict(data.postcode_changes),
+            'normalization_cache': {'hits': cache.hits, 'misses': cache.misses},
+            'normalization_cache_entries': new_cache_entries() if cache.misses else {}}
+
+
+class TableWriter(object):
+    """Writes the csv blocks of one table to its csv file, in a thread of its own"""
+
+    def __init__(self, path, field_names, level=None, queue_batches=QUEUE_BATCHES):
+        self.file = data.open_csv(path, level)
+        data.UnicodeDictWriter(self.file, field_names).writeheader()
+        self.queue = Queue(queue_batches)
+        self.rows = 0
+        self.seconds = 0.0
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                text = self.queue.get()
+                if text is None:
+                    return
+                start = timer()
+                self.file.write(text)
+                self.seconds += timer() - start
+        except Exception as e:
+            self.error = e
+            #keep taking batches so put() never blocks, close() reports the error
+            while self.queue.get() is not None:
+                pass
+        finally:
+            self.file.close()
+
+    def put(self, text, rows):
+        if self.error is not None:
+            raise self.error
+        self.rows += rows
+        self.queue.put(text)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class Pipeline(object):
+    """Runs the parse, shape and write stages over the elements of one input
+
+    csv_paths are the output files in data.CSV_PATHS order, compressed at level if they have a
+    compressed extension.  The element counts and stage seconds are added to run_metrics,
+    where parse is the time the main process spends on parsing and making the raw records, and
+    write the time the workers spend formatting the csv text plus the writer threads' writes.
+    The postcode changes and normalization cache counters and entries of the workers are
+    collected in postcode_changes, cache_hits, cache_misses and cache_entries, for the caller
+    to add to its own (data.py run as a script is not the data module the workers use).
+    """
+
+    def __init__(self, csv_paths, validate, use_cerberus=False, workers=1, norm_cache_path=None,
+                 batch_size=BATCH_SIZE, queue_batches=QUEUE_BATCHES, ordered=True, level=None,
+                 run_metrics=None, quarantine=None, tag_stats=None, street_rules_path=None):
+        self.batch_size = max(1, batch_size)
+        self.queue_batches = max(1, queue_batches)
+        self.ordered = ordered
+        self.workers = max(1, workers)
+        self.run_metrics = run_metrics if run_metrics is not None else metrics.Metrics(interval=None)
+        self.quarantine = quarantine
+        self.tag_stats = tag_stats
+        self.batches = 0
+        self.pool_wait = 0.0
+        self.writer_wait = 0.0
+        self.postcode_changes = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_entries = {}
+        self.writers = [TableWriter(path, field_names, level, self.queue_batches)
+                        for path, field_names in zip(csv_paths, data.CSV_FIELDS)]
+        self.pool = multiprocessing.Pool(self.workers, init_worker,
+                                         (validate, use_cerberus, norm_cache_path, quarantine is not None,
+                                          tag_stats.top if tag_stats is not None else None, street_rules_path))
+
+    def next_done(self, pending):
+        """Remove and return the next finished batch, the oldest one if the order matters"""
+        start = timer()
+        if self.ordered:
+            result = pending.popleft()
+        else:
+            result = None
+            while result is None:
+                for candidate in pending:
+                    if candidate.ready():
+                        result = candidate
+                        break
+                else:
+                    pending[0].wait(POLL_SECONDS)
+            pending.remove(result)
+        shaped = result.get()
+        self.pool_wait += timer() - start
+        return shaped
+
+    def collect(self, shaped, position=None):
+        """Hand the rows of a shaped batch to the writers and add up its counters"""
+        start = timer()
+        for writer, text, rows in zip(self.writers, shaped['tables'], shaped['rows']):
+            if text:
+                writer.put(text, rows)
+        self.writer_wait += timer() - start
+        for record, error in shaped['invalid']:
+            self.quarantine.add(to_element(record), error)
+        self.run_metrics.merge(shaped['metrics'])
+        if self.tag_stats is not None:
+            self.tag_stats.merge(shaped['tag_stats'])
+        self.postcode_changes.update(shaped['postcode_changes'])
+        self.cache_hits += shaped['normalization_cache']['hits']
+        self.cache_misses += shaped['normalization_cache']['misses']
+        for kind, rows in shaped['normalization_cache_entries'].items():
+            self.cache_entries.setdefault(kind, []).extend(rows)
+        if position is not None:
+            self.run_metrics.maybe_report(position())
+
+    def run(self, elements):
+        """Shape and write the elements, returns the pipeline counters for the run summary"""
+        run_metrics = self.run_metrics
+        parse_seconds = dict.fromkeys(metrics.TAGS, 0.0)
+        pending = deque()
+        batch = []
+        elements = iter(elements)
+        try:
+            while True:
+                start = timer()
+                element = next(elements, None)
+                if element is not None:
+                    batch.append(raw_record(element))
+                    parse_seconds[element.tag] += timer() - start
+                if batch and (element is None or len(batch) >= self.batch_size):
+                    pending.append(self.pool.apply_async(shape_batch, (batch,)))
+                    self.batches += 1
+                    batch = []
+                    while len(pending) >= self.queue_batches:
+                        self.collect(self.next_done(pending), run_metrics.position)
+                if element is None:
+                    break
+            while pending:
+                self.collect(self.next_done(pending), run_metrics.position)
+            self.pool.close()
+        except:
+            self.pool.terminate()
+            raise
+        finally:
+            self.pool.join()
+            for writer in self.writers:
+                writer.close()
+
+        for tag, seconds in parse_seconds.items():
+            run_metrics.seconds[tag][0] += seconds
+        for writer, tag in zip(self.writers, TABLE_TAGS):
+            run_metrics.seconds[tag][4] += writer.seconds
+        return {'workers': self.workers,
+                'batch_size': self.batch_size,
+                'queue_batches': self.queue_batches,
+                'ordered': self.ordered,
+                'batches': self.batches,
+                'pool_wait_seconds': round(self.pool_wait, 4),
+                'writer_wait_seconds': round(self.writer_wait, 4),
+                'rows': dict((table, writer.rows) for table, writer in zip(TABLES, self.writers))}
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Referential check of way_nodes against the nodes of the extract.
+
+Clipped extracts keep the whole of every way that crosses the boundary, but not the nodes
+outside of it, so many way_nodes rows reference nodes that are not in the nodes table.
+WayNodeCheck records every node id in an IdBitmap (see idindex.py) while the nodes are
+shaped, then checks the node_id of every way_nodes row against it.  Dangling rows are counted,
+and dropped if asked.
+
+OSM files list all nodes before the ways, so by the time the first way is shaped every node
+id has been recorded.
+"""
+import os
+from itertools import groupby
+from operator import itemgetter
+
+from compat import open_text_input, open_text_output
+from idindex import IdBitmap
+
+#number of dangling (way id, node id) pairs listed in the report
+EXAMPLES = 10
+
+
+class WayNodeCheck(object):
+    """Checks way_nodes rows against the node ids seen so far"""
+
+    def __init__(self, drop=False):
+        self.drop = drop
+        self.nodes = IdBitmap()
+        self.way_nodes = 0
+        self.dangling = 0
+        self.ways_with_dangling = 0
+        self.examples = []
+
+    def add_node(self, node_id):
+        self.nodes.add(int(node_id))
+
+    def check(self, way_nodes):
+        """Return the (id, node_id, position) rows of one way, without the dangling ones if drop"""
+        nodes = self.nodes
+        kept = [row for row in way_nodes if int(row[1]) in nodes]
+        missing = len(way_nodes) - len(kept)
+        self.way_nodes += len(way_nodes)
+        if missing:
+            self.dangling += missing
+            self.ways_with_dangling += 1
+            if len(self.examples) < EXAMPLES:
+                self.examples.extend((row[0], row[1]) for row in way_nodes
+                                     if int(row[1]) not in nodes)
+                del self.examples[EXAMPLES:]
+        return kept if self.drop else way_nodes
+
+    def check_csvs(self, paths):
+        """Check a set of headerless shard csv(s) in place, in CSV_PATHS order
+
+        Records the ids of the nodes csv, then checks the ways_nodes csv and rewrites it
+        without the dangling rows if drop.
+        """
+        with open_text_input(paths[0]) as nodes_file:
+            for line in nodes_file:
+                self.add_node(line[:line.index(',')])
+
+        checked_path = paths[3] + '.checked'
+        with open_text_input(paths[3]) as way_nodes_file, open_text_output(checked_path) as checked_file:
+            rows = (line.split(',', 2) for line in way_nodes_file)
+            for way_id, way_nodes in groupby(rows, itemgetter(0)):
+                for row in self.check(list(way_nodes)):
+                    checked_file.write(','.join(row))
+        os.remove(paths[3])
+        os.rename(checked_path, paths[3])
+
+    def report(self):
+        return {'way_nodes': self.way_nodes,
+                'dangling': self.dangling,
+                'ways_with_dangling': self.ways_with_dangling,
+                'dropped': self.dangling if self.drop else 0,
+                'examples': self.examples,
+                'node_ids': len(self.nodes),
+                'node_index_bytes': self.nodes.nbytes()}
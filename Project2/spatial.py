@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+R*Tree spatial index over the nodes and ways of a database loaded by sqlite_loader.py.
+
+Without an index, finding the nodes in an area means scanning the lat/lon of every row of
+nodes, and the ways in an area cannot be found at all without joining ways_nodes to nodes.
+With data.py --sqlite DB --rtree the load also fills two SQLite R*Tree virtual tables:
+
+- nodes_rtree: a point box per node
+- ways_rtree:  the bounding box of each way, computed from the coordinates of its way_nodes
+               (nodes that are not in the extract are left out of the box)
+
+nodes_in_bbox and ways_in_bbox answer bbox queries from them in milliseconds.  R*Tree stores
+32 bit floats rounded outwards, so node results are checked against the exact lat/lon, while
+ways_in_bbox can also return a way that misses the bbox by less than that rounding (~1m).
+osc_update.py keeps both tables up to date.
+
+Needs a sqlite3 library built with the R*Tree module (the default for the library that ships
+with Python on most platforms).
+
+Usage:
+    python spatial.py map.db MINLAT MINLON MAXLAT MAXLON
+"""
+import argparse
+import sqlite3
+import time
+
+RTREE_TABLES = [
+    'CREATE VIRTUAL TABLE nodes_rtree USING rtree (id, min_lat, max_lat, min_lon, max_lon)',
+    'CREATE VIRTUAL TABLE ways_rtree USING rtree (id, min_lat, max_lat, min_lon, max_lon)',
+]
+FILL_NODES = '''
+    INSERT INTO nodes_rtree
+    SELECT id, lat, lat, lon, lon FROM nodes WHERE lat IS NOT NULL AND lon IS NOT NULL'''
+#bounding box of each way from the nodes it references
+WAY_BBOXES = '''
+    SELECT ways_nodes.id, MIN(lat), MAX(lat), MIN(lon), MAX(lon)
+    FROM ways_nodes JOIN nodes ON nodes.id = ways_nodes.node_id'''
+
+NODES_IN_BBOX = '''
+    SELECT nodes.* FROM nodes_rtree JOIN nodes ON nodes.id = nodes_rtree.id
+    WHERE nodes_rtree.min_lat <= :max_lat AND nodes_rtree.max_lat >= :min_lat
+      AND nodes_rtree.min_lon <= :max_lon AND nodes_rtree.max_lon >= :min_lon
+      AND nodes.lat BETWEEN :min_lat AND :max_lat AND nodes.lon BETWEEN :min_lon AND :max_lon'''
+WAYS_IN_BBOX = '''
+    SELECT ways.* FROM ways_rtree JOIN ways ON ways.id = ways_rtree.id
+    WHERE ways_rtree.min_lat <= :max_lat AND ways_rtree.max_lat >= :min_lat
+      AND ways_rtree.min_lon <= :max_lon AND ways_rtree.max_lon >= :min_lon'''
+
+
+def has_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone() is not None
+
+
+def build_index(conn):
+    """Create and fill nodes_rtree and ways_rtree from the loaded nodes and ways_nodes"""
+    try:
+        for create in RTREE_TABLES:
+            conn.execute(create)
+    except sqlite3.OperationalError as e:
+        raise RuntimeError('Could not create the R*Tree tables, is sqlite3 built with the R*Tree module? ({0})'
+                           .format(e))
+    conn.execute(FILL_NODES)
+    conn.execute('INSERT INTO ways_rtree ' + WAY_BBOXES + ' GROUP BY ways_nodes.id')
+
+
+def update_nodes(conn, node_ids):
+    """Replace the nodes_rtree entries of node_ids with their current coordinates"""
+    for node_id in node_ids:
+        conn.execute('DELETE FROM nodes_rtree WHERE id = ?', (node_id,))
+        conn.execute(FILL_NODES + ' AND id = ?', (node_id,))
+
+
+def update_ways(conn, way_ids):
+    """Recompute the ways_rtree boxes of way_ids, e.g. after their nodes or way_nodes changed"""
+    for way_id in way_ids:
+        conn.execute('DELETE FROM ways_rtree WHERE id = ?', (way_id,))
+        conn.execute('INSERT INTO ways_rtree ' + WAY_BBOXES + ' WHERE ways_nodes.id = ? GROUP BY ways_nodes.id',
+                     (way_id,))
+
+
+def bbox_params(bbox):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return {'min_lat': min_lat, 'min_lon': min_lon, 'max_lat': max_lat, 'max_lon': max_lon}
+
+
+def nodes_in_bbox(conn, bbox):
+    """Return the nodes rows inside bbox = (min lat, min lon, max lat, max lon)"""
+    return conn.execute(NODES_IN_BBOX, bbox_params(bbox)).fetchall()
+
+
+def ways_in_bbox(conn, bbox):
+    """Return the ways rows whose bounding box intersects bbox = (min lat, min lon, max lat, max lon)"""
+    return conn.execute(WAYS_IN_BBOX, bbox_params(bbox)).fetchall()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count the nodes and ways in a bounding box')
+    parser.add_argument('db', help='SQLite database loaded with data.py --sqlite DB --rtree')
+    parser.add_argument('bbox', type=float, nargs=4, metavar=('MINLAT', 'MINLON', 'MAXLAT', 'MAXLON'))
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    for name, query in (('nodes', nodes_in_bbox), ('ways', ways_in_bbox)):
+        start = time.time()
+        rows = query(conn, args.bbox)
+        print('{0:5s} {1:10d} rows {2:8.1f}ms'.format(name, len(rows), (time.time() - start) * 1000))
+    conn.close()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk load shaped OSM elements straight into a SQLite database.
+
+This replaces writing the five .csv files and importing them by hand with the sqlite3 shell
+(see "Importing Data into SQL Database" in OpenStreetMap+Project.md).  The tables are created
+up front with real column types and primary keys, so there is no header/last column problem
+and nothing has to be re-parsed from text.
+
+To keep the load fast:
+- rows are buffered per table and inserted with executemany in batches
+- many batches share one transaction, committed every COMMIT_ROWS rows
+- the database is opened in WAL mode with synchronous=OFF while loading
+- secondary indexes are only built once all of the rows are in
+
+With rtree the R*Tree spatial index of spatial.py is filled once the rows are in, too, and the
+summary tables of analytics.py are always filled at the end.
+
+Usage:
+    python data.py map.osm --sqlite map.db
+"""
+import csv
+import os
+import sqlite3
+
+import analytics
+import data
+import spatial
+from compat import decode_row, open_text_input
+
+#number of rows buffered per table before an executemany
+BATCH_ROWS = 10000
+#number of rows inserted between commits
+COMMIT_ROWS = 500000
+
+#table name, column names and create statement for each table, in csv order
+TABLES = [
+    ('nodes', data.NODE_FIELDS, '''
+        CREATE TABLE nodes (
+            id INTEGER PRIMARY KEY NOT NULL,
+            lat REAL,
+            lon REAL,
+            user TEXT,
+            uid INTEGER,
+            version TEXT,
+            changeset INTEGER,
+            timestamp TEXT
+        )'''),
+    ('nodes_tags', data.NODE_TAGS_FIELDS, '''
+        CREATE TABLE nodes_tags (
+            id INTEGER NOT NULL REFERENCES nodes (id),
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            type TEXT NOT NULL
+        )'''),
+    ('ways', data.WAY_FIELDS, '''
+        CREATE TABLE ways (
+            id INTEGER PRIMARY KEY NOT NULL,
+            user TEXT,
+            uid INTEGER,
+            version TEXT,
+            changeset INTEGER,
+            timestamp TEXT
+        )'''),
+    ('ways_nodes', data.WAY_NODES_FIELDS, '''
+        CREATE TABLE ways_nodes (
+            id INTEGER NOT NULL REFERENCES ways (id),
+            node_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (id, position)
+        ) WITHOUT ROWID'''),
+    ('ways_tags', data.WAY_TAGS_FIELDS, '''
+        CREATE TABLE ways_tags (
+            id INTEGER NOT NULL REFERENCES ways (id),
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            type TEXT NOT NULL
+        )'''),
+    ('relations', data.RELATION_FIELDS, '''
+        CREATE TABLE relations (
+            id INTEGER PRIMARY KEY NOT NULL,
+            user TEXT,
+            uid INTEGER,
+            version TEXT,
+            changeset INTEGER,
+            timestamp TEXT
+        )'''),
+    ('relations_members', data.RELATION_MEMBERS_FIELDS, '''
+        CREATE TABLE relations_members (
+            id INTEGER NOT NULL REFERENCES relations (id),
+            member_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            role TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (id, position)
+        ) WITHOUT ROWID'''),
+    ('relations_tags', data.RELATION_TAGS_FIELDS, '''
+        CREATE TABLE relations_tags (
+            id INTEGER NOT NULL REFERENCES relations (id),
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            type TEXT NOT NULL
+        )'''),
+]
+
+#secondary indexes, built after the load
+INDEXES = [
+    'CREATE INDEX nodes_tags_id ON nodes_tags (id)',
+    'CREATE INDEX nodes_tags_key ON nodes_tags (key)',
+    'CREATE INDEX ways_tags_id ON ways_tags (id)',
+    'CREATE INDEX ways_tags_key ON ways_tags (key)',
+    'CREATE INDEX ways_nodes_node_id ON ways_nodes (node_id)',
+    'CREATE INDEX relations_members_member ON relations_members (type, member_id)',
+    'CREATE INDEX relations_tags_id ON relations_tags (id)',
+    'CREATE INDEX relations_tags_key ON relations_tags (key)',
+]
+
+
+class SQLiteOutput(object):
+    """Output for data.write_elements that bulk loads the tables into a SQLite database
+
+    write() takes elements shaped by data.shape_rows.  Like the csv outputs, an existing
+    database at path is replaced.
+    """
+
+    def __init__(self, path, batch_rows=BATCH_ROWS, commit_rows=COMMIT_ROWS, rtree=False):
+        for stale in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(stale):
+                os.remove(stale)
+        self.path = path
+        self.batch_rows = batch_rows
+        self.commit_rows = commit_rows
+        self.rtree = rtree
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute('PRAGMA cache_size = -200000')
+        self.conn.execute('PRAGMA temp_store = MEMORY')
+        for name, fields, create in TABLES:
+            self.conn.execute(create)
+
+        self.fields = dict((name, fields) for name, fields, create in TABLES)
+        self.inserts = dict((name, 'INSERT INTO {0} ({1}) VALUES ({2})'.format(
+            name, ', '.join(fields), ', '.join('?' * len(fields)))) for name, fields, create in TABLES)
+        self.buffers = dict((name, []) for name, fields, create in TABLES)
+        self.uncommitted = 0
+        self.conn.execute('BEGIN')
+
+    def add_rows(self, table, rows):
+        """Buffer rows (sequences in the table's column order) for table"""
+        buf = self.buffers[table]
+        buf.extend(rows)
+        if len(buf) >= self.batch_rows:
+            self.flush(table)
+
+    def add_stream(self, table, rows):
+        """Buffer rows from an iterator for table, flushing as the batches fill up"""
+        buf = self.buffers[table]
+        batch_rows = self.batch_rows
+        for row in rows:
+            buf.append(row)
+            if len(buf) >= batch_rows:
+                self.flush(table)
+
+    def write(self, tag, el):
+        if tag == 'node':
+            self.add_rows('nodes', [el['node']])
+            self.add_rows('nodes_tags', el['node_tags'])
+        elif tag == 'way':
+            self.add_rows('ways', [el['way']])
+            self.add_rows('ways_nodes', el['way_nodes'])
+            self.add_rows('ways_tags', el['way_tags'])
+        elif tag == 'relation':
+            self.add_rows('relations', [el['relation']])
+            #members first, the tags are complete once they have been consumed
+            self.add_stream('relations_members', el['relation_members'])
+            self.add_rows('relations_tags', el['relation_tags'])
+
+    def load_csvs(self, paths):
+        """Load one set of headerless csv files (as written by data.CsvOutput) in table order"""
+        for (name, fields, create), path in zip(TABLES, paths):
+            buf = self.buffers[name]
+            with open_text_input(path) as csv_file:
+                for row in csv.reader(csv_file):
+                    buf.append(decode_row(row))
+                    if len(buf) >= self.batch_rows:
+                        self.flush(name)
+
+    def flush(self, table):
+        buf = self.buffers[table]
+        if buf:
+            self.conn.executemany(self.inserts[table], buf)
+            self.uncommitted += len(buf)
+            del buf[:]
+        if self.uncommitted >= self.commit_rows:
+            self.conn.execute('COMMIT')
+            self.conn.execute('BEGIN')
+            self.uncommitted = 0
+
+    def close(self):
+        """Flush the remaining rows, build the indexes and summary tables and restore safe pragmas"""
+        if self.conn is None:
+            return
+        for name, fields, create in TABLES:
+            self.flush(name)
+        if self.rtree:
+            spatial.build_index(self.conn)
+        self.conn.execute('COMMIT')
+        for index in INDEXES:
+            self.conn.execute(index)
+        self.conn.execute('BEGIN')
+        analytics.build_summaries(self.conn)
+        self.conn.execute('COMMIT')
+        self.conn.execute('ANALYZE')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.close()
+        self.conn = None
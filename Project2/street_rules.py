@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Street type cleaning rules, shared by the audit (audit.py, audit_engine.py) and the conversion
+(data.py, osc_update.py).
+
+audit.py and data.py each had their own copy of the street type regexes, and they had drifted
+apart (data.py knew St, Lp, Blvd and Hwy, audit.py only Av and Rd).  Both audit_street_type
+functions also added to the module global mapping as a side effect, so during a conversion the
+mapping depended on which street names had been seen so far, and it was lost at the end of the
+run.  Here the two steps are kept apart:
+
+- audit: audit_street_type only records the unexpected street types and the names they were
+  found in.  learn() then proposes a full type for each of them from ABBREVIATIONS (one regex
+  alternation, the first abbreviation in the street type wins) and returns a new StreetRules.
+  audit_engine.py --save-rules PATH writes it to a JSON file that can be reviewed and edited.
+- conversion: data.py --street-rules PATH loads that file into a StreetRules that is never
+  modified afterwards.  clean() replaces the last word of a street name if it is one of the
+  mapped abbreviations, with one search of a regex that alternates over all of them, so the
+  result only depends on the value and the file.
+
+Usage:
+    python audit_engine.py map.osm --save-rules street_rules.json
+    python data.py map.osm --street-rules street_rules.json
+"""
+import hashlib
+import json
+import re
+
+import checkpoint
+
+#the last word of a street name
+street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
+
+#street types that need no cleaning
+EXPECTED = ("Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road",
+            "Trail", "Parkway", "Commons", "Bayou", "Circle", "Bend", "Highway", "Point", "Way",
+            "Hollow", "Trace", "Run", "Loop", "Knee", "Ridge", "Park", "Hill", "Cove", "Alley")
+
+#abbreviations known before any audit
+DEFAULT_MAPPING = {"St": "Street",
+                   "St.": "Street"}
+
+#abbreviation a street type starts with (at a word boundary, any case) -> full street type,
+#in the order the audit scripts tried them
+ABBREVIATIONS = (('Av', 'Avenue'), ('Rd', 'Road'), ('St', 'Street'), ('Lp', 'Loop'),
+                 ('Blvd', 'Boulevard'), ('Hwy', 'Highway'))
+abbreviation_re = re.compile(r'\b(?:' + '|'.join('({0})'.format(abbreviation)
+                                                 for abbreviation, _ in ABBREVIATIONS) + ')',
+                             re.IGNORECASE)
+
+FORMAT_VERSION = 1
+
+
+class StreetRules(object):
+    """Frozen expected street types and abbreviation -> street type mapping"""
+
+    def __init__(self, mapping=None, expected=EXPECTED):
+        self.mapping = dict(DEFAULT_MAPPING if mapping is None else mapping)
+        self.expected = frozenset(expected)
+        #longest first, so "St." is tried before "St"
+        alternatives = sorted(self.mapping, key=lambda abbreviation: (-len(abbreviation), abbreviation))
+        self.pattern = None
+        if alternatives:
+            self.pattern = re.compile(u'(?<=\\s)(?:{0})\\Z'.format(u'|'.join(map(re.escape, alternatives))),
+                                      re.UNICODE)
+        self.signature = hashlib.md5(json.dumps([sorted(self.expected), sorted(self.mapping.items())]).encode('utf-8')).hexdigest()
+
+    def clean(self, name):
+        """Return name with its last word replaced if it is a mapped abbreviation
+
+        A name of a single word is kept, it has no street type.
+        """
+        m = self.pattern.search(name) if self.pattern is not None else None
+        if m is None:
+            return name
+        return name[:m.start()] + self.mapping[m.group()]
+
+    def street_type(self, name):
+        """Return the last word of name if it is not an expected street type, else None"""
+        m = street_type_re.search(name)
+        if m and m.group() not in self.expected:
+            return m.group()
+        return None
+
+    def export(self):
+        return {'version': FORMAT_VERSION, 'expected': sorted(self.expected), 'mapping': self.mapping}
+
+
+#the rules used when no rules file is given: the conversion writes the street names as they are
+PASSTHROUGH = StreetRules({})
+
+
+#this function records the street type of street_name in street_types if it is not expected
+def audit_street_type(street_types, street_name, expected=EXPECTED):
+    m = street_type_re.search(street_name)
+    if m:
+        street_type = m.group()
+        if street_type not in expected:
+            street_types[street_type].add(street_name)
+
+
+#returns the full street type an unexpected street type abbreviates, or None
+def propose(street_type):
+    m = abbreviation_re.search(street_type)
+    if m is None:
+        return None
+    return ABBREVIATIONS[m.lastindex - 1][1]
+
+
+def learn(street_types, base=None):
+    """Return new rules with a mapping for each street type in street_types that has a proposal
+
+    The mappings of base (StreetRules() by default) are kept as they are, so an edited rules
+    file can be extended by auditing another extract.
+    """
+    if base is None:
+        base = StreetRules()
+    mapping = dict(base.mapping)
+    for street_type in sorted(street_types):
+        if street_type in mapping or street_type in base.expected:
+            continue
+        full = propose(street_type)
+        if full is not None:
+            mapping[street_type] = full
+    return StreetRules(mapping, base.expected)
+
+
+def save(rules, path):
+    """Write rules to path as JSON, through a temporary file (see checkpoint.replace_file)"""
+    checkpoint.replace_file(path, json.dumps(rules.export(), indent=2, separators=(',', ': '), sort_keys=True))
+
+
+def load(path):
+    """Return the StreetRules saved in path"""
+    with open(path) as f:
+        saved = json.load(f)
+    if saved.get('version') != FORMAT_VERSION:
+        raise ValueError('{0} is not a version {1} street rules file'.format(path, FORMAT_VERSION))
+    return StreetRules(saved['mapping'], saved['expected'])
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
 import pprint
 import re
+
+import osm_reader
 """
 This code was adapted from the lesson exercises for the Wrangle OpenStreetMap Data Project
 Before you process the data and add it into your database, you should check the
@@ -30,17 +31,6 @@ lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
 #regex to identify any problematic characters
 problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
-#this function uses iterparse to fetch all of the elements in the dataset
-#Uses code that ensures the elements are not stored in memory
-#Reference: https://discussions.udacity.com/t/lingering-questions-as-i-head-into-sql-portion-of-p3/237251/27
-def get_element(osm_file, tags=('node', 'way')):
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end':
-            yield elem
-            root.clear()
-
 #Using regex keys, check each tag for the categories listed in the header description
 #If the regex keys find a match, increment the counter for that category in a Python Dict
 def key_type(element, keys):
@@ -59,14 +49,11 @@ def key_type(element, keys):
 
 #Use this function to define the keys dict, and iterate over all elements in the dataset
 #should return the final tally of keys categories as dict keys when completed
-def process_map(filename):
-    keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    context = ET.iterparse(filename , events=('start', 'end'))
-    _, root = next(context)
-    for element in get_element(filename):
-        keys = key_type(element, keys)
-
-    return keys
+#the tally is done by the key_type collector of the single pass audit in audit_engine.py
+def process_map(filename, backend=osm_reader.DEFAULT_BACKEND):
+    import audit_engine  # imported here because audit_engine imports this module
+    report = audit_engine.run_audit(filename, [audit_engine.KeyTypeCollector()], backend)
+    return report['key_types']
 
 #Main function
 if __name__ == "__main__":
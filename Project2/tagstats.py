@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming tag and contributor statistics, gathered by data.process_map in bounded memory.
+
+The analysis in OpenStreetMap+Project.md (element counts, distinct uids, top contributors,
+tag types) could only be run after the csv files were imported into SQL, and users.py keeps
+every user name in a set.  With data.py --stats PATH a TagStats object sees every shaped
+element during the conversion and the report is saved to PATH at the end of the run:
+
+- exact counts of the elements and tags per element type, of the tag types per element type
+  and of the tag keys (up to max_keys distinct keys, the tags of any further keys are only
+  counted in keys_uncounted)
+- HyperLogLog estimates of the number of distinct uids, user names, keys and key=value pairs,
+  with a relative standard error of 1.04 / sqrt(2 ** precision) (0.8% by default)
+- the top user names, keys and key=value pairs by count, from a Count-Min sketch per field
+  and a bounded set of heavy hitter candidates.  A Count-Min count can only be too high, by
+  at most e / width of the field's total count with probability 1 - exp(-depth), and the
+  report gives that bound per field
+
+The values are collected in bounded dicts of pending counts first and folded into the
+sketches every PENDING_LIMIT observations, so a value that repeats (highway=residential) is
+hashed once per flush instead of once per tag.  The sketches take about 2 ** precision bytes
+per HyperLogLog and 8 * width * depth bytes per Count-Min sketch, whatever the size of the
+input.  export() and merge() combine the statistics of shards and pipeline batches shaped in
+other processes; the hashes are md5 based so they agree between processes and runs.
+
+Usage:
+    python data.py map.osm --stats stats.json --stats-top 50
+"""
+import hashlib
+import heapq
+import math
+import struct
+from array import array
+from collections import defaultdict
+
+from compat import text_type
+
+TAGS = ('node', 'way', 'relation')
+#the fields with a distinct count, and those of them with a top list
+SKETCHED = ('uids', 'users', 'keys', 'values')
+RANKED = ('users', 'keys', 'values')
+TOP = 20
+#HyperLogLog registers are 2 ** PRECISION bytes
+PRECISION = 14
+CMS_WIDTH = 1 << 14
+CMS_DEPTH = 4
+#heavy hitter candidates kept per entry of a top list
+CANDIDATES = 10
+MAX_EXACT_KEYS = 10000
+#observations collected before they are folded into the sketches
+PENDING_LIMIT = 1 << 16
+MASK32 = (1 << 32) - 1
+
+
+def hash64(value):
+    """Return a 64 bit hash of value that is the same in every process and run"""
+    if isinstance(value, text_type):
+        value = value.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """Distinct count estimate over 2 ** precision one byte registers"""
+
+    def __init__(self, precision=PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.size)
+
+    def add(self, h):
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, registers):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, registers))
+
+    def count(self):
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(bytearray(1))
+        if estimate <= 2.5 * size and zeros:
+            #small range correction (linear counting)
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+
+class CountMinSketch(object):
+    """Count estimates that are never too low, in depth rows of width counters"""
+
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH, table=None, total=0):
+        if width & (width - 1):
+            raise ValueError('The Count-Min width must be a power of 2, got {0}'.format(width))
+        self.width = width
+        self.depth = depth
+        #doubles count exactly up to 2 ** 53 on every platform
+        self.table = table if table is not None else array('d', [0.0]) * (width * depth)
+        self.total = total
+
+    def cells(self, h):
+        #double hashing, each row gets its own cell from the two halves of h
+        low, high = h & MASK32, h >> 32
+        mask = self.width - 1
+        return [row * self.width + ((low + row * high) & mask) for row in range(self.depth)]
+
+    def add(self, h, count=1):
+        """Add count to the cells of h and return its new estimate"""
+        table = self.table
+        self.total += count
+        estimate = None
+        for cell in self.cells(h):
+            table[cell] += count
+            if estimate is None or table[cell] < estimate:
+                estimate = table[cell]
+        return int(estimate)
+
+    def estimate(self, h):
+        table = self.table
+        return int(min(table[cell] for cell in self.cells(h)))
+
+    def merge(self, table, total):
+        self.table = array('d', [a + b for a, b in zip(self.table, table)])
+        self.total += total
+
+    def error(self):
+        """Return the most a count may be too high by, with probability 1 - exp(-depth)"""
+        return int(math.ceil(math.e / self.width * self.total))
+
+
+#highest estimate first, equal estimates in item order so the top lists do not depend on the
+#dict order (which differs between Python 2 and 3)
+def rank(item):
+    return -item[1], item[0]
+
+
+class TopK(object):
+    """The items with the highest estimates, from a bounded set of candidates"""
+
+    def __init__(self, size=TOP, counts=None):
+        self.size = size
+        self.capacity = max(1, size * CANDIDATES)
+        self.counts = counts if counts is not None else {}
+        self.floor = 0
+
+    def offer(self, item, estimate):
+        counts = self.counts
+        if item in counts or estimate > self.floor or len(counts) < self.capacity:
+            counts[item] = estimate
+            if len(counts) > 2 * self.capacity:
+                self.prune()
+
+    def prune(self):
+        kept = heapq.nsmallest(self.capacity, self.counts.items(), key=rank)
+        self.counts = dict(kept)
+        self.floor = kept[-1][1]
+
+    def top(self):
+        return heapq.nsmallest(self.size, self.counts.items(), key=rank)
+
+
+class TagStats(object):
+    """Exact counters and sketches over the elements shaped by data.shape_rows
+
+    add() takes an element type and its shaped tables, after the relation members have been
+    consumed (the relation tags are only complete then).
+    """
+
+    def __init__(self, top=TOP, precision=PRECISION, width=CMS_WIDTH, depth=CMS_DEPTH, max_keys=MAX_EXACT_KEYS):
+        self.top = top
+        self.precision = precision
+        self.width = width
+        self.depth = depth
+        self.max_keys = max_keys
+        self.elements = dict.fromkeys(TAGS, 0)
+        self.tags = dict.fromkeys(TAGS, 0)
+        self.tag_types = dict((tag, defaultdict(int)) for tag in TAGS)
+        self.keys = {}
+        self.keys_uncounted = 0
+        self.pending = dict((field, defaultdict(int)) for field in SKETCHED)
+        self.observed = 0
+        #made on the first flush, a batch shaped by a pipeline worker never needs them
+        self.sketches = None
+
+    def add(self, tag, el):
+        row = el[tag]
+        tags = el[tag + '_tags']
+        pending = self.pending
+        pending['uids'][row.uid] += 1
+        pending['users'][row.user] += 1
+        self.elements[tag] += 1
+        self.tags[tag] += len(tags)
+        tag_types = self.tag_types[tag]
+        keys = self.keys
+        pending_keys = pending['keys']
+        pending_values = pending['values']
+        for _, key, value, tag_type in tags:
+            tag_types[tag_type] += 1
+            k = key if tag_type == 'regular' else tag_type + ':' + key
+            if k in keys:
+                keys[k] += 1
+            elif len(keys) < self.max_keys:
+                keys[k] = 1
+            else:
+                self.keys_uncounted += 1
+            pending_keys[k] += 1
+            pending_values[k + '=' + value] += 1
+        self.observed += 2 + 2 * len(tags)
+        if self.observed >= PENDING_LIMIT:
+            self.flush()
+
+    def make_sketches(self):
+        return dict((field, (HyperLogLog(self.precision),
+                             CountMinSketch(self.width, self.depth) if field in RANKED else None,
+                             TopK(self.top) if field in RANKED else None))
+                    for field in SKETCHED)
+
+    def flush(self):
+        """Fold the pending counts into the sketches"""
+        if self.sketches is None:
+            self.sketches = self.make_sketches()
+        for field, counts in self.pending.items():
+            hll, cms, top = self.sketches[field]
+            for item, count in counts.items():
+                h = hash64(item)
+                hll.add(h)
+                if cms is not None:
+                    top.offer(item, cms.add(h, count))
+            counts.clear()
+        self.observed = 0
+
+    def export(self):
+        """Return the counters, pending counts and sketches as plain picklable values"""
+        sketches = None
+        if self.sketches is not None:
+            sketches = dict((field, {'registers': hll.registers,
+                                     'table': cms.table if cms is not None else None,
+                                     'total': cms.total if cms is not None else 0,
+                                     'candidates': top.counts if top is not None else None})
+                            for field, (hll, cms, top) in self.sketches.items())
+        return {'settings': [self.top, self.precision, self.width, self.depth],
+                'elements': self.elements,
+                'tags': self.tags,
+                'tag_types': dict((tag, dict(types)) for tag, types in self.tag_types.items()),
+                'keys': self.keys,
+                'keys_uncounted': self.keys_uncounted,
+                'pending': dict((field, dict(counts)) for field, counts in self.pending.items()),
+                'sketches': sketches}
+
+    def merge(self, exported):
+        """Add the statistics exported by another TagStats with the same settings"""
+        if exported['settings'] != [self.top, self.precision, self.width, self.depth]:
+            raise ValueError('Cannot merge tag statistics with different sketch settings')
+        for tag in TAGS:
+            self.elements[tag] += exported['elements'][tag]
+            self.tags[tag] += exported['tags'][tag]
+            for tag_type, count in exported['tag_types'][tag].items():
+                self.tag_types[tag][tag_type] += count
+        keys = self.keys
+        for k, count in exported['keys'].items():
+            if k in keys:
+                keys[k] += count
+            elif len(keys) < self.max_keys:
+                keys[k] = count
+            else:
+                self.keys_uncounted += count
+        self.keys_uncounted += exported['keys_uncounted']
+
+        for field, counts in exported['pending'].items():
+            pending = self.pending[field]
+            for item, count in counts.items():
+                pending[item] += count
+            self.observed += len(counts)
+        if exported['sketches'] is not None:
+            if self.sketches is None:
+                self.sketches = self.make_sketches()
+            for field, other in exported['sketches'].items():
+                hll, cms, top = self.sketches[field]
+                hll.merge(other['registers'])
+                if cms is not None:
+                    cms.merge(other['table'], other['total'])
+                    #both sides' candidates, estimated again from the merged counts
+                    for item in set(top.counts) | set(other['candidates']):
+                        top.offer(item, cms.estimate(hash64(item)))
+        if self.observed >= PENDING_LIMIT:
+            self.flush()
+
+    def report(self):
+        """Return the statistics as a JSON-ready dict"""
+        self.flush()
+        distinct = {}
+        top = {}
+        overestimate = {}
+        for field, (hll, cms, ranked) in self.sketches.items():
+            distinct[field] = hll.count()
+            if cms is not None:
+                top[field] = [[item, count] for item, count in ranked.top()]
+                overestimate[field] = cms.error()
+        return {'elements': dict(self.elements),
+                'tags': dict(self.tags),
+                'tag_types': dict((tag, dict(types)) for tag, types in self.tag_types.items() if types),
+                'keys': dict(self.keys),
+                'keys_uncounted': self.keys_uncounted,
+                'distinct': distinct,
+                'distinct_relative_error': round(1.04 / math.sqrt(1 << self.precision), 4),
+                'top': top,
+                'top_max_overestimate': overestimate}
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
 import pprint
-import re
+import audit_engine
+import osm_reader
 """
 This code was adapted from the lesson exercises for the Wrangle OpenStreetMap Data Project
 Your task is to explore the data a bit more.
@@ -11,28 +11,11 @@ have contributed to the map in this particular area!
 
 The function process_map should return a set of unique user IDs ("uid")
 """
-#this function uses iterparse to fetch all of the elements in the dataset
-#Uses code that ensures the elements are not stored in memory
-#Reference: https://discussions.udacity.com/t/lingering-questions-as-i-head-into-sql-portion-of-p3/237251/27
-def get_element(osm_file):
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end':
-            yield elem
-            root.clear()
-
 #This function will do the heavy lifting for determining the unique users in the dataset
-def process_map(filename):
-    #create a set() to store the unique users in
-    users = set()
-    #Loop over all elements in the input osm file
-    #Check the element.tag type and fill the set() with unigue users if type== "node", "way" or "relation"
-    for element in get_element(filename):
-        if element.tag == "node" or element.tag == "way" or element.tag == "relation":
-            users.add(element.get('user'))
-
-    return users
+#The users are gathered by the users collector of the single pass audit in audit_engine.py
+def process_map(filename, backend=osm_reader.DEFAULT_BACKEND):
+    report = audit_engine.run_audit(filename, [audit_engine.UserCollector()], backend)
+    return report['users']['users']
 
 if __name__ == "__main__":
     #call the process map function to determine unique users and store it in the users variable